@@ -1,5 +1,5 @@
 import os
-os.environ['CUDA_VISIBLE_DEVICES'] = '0,1,2,3'
+# os.environ['CUDA_VISIBLE_DEVICES'] = '0,1,2,3'
 
 import random
 import logging
@@ -10,23 +10,28 @@ import torch
 import numpy as np
 import pandas as pd
 import torch.nn as nn
-import torch.optim as optim
-import torch.distributed as dist
-dist.init_process_group(backend="nccl")
 
 from model.CKE import CKE
 from utility.parser_cke import *
 from utility.log_helper import *
 from utility.metrics import *
 from utility.helper import *
+from utility.prefetcher import BatchPrefetcher
+from utility.optimizer import create_optimizer, optimizer_state_nbytes
+from utility.distributed import init_distributed, barrier, cleanup, shard, all_reduce_sum
+from utility.mips_index import export_index
+from utility.quantize import export_quantized
 from utility.loader_cke import DataLoaderCKE
 
 
-def evaluate(model, train_user_dict, test_user_dict, user_ids_batches, item_ids, K):
+# 数据并行时每个进程只评估自己的那部分用户，指标的和在所有进程之间相加
+# quantized 不为 None 时用 utility.quantize 导出的低精度编码打分，不使用 model
+def evaluate(model, train_user_csr, test_user_csr, user_ids_batches, item_ids, K, quantized=None):
     model.eval()
     model = model.module if isinstance(model, nn.parallel.DistributedDataParallel) else model
+    scorer = model if quantized is None else quantized
 
-    n_users = len(test_user_dict.keys())
+    n_users = sum(len(d) for d in user_ids_batches)
     item_ids_batch = item_ids.cpu().numpy()
 
     cf_scores = []
@@ -36,21 +41,23 @@ def evaluate(model, train_user_dict, test_user_dict, user_ids_batches, item_ids,
 
     with torch.no_grad():
         for user_ids_batch in user_ids_batches:
-            cf_scores_batch = model.predict(user_ids_batch, item_ids)       # (n_batch_users, n_eval_items)
+            cf_scores_batch = scorer.predict(user_ids_batch, item_ids)      # (n_batch_users, n_eval_items)
 
-            cf_scores_batch = cf_scores_batch.cpu()
+            # 分数留在原设备上计算指标，只有需要返回的分数才拷贝到 cpu
             user_ids_batch = user_ids_batch.cpu().numpy()
-            precision_batch, recall_batch, ndcg_batch = calc_metrics_at_k(cf_scores_batch, train_user_dict, test_user_dict, user_ids_batch, item_ids_batch, K)
+            precision_batch, recall_batch, ndcg_batch = calc_metrics_at_k(cf_scores_batch, train_user_csr, test_user_csr, user_ids_batch, item_ids_batch, K)
 
-            cf_scores.append(cf_scores_batch.numpy())
+            cf_scores.append(cf_scores_batch.cpu().numpy())
             precision.append(precision_batch)
             recall.append(recall_batch)
             ndcg.append(ndcg_batch)
 
-    cf_scores = np.concatenate(cf_scores, axis=0)
-    precision_k = sum(np.concatenate(precision)) / n_users
-    recall_k = sum(np.concatenate(recall)) / n_users
-    ndcg_k = sum(np.concatenate(ndcg)) / n_users
+    cf_scores = np.concatenate(cf_scores, axis=0) if len(cf_scores) > 0 else None
+    precision_sum, recall_sum, ndcg_sum, n_users = all_reduce_sum([sum(d.sum() for d in precision), sum(d.sum() for d in recall),
+                                                                   sum(d.sum() for d in ndcg), n_users])
+    precision_k = precision_sum / n_users
+    recall_k = recall_sum / n_users
+    ndcg_k = ndcg_sum / n_users
     return cf_scores, precision_k, recall_k, ndcg_k
 
 
@@ -60,8 +67,12 @@ def train(args):
     np.random.seed(args.seed)
     torch.manual_seed(args.seed)
 
-    log_save_id = create_log_id(args.save_dir)
-    logging_config(folder=args.save_dir, name='log{:d}'.format(log_save_id), no_console=False)
+    # 只有使用 torchrun 启动并且 --distributed 1 时才初始化进程组，只有 0 号进程写日志和保存模型
+    rank, world_size = init_distributed(args)
+
+    if rank == 0:
+        log_save_id = create_log_id(args.save_dir)
+        logging_config(folder=args.save_dir, name='log{:d}'.format(log_save_id), no_console=False)
     logging.info(args)
 
     # GPU / CPU
@@ -72,7 +83,18 @@ def train(args):
         torch.cuda.manual_seed_all(args.seed)
 
     # load data
+    # 0 号进程先读取（--kg_binary 1 时会写 kg_final.npy），其它进程等它完成后再读取
+    if rank != 0:
+        barrier()
     data = DataLoaderCKE(args, logging)
+    if rank == 0:
+        barrier()
+
+    # 每个进程只从自己的那部分用户 / 头实体中采样
+    if world_size > 1:
+        data.cf_sampler.shard(rank, world_size)
+        data.kg_sampler.shard(rank, world_size)
+    rank_seed = [rank] if world_size > 1 else []
 
     if args.use_pretrain == 1:
         user_pre_embed = torch.tensor(data.user_pre_embed)
@@ -80,7 +102,7 @@ def train(args):
     else:
         user_pre_embed, item_pre_embed = None, None
 
-    user_ids = list(data.test_user_dict.keys())
+    user_ids = shard(list(data.test_user_dict.keys()), rank, world_size)
     user_ids_batches = [user_ids[i: i + args.test_batch_size] for i in range(0, len(user_ids), args.test_batch_size)]
     user_ids_batches = [torch.LongTensor(d) for d in user_ids_batches]
     if use_cuda:
@@ -90,17 +112,21 @@ def train(args):
     if use_cuda:
         item_ids = item_ids.to(device)
 
+    # 训练集和测试集只转换一次 CSR，评估时一次性屏蔽训练集中的项目
+    train_user_csr = user_dict_to_csr(data.train_user_dict, data.n_items)
+    test_user_csr = user_dict_to_csr(data.test_user_dict, data.n_items)
+
     # construct model & optimizer
     model = CKE(args, data.n_users, data.n_items, data.n_entities, data.n_relations, user_pre_embed, item_pre_embed)
     if args.use_pretrain == 2:
         model = load_model(model, args.pretrain_model_path)
 
     model.to(device)
-    if n_gpu > 1:
+    if world_size > 1:
         model = nn.parallel.DistributedDataParallel(model)
     logging.info(model)
 
-    optimizer = optim.Adam(model.parameters(), lr=args.lr)
+    optimizer = create_optimizer(model, args.lr, args.sparse_grad == 1)
 
     # initialize metrics
     best_epoch = -1
@@ -118,24 +144,25 @@ def train(args):
         time1 = time()
         total_loss = 0
 
-        n_kg_batch = data.n_kg_data // data.kg_batch_size + 1
-        n_cf_batch = data.n_cf_train // data.cf_batch_size + 1
+        n_kg_batch = data.n_kg_data // (data.kg_batch_size * world_size) + 1
+        n_cf_batch = data.n_cf_train // (data.cf_batch_size * world_size) + 1
         n_batch = max(n_kg_batch, n_cf_batch)
 
-        for iter in range(1, n_batch + 1):
+        batches = BatchPrefetcher(lambda rng: data.generate_cf_batch(data.train_user_dict, rng) + data.generate_kg_batch(data.kg_dict, rng), n_batch,
+                                  args.n_workers, args.prefetch_depth, [args.seed, epoch] + rank_seed, args.pin_memory == 1)
+        for iter, batch in enumerate(batches, 1):
             time2 = time()
-            cf_batch_user, cf_batch_pos_item, cf_batch_neg_item = data.generate_cf_batch(data.train_user_dict)
-            kg_batch_head, kg_batch_relation, kg_batch_pos_tail, kg_batch_neg_tail = data.generate_kg_batch(data.kg_dict)
+            cf_batch_user, cf_batch_pos_item, cf_batch_neg_item, kg_batch_head, kg_batch_relation, kg_batch_pos_tail, kg_batch_neg_tail = batch
 
             if use_cuda:
-                cf_batch_user = cf_batch_user.to(device)
-                cf_batch_pos_item = cf_batch_pos_item.to(device)
-                cf_batch_neg_item = cf_batch_neg_item.to(device)
+                cf_batch_user = cf_batch_user.to(device, non_blocking=True)
+                cf_batch_pos_item = cf_batch_pos_item.to(device, non_blocking=True)
+                cf_batch_neg_item = cf_batch_neg_item.to(device, non_blocking=True)
 
-                kg_batch_head = kg_batch_head.to(device)
-                kg_batch_relation = kg_batch_relation.to(device)
-                kg_batch_pos_tail = kg_batch_pos_tail.to(device)
-                kg_batch_neg_tail = kg_batch_neg_tail.to(device)
+                kg_batch_head = kg_batch_head.to(device, non_blocking=True)
+                kg_batch_relation = kg_batch_relation.to(device, non_blocking=True)
+                kg_batch_pos_tail = kg_batch_pos_tail.to(device, non_blocking=True)
+                kg_batch_neg_tail = kg_batch_neg_tail.to(device, non_blocking=True)
 
             batch_loss = model('train', cf_batch_user, cf_batch_pos_item, cf_batch_neg_item, kg_batch_head, kg_batch_relation, kg_batch_pos_tail, kg_batch_neg_tail).mean()
             batch_loss.backward()
@@ -145,12 +172,12 @@ def train(args):
 
             if (iter % args.print_every) == 0:
                 logging.info('KG & CF Training: Epoch {:04d} Iter {:04d} / {:04d} | Time {:.1f}s | Iter Loss {:.4f} | Iter Mean Loss {:.4f}'.format(epoch, iter, n_batch, time() - time2, batch_loss.item(), total_loss / iter))
-        logging.info('KG & CF Training: Epoch {:04d} Total Iter {:04d} | Total Time {:.1f}s | Iter Mean Loss {:.4f}'.format(epoch, n_batch, time() - time1, total_loss / n_batch))
+        logging.info('KG & CF Training: Epoch {:04d} Total Iter {:04d} | Total Time {:.1f}s | Iter Mean Loss {:.4f} | Peak RSS {:.1f} MB | Optimizer State {:.1f} MB'.format(epoch, n_batch, time() - time1, total_loss / n_batch, peak_rss(), optimizer_state_nbytes(optimizer) / 2 ** 20))
 
         # evaluate cf
         if (epoch % args.evaluate_every) == 0:
             time1 = time()
-            _, precision, recall, ndcg = evaluate(model, data.train_user_dict, data.test_user_dict, user_ids_batches, item_ids, args.K)
+            _, precision, recall, ndcg = evaluate(model, train_user_csr, test_user_csr, user_ids_batches, item_ids, args.K)
             logging.info('CF Evaluation: Epoch {:04d} | Total Time {:.1f}s | Precision {:.4f} Recall {:.4f} NDCG {:.4f}'.format(epoch, time() - time1, precision, recall, ndcg))
 
             epoch_list.append(epoch)
@@ -163,15 +190,17 @@ def train(args):
                 break
 
             if recall_list.index(best_recall) == len(recall_list) - 1:
-                save_model(model, args.save_dir, epoch, best_epoch)
-                logging.info('Save model on epoch {:04d}!'.format(epoch))
+                if rank == 0:
+                    save_model(model, args.save_dir, epoch, best_epoch)
+                    logging.info('Save model on epoch {:04d}!'.format(epoch))
                 best_epoch = epoch
 
     # save model
-    save_model(model, args.save_dir, epoch)
+    if rank == 0:
+        save_model(model, args.save_dir, epoch)
 
     # save metrics
-    _, precision, recall, ndcg = evaluate(model, data.train_user_dict, data.test_user_dict, user_ids_batches, item_ids, args.K)
+    _, precision, recall, ndcg = evaluate(model, train_user_csr, test_user_csr, user_ids_batches, item_ids, args.K)
     logging.info('Final CF Evaluation: Precision {:.4f} Recall {:.4f} NDCG {:.4f}'.format(precision, recall, ndcg))
 
     epoch_list.append(epoch)
@@ -179,9 +208,11 @@ def train(args):
     recall_list.append(recall)
     ndcg_list.append(ndcg)
 
-    metrics = pd.DataFrame([epoch_list, precision_list, recall_list, ndcg_list]).transpose()
-    metrics.columns = ['epoch_idx', 'precision@{}'.format(args.K), 'recall@{}'.format(args.K), 'ndcg@{}'.format(args.K)]
-    metrics.to_csv(args.save_dir + '/metrics.tsv', sep='\t', index=False)
+    if rank == 0:
+        metrics = pd.DataFrame([epoch_list, precision_list, recall_list, ndcg_list]).transpose()
+        metrics.columns = ['epoch_idx', 'precision@{}'.format(args.K), 'recall@{}'.format(args.K), 'ndcg@{}'.format(args.K)]
+        metrics.to_csv(args.save_dir + '/metrics.tsv', sep='\t', index=False)
+    cleanup()
 
 
 def predict(args):
@@ -205,16 +236,37 @@ def predict(args):
     if use_cuda:
         item_ids = item_ids.to(device)
 
+    # 训练集和测试集只转换一次 CSR，评估时一次性屏蔽训练集中的项目
+    train_user_csr = user_dict_to_csr(data.train_user_dict, data.n_items)
+    test_user_csr = user_dict_to_csr(data.test_user_dict, data.n_items)
+
     # load model
     model = CKE(args, data.n_users, data.n_items, data.n_entities, data.n_relations)
     model = load_model(model, args.pretrain_model_path)
     model.to(device)
 
     # predict
-    cf_scores, precision, recall, ndcg = evaluate(model, data.train_user_dict, data.test_user_dict, user_ids_batches, item_ids, args.K)
+    time0 = time()
+    cf_scores, precision, recall, ndcg = evaluate(model, train_user_csr, test_user_csr, user_ids_batches, item_ids, args.K)
+    eval_time = time() - time0
     np.save(args.save_dir + 'cf_scores.npy', cf_scores)
     print('CF Evaluation: Precision {:.4f} Recall {:.4f} NDCG {:.4f}'.format(precision, recall, ndcg))
 
+    # 导出推理用的低精度编码，读取后用它再评估一次，和 float32 的模型比较指标和打分吞吐量
+    if args.quantize_embed != 'none':
+        user_embed, item_embed = model.export_embed()
+        quantized = export_quantized(args, user_embed, item_embed).to(device)
+        time0 = time()
+        _, q_precision, q_recall, q_ndcg = evaluate(model, train_user_csr, test_user_csr, user_ids_batches, item_ids, args.K, quantized)
+        q_eval_time = time() - time0
+        print('Quantized CF Evaluation: Precision {:.4f} Recall {:.4f} NDCG {:.4f} | Delta Recall {:+.4f} NDCG {:+.4f} | {:.0f} users/s (float32 model {:.0f} users/s)'.format(
+            q_precision, q_recall, q_ndcg, q_recall - recall, q_ndcg - ndcg, len(user_ids) / q_eval_time, len(user_ids) / eval_time))
+
+    # 导出 MIPS 索引，线上用 Recommender.load 读取后 recommend(user_id, k)
+    if args.ann_index == 1:
+        user_embed, item_embed = model.export_embed()
+        export_index(args, user_embed, item_embed, train_user_csr, test_user_csr, np.array(user_ids))
+
 
 
 if __name__ == '__main__':
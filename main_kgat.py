@@ -11,7 +11,6 @@ import torch
 import numpy as np
 import pandas as pd
 import torch.nn as nn
-import torch.optim as optim
 import torch.distributed as dist
 
 from model.KGAT import KGAT
@@ -19,18 +18,32 @@ from utility.parser_kgat import *
 from utility.log_helper import *
 from utility.metrics import *
 from utility.helper import *
+from utility.prefetcher import BatchPrefetcher
+from utility.optimizer import create_optimizer, optimizer_state_nbytes
+from utility.distributed import init_distributed, barrier, cleanup, shard, all_reduce_sum
+from utility.mips_index import export_index
+from utility.quantize import export_quantized
 from utility.loader_kgat import DataLoaderKGAT
 
 
-# 评估的时候大部分是在cpu完成的，计算评估的底层函数都是用的numpy，应该是可以在gpu中完成，待优化
-def evaluate(model, train_graph, train_user_dict, test_user_dict, user_ids_batches, item_ids, K):
+# 评估指标在模型所在的设备上用 torch.topk 计算，不再把整行分数拷贝到 cpu 排序
+# out-of-core 模式下 train_graph 为 None，block_fn 每次返回一组覆盖所有节点的 block，逐块传播
+# 数据并行时每个进程只评估自己的那部分用户，指标的和在所有进程之间相加
+# quantized 不为 None 时用 utility.quantize 导出的低精度编码打分，不需要传播
+def evaluate(model, train_graph, train_user_csr, test_user_csr, user_ids_batches, item_ids, K, block_fn=None, rank=0, world_size=1, quantized=None):
     model.eval()
 
-    with torch.no_grad():
-        att = model.compute_attention(train_graph)
-    train_graph.edata['att'] = att
-
-    n_users = len(test_user_dict.keys())
+    # 整个评估只传播一次，之后每个 batch 的用户直接从保存的编码中打分
+    if quantized is None:
+        if train_graph is None:
+            model.freeze_blocks(block_fn)
+        else:
+            with torch.no_grad():
+                att = model.compute_attention(train_graph, rank, world_size)
+            train_graph.edata['att'] = att
+            model.freeze(train_graph)
+
+    n_users = sum(len(d) for d in user_ids_batches)
     # item_ids_batch = item_ids
     item_ids_batch = item_ids.cpu().numpy()
 
@@ -42,23 +55,29 @@ def evaluate(model, train_graph, train_user_dict, test_user_dict, user_ids_batch
     with torch.no_grad():
         # for user_ids_batch in user_ids_batches:
         for user_ids_batch in tqdm(user_ids_batches, desc='Evaluating Iteration'):
-            cf_scores_batch = model('predict', train_graph, user_ids_batch, item_ids)       # (n_batch_users, n_eval_items)
+            if quantized is None:
+                cf_scores_batch = model('predict', train_graph, user_ids_batch, item_ids)       # (n_batch_users, n_eval_items)
+            else:
+                cf_scores_batch = quantized.predict(user_ids_batch, item_ids)                   # (n_batch_users, n_eval_items)
 
-            cf_scores_batch = cf_scores_batch.cpu()
+            # 分数留在原设备上计算指标，只有第一个 batch 的分数拷贝到 cpu 用于返回
             user_ids_batch = user_ids_batch.cpu().numpy()
-            precision_batch, recall_batch, ndcg_batch = calc_metrics_at_k(cf_scores_batch, train_user_dict, test_user_dict, user_ids_batch, item_ids_batch, K)
+            precision_batch, recall_batch, ndcg_batch = calc_metrics_at_k(cf_scores_batch, train_user_csr, test_user_csr, user_ids_batch, item_ids_batch, K)
 
-            cf_scores.append(cf_scores_batch.numpy())
+            if len(cf_scores) == 0:
+                cf_scores.append(cf_scores_batch.cpu().numpy())
             precision.append(precision_batch)
             recall.append(recall_batch)
             ndcg.append(ndcg_batch)
 
     # 如果全部返回的话占用 6.55 GiB，训练的时候电脑无法分配这么多内存，只有在预测的情况下才能
     # cf_scores = np.concatenate(cf_scores, axis=0)  #  (70591, 24915)
-    cf_scores = cf_scores[0]
-    precision_k = sum(np.concatenate(precision)) / n_users
-    recall_k = sum(np.concatenate(recall)) / n_users
-    ndcg_k = sum(np.concatenate(ndcg)) / n_users
+    cf_scores = cf_scores[0] if len(cf_scores) > 0 else None
+    precision_sum, recall_sum, ndcg_sum, n_users = all_reduce_sum([sum(d.sum() for d in precision), sum(d.sum() for d in recall),
+                                                                   sum(d.sum() for d in ndcg), n_users])
+    precision_k = precision_sum / n_users
+    recall_k = recall_sum / n_users
+    ndcg_k = ndcg_sum / n_users
     return cf_scores, precision_k, recall_k, ndcg_k
 
 
@@ -68,9 +87,13 @@ def train(args):
     np.random.seed(args.seed)
     torch.manual_seed(args.seed)
 
+    # 数据并行，只有 0 号进程写日志和保存模型
+    rank, world_size = init_distributed(args)
+
     # 创建日志文件
-    log_save_id = create_log_id(args.save_dir)
-    logging_config(folder=args.save_dir, name='log{:d}'.format(log_save_id), no_console=False)
+    if rank == 0:
+        log_save_id = create_log_id(args.save_dir)
+        logging_config(folder=args.save_dir, name='log{:d}'.format(log_save_id), no_console=False)
     logging.info(args)
 
     # GPU / CPU
@@ -82,10 +105,21 @@ def train(args):
     print('device:', device, 'n_gpu:', n_gpu)
 
     # load data
+    # 0 号进程先读取（缓存不存在时创建缓存），其它进程等它完成后再从缓存读取
     print('load data ...')
+    if rank != 0:
+        barrier()
     data = DataLoaderKGAT(args, logging)
+    if rank == 0:
+        barrier()
     print('load data finish.')
 
+    # 每个进程只从自己的那部分用户 / 头实体中采样
+    if world_size > 1:
+        data.cf_sampler.shard(rank, world_size)
+        data.kg_sampler.shard(rank, world_size)
+    rank_seed = [rank] if world_size > 1 else []
+
     # embedding
     if args.use_pretrain == 1:
         user_pre_embed = torch.tensor(data.user_pre_embed)
@@ -93,7 +127,7 @@ def train(args):
     else:
         user_pre_embed, item_pre_embed = None, None
 
-    user_ids = list(data.test_user_dict.keys())
+    user_ids = shard(list(data.test_user_dict.keys()), rank, world_size)
     user_ids_batches = [user_ids[i: i + args.test_batch_size] for i in range(0, len(user_ids), args.test_batch_size)]
     user_ids_batches = [torch.LongTensor(d) for d in user_ids_batches]
     if use_cuda:
@@ -103,25 +137,35 @@ def train(args):
     if use_cuda:
         item_ids = item_ids.to(device)
 
+    # 训练集和测试集只转换一次 CSR，评估时一次性屏蔽训练集中的项目
+    train_user_csr = user_dict_to_csr(data.train_user_dict, data.n_items)
+    test_user_csr = user_dict_to_csr(data.test_user_dict, data.n_items)
+
     # construct model & optimizer
     model = KGAT(args, data.n_users, data.n_entities, data.n_relations, user_pre_embed, item_pre_embed)
     if args.use_pretrain == 2:
         model = load_model(model, args.pretrain_model_path)
 
     model.to(device)
-    # if n_gpu > 1:
-    #     model = nn.parallel.DistributedDataParallel(model)
+    # cf / kg 两种 loss 各自只用到一部分参数，需要 find_unused_parameters
+    # 注意力、评估和保存模型直接使用 kgat（不经过 DDP）
+    kgat = model
+    if world_size > 1:
+        model = nn.parallel.DistributedDataParallel(model, find_unused_parameters=True)
     logging.info(model)
 
-    optimizer = optim.Adam(model.parameters(), lr=args.lr)
+    optimizer = create_optimizer(model, args.lr, args.sparse_grad == 1)
 
     # move graph data to GPU
-    if use_cuda:
+    if use_cuda and not data.out_of_core:
         data.train_graph = data.train_graph.to(device)
         # data.test_graph = data.test_graph.to(device)
 
     train_graph = data.train_graph
     # test_graph = data.test_graph
+    block_fn = lambda: data.in_blocks(args.ooc_chunk_size)
+    fanouts = eval(args.fanout)
+    assert len(fanouts) == kgat.n_layers
 
     # initialize metrics
     best_epoch = -1
@@ -137,24 +181,43 @@ def train(args):
         model.train()
 
         # update attention scores
-        with torch.no_grad():
-            att = model('calc_att', train_graph)
-        train_graph.edata['att'] = att
-        logging.info('Update attention scores: Epoch {:04d} | Total Time {:.1f}s'.format(epoch, time() - time0))
+        # out-of-core 模式下没有整个图，注意力在每个 batch 的 block 上计算
+        # 数据并行时各进程分别计算一段边的注意力，再拼接成整个图的注意力
+        if not data.out_of_core:
+            with torch.no_grad():
+                att = kgat.compute_attention(train_graph, rank, world_size)
+            train_graph.edata['att'] = att
+            logging.info('Update attention scores: Epoch {:04d} | Total Time {:.1f}s'.format(epoch, time() - time0))
 
         # train cf
         time1 = time()
         cf_total_loss = 0
-        n_cf_batch = data.n_cf_train // data.cf_batch_size + 1
-
-        for iter in range(1, n_cf_batch + 1):
+        n_cf_batch = data.n_cf_train // (data.cf_batch_size * world_size) + 1
+
+        if data.out_of_core:
+            # 预取线程直接从 mmap 采样并构建 batch 的 block
+            make_cf_batch = lambda rng: data.generate_cf_block_batch(data.train_user_dict, fanouts, rng)
+        else:
+            make_cf_batch = lambda rng: data.generate_cf_batch(data.train_user_dict, rng) + (None,)
+        cf_batches = BatchPrefetcher(make_cf_batch, n_cf_batch,
+                                     args.n_workers, args.prefetch_depth, [args.seed, epoch, 0] + rank_seed, args.pin_memory == 1)
+        for iter, (cf_batch_user, cf_batch_pos_item, cf_batch_neg_item, cf_batch_blocks) in enumerate(cf_batches, 1):
             time2 = time()
-            cf_batch_user, cf_batch_pos_item, cf_batch_neg_item = data.generate_cf_batch(data.train_user_dict)
             if use_cuda:
-                cf_batch_user = cf_batch_user.to(device)
-                cf_batch_pos_item = cf_batch_pos_item.to(device)
-                cf_batch_neg_item = cf_batch_neg_item.to(device)
-            cf_batch_loss = model('calc_cf_loss', train_graph, cf_batch_user, cf_batch_pos_item, cf_batch_neg_item)
+                cf_batch_user = cf_batch_user.to(device, non_blocking=True)
+                cf_batch_pos_item = cf_batch_pos_item.to(device, non_blocking=True)
+                cf_batch_neg_item = cf_batch_neg_item.to(device, non_blocking=True)
+            if data.out_of_core:
+                cf_batch_graph = [block.to(device) for block in cf_batch_blocks]
+                with torch.no_grad():
+                    for block in cf_batch_graph:
+                        block.edata['att'] = kgat('calc_att', block)
+            elif args.use_block == 1:
+                cf_batch_seeds = torch.unique(torch.cat([cf_batch_user, cf_batch_pos_item, cf_batch_neg_item]))
+                cf_batch_graph = data.sample_blocks(train_graph, cf_batch_seeds, fanouts)
+            else:
+                cf_batch_graph = train_graph
+            cf_batch_loss = model('calc_cf_loss', cf_batch_graph, cf_batch_user, cf_batch_pos_item, cf_batch_neg_item)
 
             cf_batch_loss.backward()
             optimizer.step()
@@ -163,21 +226,23 @@ def train(args):
 
             if (iter % args.cf_print_every) == 0:
                 logging.info('CF Training: Epoch {:04d} Iter {:04d} / {:04d} | Time {:.1f}s | Iter Loss {:.4f} | Iter Mean Loss {:.4f}'.format(epoch, iter, n_cf_batch, time() - time2, cf_batch_loss.item(), cf_total_loss / iter))
-        logging.info('CF Training: Epoch {:04d} Total Iter {:04d} | Total Time {:.1f}s | Iter Mean Loss {:.4f}'.format(epoch, n_cf_batch, time() - time1, cf_total_loss / n_cf_batch))
+        cf_time = time() - time1
+        logging.info('CF Training: Epoch {:04d} Total Iter {:04d} | Total Time {:.1f}s | Iter Mean Loss {:.4f} | {:.0f} samples/s'.format(epoch, n_cf_batch, cf_time, cf_total_loss / n_cf_batch, n_cf_batch * data.cf_batch_size * world_size / cf_time))
 
         # train kg
         time1 = time()
         kg_total_loss = 0
-        n_kg_batch = data.n_kg_train // data.kg_batch_size + 1
+        n_kg_batch = data.n_kg_train // (data.kg_batch_size * world_size) + 1
 
-        for iter in range(1, n_kg_batch + 1):
+        kg_batches = BatchPrefetcher(lambda rng: data.generate_kg_batch(data.train_kg_dict, rng), n_kg_batch,
+                                     args.n_workers, args.prefetch_depth, [args.seed, epoch, 1] + rank_seed, args.pin_memory == 1)
+        for iter, (kg_batch_head, kg_batch_relation, kg_batch_pos_tail, kg_batch_neg_tail) in enumerate(kg_batches, 1):
             time2 = time()
-            kg_batch_head, kg_batch_relation, kg_batch_pos_tail, kg_batch_neg_tail = data.generate_kg_batch(data.train_kg_dict)
             if use_cuda:
-                kg_batch_head = kg_batch_head.to(device)
-                kg_batch_relation = kg_batch_relation.to(device)
-                kg_batch_pos_tail = kg_batch_pos_tail.to(device)
-                kg_batch_neg_tail = kg_batch_neg_tail.to(device)
+                kg_batch_head = kg_batch_head.to(device, non_blocking=True)
+                kg_batch_relation = kg_batch_relation.to(device, non_blocking=True)
+                kg_batch_pos_tail = kg_batch_pos_tail.to(device, non_blocking=True)
+                kg_batch_neg_tail = kg_batch_neg_tail.to(device, non_blocking=True)
             kg_batch_loss = model('calc_kg_loss', kg_batch_head, kg_batch_relation, kg_batch_pos_tail, kg_batch_neg_tail)
 
             kg_batch_loss.backward()
@@ -187,14 +252,15 @@ def train(args):
 
             if (iter % args.kg_print_every) == 0:
                 logging.info('KG Training: Epoch {:04d} Iter {:04d} / {:04d} | Time {:.1f}s | Iter Loss {:.4f} | Iter Mean Loss {:.4f}'.format(epoch, iter, n_kg_batch, time() - time2, kg_batch_loss.item(), kg_total_loss / iter))
-        logging.info('KG Training: Epoch {:04d} Total Iter {:04d} | Total Time {:.1f}s | Iter Mean Loss {:.4f}'.format(epoch, n_kg_batch, time() - time1, kg_total_loss / n_kg_batch))
+        kg_time = time() - time1
+        logging.info('KG Training: Epoch {:04d} Total Iter {:04d} | Total Time {:.1f}s | Iter Mean Loss {:.4f} | {:.0f} samples/s'.format(epoch, n_kg_batch, kg_time, kg_total_loss / n_kg_batch, n_kg_batch * data.kg_batch_size * world_size / kg_time))
 
-        logging.info('CF + KG Training: Epoch {:04d} | Total Time {:.1f}s'.format(epoch, time() - time0))
+        logging.info('CF + KG Training: Epoch {:04d} | Total Time {:.1f}s | Peak RSS {:.1f} MB | Optimizer State {:.1f} MB'.format(epoch, time() - time0, peak_rss(), optimizer_state_nbytes(optimizer) / 2 ** 20))
 
         # evaluate cf
         if (epoch % args.evaluate_every) == 0:
             time1 = time()
-            _, precision, recall, ndcg = evaluate(model, train_graph, data.train_user_dict, data.test_user_dict, user_ids_batches, item_ids, args.K)
+            _, precision, recall, ndcg = evaluate(kgat, train_graph, train_user_csr, test_user_csr, user_ids_batches, item_ids, args.K, block_fn, rank, world_size)
             logging.info('CF Evaluation: Epoch {:04d} | Total Time {:.1f}s | Precision {:.4f} Recall {:.4f} NDCG {:.4f}'.format(epoch, time() - time1, precision, recall, ndcg))
 
             epoch_list.append(epoch)
@@ -207,8 +273,9 @@ def train(args):
                 break
 
             if recall_list.index(best_recall) == len(recall_list) - 1:
-                save_model(model, args.save_dir, epoch, best_epoch)
-                logging.info('Save model on epoch {:04d}!'.format(epoch))
+                if rank == 0:
+                    save_model(kgat, args.save_dir, epoch, best_epoch)
+                    logging.info('Save model on epoch {:04d}!'.format(epoch))
                 best_epoch = epoch
 
     # save model
@@ -216,7 +283,7 @@ def train(args):
     # logging.info('Save model on epoch {:04d}!'.format(epoch))
     #
     # # save metrics
-    # _, precision, recall, ndcg = evaluate(model, train_graph, data.train_user_dict, data.test_user_dict, user_ids_batches, item_ids, args.K)
+    # _, precision, recall, ndcg = evaluate(model, train_graph, train_user_csr, test_user_csr, user_ids_batches, item_ids, args.K)
     # logging.info('Final CF Evaluation: Precision {:.4f} Recall {:.4f} NDCG {:.4f}'.format(precision, recall, ndcg))
     #
     # epoch_list.append(epoch)
@@ -224,9 +291,11 @@ def train(args):
     # recall_list.append(recall)
     # ndcg_list.append(ndcg)
 
-    metrics = pd.DataFrame([epoch_list, precision_list, recall_list, ndcg_list]).transpose()
-    metrics.columns = ['epoch_idx', 'precision@{}'.format(args.K), 'recall@{}'.format(args.K), 'ndcg@{}'.format(args.K)]
-    metrics.to_csv(args.save_dir + '/metrics.tsv', sep='\t', index=False)
+    if rank == 0:
+        metrics = pd.DataFrame([epoch_list, precision_list, recall_list, ndcg_list]).transpose()
+        metrics.columns = ['epoch_idx', 'precision@{}'.format(args.K), 'recall@{}'.format(args.K), 'ndcg@{}'.format(args.K)]
+        metrics.to_csv(args.save_dir + '/metrics.tsv', sep='\t', index=False)
+    cleanup()
 
 
 def predict(args):
@@ -250,6 +319,10 @@ def predict(args):
     if use_cuda:
         item_ids = item_ids.to(device)
 
+    # 训练集和测试集只转换一次 CSR，评估时一次性屏蔽训练集中的项目
+    train_user_csr = user_dict_to_csr(data.train_user_dict, data.n_items)
+    test_user_csr = user_dict_to_csr(data.test_user_dict, data.n_items)
+
     # load model
     model = KGAT(args, data.n_users, data.n_entities, data.n_relations)
     model = load_model(model, args.pretrain_model_path)
@@ -258,18 +331,39 @@ def predict(args):
     #     model = nn.parallel.DistributedDataParallel(model)
 
     # move graph data to GPU
-    if use_cuda:
+    if use_cuda and not data.out_of_core:
         data.train_graph = data.train_graph.to(device)
         # data.test_graph = data.test_graph.to(device)
 
     train_graph = data.train_graph
     # test_graph = data.test_graph
+    block_fn = lambda: data.in_blocks(args.ooc_chunk_size)
 
     # predict
-    cf_scores, precision, recall, ndcg = evaluate(model, train_graph, data.train_user_dict, data.test_user_dict, user_ids_batches, item_ids, args.K)
+    time0 = time()
+    cf_scores, precision, recall, ndcg = evaluate(model, train_graph, train_user_csr, test_user_csr, user_ids_batches, item_ids, args.K, block_fn)
+    eval_time = time() - time0
     np.save(args.save_dir + 'cf_scores.npy', cf_scores)
     print('CF Evaluation: Precision {:.4f} Recall {:.4f} NDCG {:.4f}'.format(precision, recall, ndcg))
 
+    # 导出推理用的低精度编码（传播后的最终编码），读取后用它再评估一次，和 float32 的模型（包括传播）比较指标和打分吞吐量
+    # 图中用户的 id 为 n_entities + u，编码文件中第 u 行为用户 u
+    if args.quantize_embed != 'none':
+        user_embed, item_embed = model.export_embed(data.n_items, train_graph)
+        quantized = export_quantized(args, user_embed, item_embed, data.n_entities).to(device)
+        time0 = time()
+        _, q_precision, q_recall, q_ndcg = evaluate(model, train_graph, train_user_csr, test_user_csr, user_ids_batches, item_ids, args.K, block_fn, quantized=quantized)
+        q_eval_time = time() - time0
+        print('Quantized CF Evaluation: Precision {:.4f} Recall {:.4f} NDCG {:.4f} | Delta Recall {:+.4f} NDCG {:+.4f} | {:.0f} users/s (float32 model {:.0f} users/s)'.format(
+            q_precision, q_recall, q_ndcg, q_recall - recall, q_ndcg - ndcg, len(user_ids) / q_eval_time, len(user_ids) / eval_time))
+
+    # 导出 MIPS 索引，线上用 Recommender.load 读取后 recommend(user_id, k)
+    # 图中用户的 id 为 n_entities + u，索引中使用原始的用户 id u
+    if args.ann_index == 1:
+        user_embed, item_embed = model.export_embed(data.n_items, train_graph)
+        export_index(args, user_embed, item_embed, train_user_csr[data.n_entities:], test_user_csr[data.n_entities:],
+                     np.array(user_ids) - data.n_entities)
+
 
 if __name__ == '__main__':
     args = parse_kgat_args()
@@ -2,7 +2,6 @@ import os
 import random
 import logging
 import argparse
-import itertools
 from time import time
 
 import torch
@@ -17,58 +16,42 @@ from utility.parser_nfm import *
 from utility.log_helper import *
 from utility.metrics import *
 from utility.helper import *
+from utility.prefetcher import BatchPrefetcher
 from utility.loader_nfm import DataLoaderNFM
 
 
-def evaluate(model, dataloader, user_ids, K, use_cuda, device):
+def evaluate(model, dataloader, train_user_csr, test_user_csr, user_ids, K, use_cuda, device):
     n_users = len(user_ids)             # user number in test data
     n_items = dataloader.n_items
     n_entities = dataloader.n_entities
     test_batch_size = dataloader.test_batch_size
-    train_user_dict = dataloader.train_user_dict
-    test_user_dict = dataloader.test_user_dict
 
     model.eval()
 
     item_ids = list(range(n_items))
-    # itertools.product 求多个可迭代对象的笛卡尔积
-    user_item_pairs = itertools.product(user_ids, item_ids)
-    user_idx_map = dict(zip(user_ids, range(n_users)))
+    user_ids_tensor = torch.LongTensor(user_ids)
+    if use_cuda:
+        user_ids_tensor = user_ids_tensor.to(device)
 
     cf_scores = torch.zeros([len(user_ids), len(item_ids)])
     if use_cuda:
         cf_scores = cf_scores.to(device)
 
-    n_test_batch = n_users * n_items // test_batch_size + 1
-
-    # 进度条库tqdm
-    with tqdm(total=n_test_batch, desc='Evaluating Iteration') as pbar:
-        while True:
-            # itertools.islice 对迭代器做切片操作
-            batch_pairs = list(itertools.islice(user_item_pairs, test_batch_size))
-            if len(batch_pairs) == 0:
-                break
+    # 每块大约 test_batch_size 个 (user, item) 对
+    n_block_users = max(1, test_batch_size // n_items)
 
-            batch_user = [p[0] for p in batch_pairs]
-            batch_item = [p[1] for p in batch_pairs]
-            feature_values = dataloader.generate_test_batch(batch_user, batch_item)
-            # print('feature_values.shape', feature_values.shape)  # ([1048576, 184166])
-            if use_cuda:
-                feature_values = feature_values.to(device)
+    # 项目部分在第一次打分时计算并缓存，每次取一块用户和所有项目组合打分
+    with torch.no_grad():
+        for start in tqdm(range(0, n_users, n_block_users), desc='Evaluating Iteration'):
+            end = min(start + n_block_users, n_users)
+            cf_scores[start: end] = model.score_all_items(user_ids_tensor[start: end])      # (n_block_users, n_eval_items)
 
-            with torch.no_grad():
-                batch_scores = model.predict(feature_values)            # (batch_size)
-            cf_scores[[user_idx_map[u] for u in batch_user], batch_item] = batch_scores
-            pbar.update(1)
-
-    # cf_scores 得到一个和所有特征交互的可能 (1000, 24915)
-    # .cpu?  && 这里没理解
-    cf_scores = cf_scores.cpu()
+    # cf_scores 得到一个和所有特征交互的可能 (1000, 24915)，直接在原设备上计算指标
     user_ids = np.array(user_ids)
     item_ids = np.array(item_ids)
-    precision_k, recall_k, ndcg_k = calc_metrics_at_k(cf_scores, train_user_dict, test_user_dict, user_ids, item_ids, K)
+    precision_k, recall_k, ndcg_k = calc_metrics_at_k(cf_scores, train_user_csr, test_user_csr, user_ids, item_ids, K)
 
-    cf_scores = cf_scores.numpy()
+    cf_scores = cf_scores.cpu().numpy()
     precision_k = precision_k.mean()
     recall_k = recall_k.mean()
     ndcg_k = ndcg_k.mean()
@@ -108,12 +91,18 @@ def train(args):
     else:
         sample_user_ids = user_ids
 
+    # 训练集和测试集只转换一次 CSR，评估时一次性屏蔽训练集中的项目
+    train_user_csr = user_dict_to_csr(data.train_user_dict, data.n_items)
+    test_user_csr = user_dict_to_csr(data.test_user_dict, data.n_items)
+
     # construct model & optimizer
     model = NFM(args, data.n_users, data.n_items, data.n_entities, user_pre_embed, item_pre_embed)
     if args.use_pretrain == 2:
         model = load_model(model, args.pretrain_model_path)
 
     model.to(device)
+    # 项目的特征固定不变，交给模型在推理时缓存项目部分的编码
+    model.set_item_features(data.convert_coo2tensor(data.feat_matrix.tocoo()).to(device))
     logging.info(model)
 
     optimizer = optim.Adam(model.parameters(), lr=args.lr)
@@ -136,13 +125,14 @@ def train(args):
         total_loss = 0
         n_batch = data.n_cf_train // data.train_batch_size + 1
 
-        for iter in range(1, n_batch + 1):
+        batches = BatchPrefetcher(lambda rng: data.generate_train_batch(data.train_user_dict, rng), n_batch,
+                                  args.n_workers, args.prefetch_depth, [args.seed, epoch], args.pin_memory == 1)
+        for iter, batch in enumerate(batches, 1):
             time2 = time()
-            pos_feature_values, neg_feature_values = data.generate_train_batch(data.train_user_dict)
             if use_cuda:
-                pos_feature_values = pos_feature_values.to(device)
-                neg_feature_values = neg_feature_values.to(device)
-            batch_loss = model.calc_loss(pos_feature_values, neg_feature_values)
+                batch = tuple(d.to(device, non_blocking=True) for d in batch)
+            pos_feature_bag, neg_feature_bag = batch[:3], batch[3:]
+            batch_loss = model.calc_loss(pos_feature_bag, neg_feature_bag)
 
             batch_loss.backward()
             optimizer.step()
@@ -163,7 +153,7 @@ def train(args):
         if (epoch % args.evaluate_every) == 0:
             time1 = time()
             # precision 预测结果中正确的比例， recall 所有正确结果中预测的比例，  ndcg 累积增益，每个推荐结果相关性的分值累加
-            _, precision, recall, ndcg = evaluate(model, data, sample_user_ids, args.K, use_cuda, device)
+            _, precision, recall, ndcg = evaluate(model, data, train_user_csr, test_user_csr, sample_user_ids, args.K, use_cuda, device)
             logging.info(
                 'CF Evaluation: Epoch {:04d} | Total Time {:.1f}s | Precision {:.4f} Recall {:.4f} NDCG {:.4f}'.format(
                     epoch, time() - time1, precision, recall, ndcg))
@@ -187,7 +177,7 @@ def train(args):
     logging.info('Save model on epoch {:04d}!'.format(epoch))
 
     # save metrics
-    _, precision, recall, ndcg = evaluate(model, data, sample_user_ids, args.K, use_cuda, device)
+    _, precision, recall, ndcg = evaluate(model, data, train_user_csr, test_user_csr, sample_user_ids, args.K, use_cuda, device)
     logging.info('Final CF Evaluation: Precision {:.4f} Recall {:.4f} NDCG {:.4f}'.format(precision, recall, ndcg))
 
     epoch_list.append(epoch)
@@ -222,13 +212,19 @@ def predict(args):
     else:
         sample_user_ids = user_ids
 
+    # 训练集和测试集只转换一次 CSR，评估时一次性屏蔽训练集中的项目
+    train_user_csr = user_dict_to_csr(data.train_user_dict, data.n_items)
+    test_user_csr = user_dict_to_csr(data.test_user_dict, data.n_items)
+
     # load model
     model = NFM(args, data.n_users, data.n_items, data.n_entities)
     model = load_model(model, args.pretrain_model_path)
     model.to(device)
+    # 项目的特征固定不变，交给模型在推理时缓存项目部分的编码
+    model.set_item_features(data.convert_coo2tensor(data.feat_matrix.tocoo()).to(device))
 
     # predict
-    cf_scores, precision, recall, ndcg = evaluate(model, data, sample_user_ids, args.K, use_cuda, device)
+    cf_scores, precision, recall, ndcg = evaluate(model, data, train_user_csr, test_user_csr, sample_user_ids, args.K, use_cuda, device)
     np.save(args.save_dir + 'cf_scores.npy', cf_scores)
     print('CF Evaluation: Precision {:.4f} Recall {:.4f} NDCG {:.4f}'.format(precision, recall, ndcg))
 
@@ -21,8 +21,10 @@ class BPRMF(nn.Module):
         self.embed_dim = args.embed_dim
         self.l2loss_lambda = args.l2loss_lambda
 
-        self.user_embed = nn.Embedding(self.n_users, self.embed_dim)
-        self.item_embed = nn.Embedding(self.n_items, self.embed_dim)
+        # sparse_grad 为 1 时 embedding 只产生 batch 中出现的行的稀疏梯度，用 SparseAdam 更新
+        sparse = args.sparse_grad == 1
+        self.user_embed = nn.Embedding(self.n_users, self.embed_dim, sparse=sparse)
+        self.item_embed = nn.Embedding(self.n_items, self.embed_dim, sparse=sparse)
 
         if (self.use_pretrain == 1) and (user_pre_embed is not None):
             self.user_embed.weight = nn.Parameter(user_pre_embed)
@@ -46,6 +48,14 @@ class BPRMF(nn.Module):
         return cf_score
 
 
+    def export_embed(self):
+        """
+        返回所有用户和项目的最终编码 (n_users, embed_dim), (n_items, embed_dim)，用于构建 MIPS 索引
+        """
+        with torch.no_grad():
+            return self.user_embed.weight.detach().cpu(), self.item_embed.weight.detach().cpu()
+
+
     def calc_loss(self, user_ids, item_pos_ids, item_neg_ids):
         """
         user_ids:       (batch_size)
@@ -2,6 +2,8 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
+from utility.helper import bf16_autocast
+
 
 def _L2_loss_mean(x):
     return torch.mean(torch.sum(torch.pow(x, 2), dim=1, keepdim=False) / 2.)
@@ -27,11 +29,16 @@ class CKE(nn.Module):
         self.cf_l2loss_lambda = args.cf_l2loss_lambda
         self.kg_l2loss_lambda = args.kg_l2loss_lambda
 
-        self.user_embed = nn.Embedding(self.n_users, self.embed_dim)
-        self.item_embed = nn.Embedding(self.n_items, self.embed_dim)
+        # use_bf16 为 1 时 TransR 的 bmm 用 bfloat16 autocast，距离和损失保持 float32
+        self.use_bf16 = args.use_bf16 == 1
+
+        # sparse_grad 为 1 时四张 embedding 表只产生 batch 中出现的行的稀疏梯度，用 SparseAdam 更新
+        sparse = args.sparse_grad == 1
+        self.user_embed = nn.Embedding(self.n_users, self.embed_dim, sparse=sparse)
+        self.item_embed = nn.Embedding(self.n_items, self.embed_dim, sparse=sparse)
 
-        self.entity_embed = nn.Embedding(self.n_entities, self.embed_dim)
-        self.relation_embed = nn.Embedding(self.n_relations, self.relation_dim)
+        self.entity_embed = nn.Embedding(self.n_entities, self.embed_dim, sparse=sparse)
+        self.relation_embed = nn.Embedding(self.n_relations, self.relation_dim, sparse=sparse)
         self.trans_M = nn.Parameter(torch.Tensor(self.n_relations, self.embed_dim, self.relation_dim))
 
         if (self.use_pretrain == 1) and (user_pre_embed is not None):
@@ -64,9 +71,10 @@ class CKE(nn.Module):
         neg_t_embed = self.entity_embed(neg_t)           # (kg_batch_size, embed_dim)
 
         # Equation (2)
-        r_mul_h = torch.bmm(h_embed.unsqueeze(1), W_r).squeeze(1)             # (kg_batch_size, relation_dim)
-        r_mul_pos_t = torch.bmm(pos_t_embed.unsqueeze(1), W_r).squeeze(1)     # (kg_batch_size, relation_dim)
-        r_mul_neg_t = torch.bmm(neg_t_embed.unsqueeze(1), W_r).squeeze(1)     # (kg_batch_size, relation_dim)
+        # h、pos_t、neg_t 共用 W_r，合并为一次 bmm；calc_loss 在 autocast 中调用时 bmm 用 bfloat16，结果转换回 float32
+        hpn_embed = torch.stack([h_embed, pos_t_embed, neg_t_embed], dim=1)     # (kg_batch_size, 3, embed_dim)
+        r_mul_hpn = torch.bmm(hpn_embed, W_r).float()                             # (kg_batch_size, 3, relation_dim)
+        r_mul_h, r_mul_pos_t, r_mul_neg_t = r_mul_hpn.unbind(dim=1)             # (kg_batch_size, relation_dim)
 
         r_embed = F.normalize(r_embed, p=2, dim=1)
         r_mul_h = F.normalize(r_mul_h, p=2, dim=1)
@@ -125,8 +133,9 @@ class CKE(nn.Module):
         pos_t:          (kg_batch_size)
         neg_t:          (kg_batch_size)
         """
-        kg_loss = self.calc_kg_loss(h, r, pos_t, neg_t)
-        cf_loss = self.calc_cf_loss(user_ids, item_pos_ids, item_neg_ids)
+        with bf16_autocast(self.use_bf16, self.trans_M.device):
+            kg_loss = self.calc_kg_loss(h, r, pos_t, neg_t)
+            cf_loss = self.calc_cf_loss(user_ids, item_pos_ids, item_neg_ids)
         loss = kg_loss + cf_loss
         return loss
 
@@ -146,6 +155,16 @@ class CKE(nn.Module):
         return cf_score
 
 
+    def export_embed(self):
+        """
+        返回所有用户和项目的最终编码 (n_users, embed_dim), (n_items, embed_dim)，用于构建 MIPS 索引
+        项目的编码为 item_embed + entity_embed，和 predict 相同
+        """
+        with torch.no_grad():
+            item_cf_embed = self.item_embed.weight + self.entity_embed.weight[:self.n_items]
+            return self.user_embed.weight.detach().cpu(), item_cf_embed.detach().cpu()
+
+
     def forward(self, mode, *input):
         if mode == 'train':
             return self.calc_loss(*input)
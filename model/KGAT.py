@@ -1,9 +1,8 @@
-import dgl
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
-from dgl.nn.pytorch.softmax import edge_softmax
-from utility.helper import edge_softmax_fix
+import torch.distributed as dist
+from utility.helper import edge_softmax_fix, dst_sorted_index, spmm_aggregate, bf16_autocast
 
 
 def _L2_loss_mean(x):
@@ -33,33 +32,37 @@ class Aggregator(nn.Module):
 
         self.activation = nn.LeakyReLU()
 
-    def forward(self, mode, g, entity_embed):
-        g = g.local_var()
-        g.ndata['node'] = entity_embed
+    def forward(self, mode, g, entity_embed, dst_index=None):
+        """
+        g 为整个图时，entity_embed 为所有节点的编码；
+        g 为 DGL block 时，entity_embed 为 block 源节点的编码，目标节点是源节点的前 num_dst_nodes 个，只输出目标节点
+        dst_index 为 dst_sorted_index(g) 的结果（KGAT.relation_index 中缓存），不传入时在这里计算
+        在 KGAT.autocast() 中调用时 Linear 用 bfloat16 计算，输出为 bfloat16，N_h 仍然是 float32
+        """
+        if g.is_block:
+            node_embed = entity_embed[:g.num_dst_nodes()]
+        else:
+            node_embed = entity_embed
 
         # Equation (3) & (10)
         # DGL: dgl-cu10.1(0.5.3)
         # Get different results when using `dgl.function.sum`, and the randomness is due to `atomicAdd`
-        # Use `dgl.function.sum` when training model to speed up
-        # Use custom function to ensure deterministic behavior when predicting
-        if mode == 'predict':
-            g.update_all(dgl.function.u_mul_e('node', 'att', 'side'), lambda nodes: {'N_h': torch.sum(nodes.mailbox['side'], 1)})
-        else:
-            # side = 节点编码向量 @ 知识意识注意， N_h = sum(side)
-            g.update_all(dgl.function.u_mul_e('node', 'att', 'side'), dgl.function.sum('side', 'N_h'))
+        # 原来预测时用自定义的 reduce 函数保证结果确定，但比 `dgl.function.sum` 慢很多
+        # 现在训练和预测都用按目标节点排序的 CSR 邻接矩阵（值为注意力）乘节点编码：N_h = A @ side，结果确定，比 `dgl.function.sum` 更快
+        N_h = spmm_aggregate(g, g.edata['att'], entity_embed, dst_index)                   # (n_dst_nodes, in_dim)
 
         if self.aggregator_type == 'gcn':
             # Equation (6) & (9)
-            out = self.activation(self.W(g.ndata['node'] + g.ndata['N_h']))                         # (n_users + n_entities, out_dim)
+            out = self.activation(self.W(node_embed + N_h))                                 # (n_users + n_entities, out_dim)
 
         elif self.aggregator_type == 'graphsage':
             # Equation (7) & (9)
-            out = self.activation(self.W(torch.cat([g.ndata['node'], g.ndata['N_h']], dim=1)))      # (n_users + n_entities, out_dim)
+            out = self.activation(self.W(torch.cat([node_embed, N_h], dim=1)))              # (n_users + n_entities, out_dim)
 
         elif self.aggregator_type == 'bi-interaction':
             # Equation (8) & (9)
-            out1 = self.activation(self.W1(g.ndata['node'] + g.ndata['N_h']))                       # (n_users + n_entities, out_dim)
-            out2 = self.activation(self.W2(g.ndata['node'] * g.ndata['N_h']))                       # (n_users + n_entities, out_dim)
+            out1 = self.activation(self.W1(node_embed + N_h))                               # (n_users + n_entities, out_dim)
+            out2 = self.activation(self.W2(node_embed * N_h))                               # (n_users + n_entities, out_dim)
             out = out1 + out2
         else:
             raise NotImplementedError
@@ -92,9 +95,13 @@ class KGAT(nn.Module):
         self.kg_l2loss_lambda = args.kg_l2loss_lambda
         self.cf_l2loss_lambda = args.cf_l2loss_lambda
 
+        # use_bf16 为 1 时注意力、传播和 KG 损失中的矩阵乘法用 bfloat16（传播和 KG 损失用 autocast），softmax、聚合和损失保持 float32
+        self.use_bf16 = args.use_bf16 == 1
+
         # Embedding
         self.relation_embed = nn.Embedding(self.n_relations, self.relation_dim)
-        self.entity_user_embed = nn.Embedding(self.n_entities + self.n_users, self.entity_dim)
+        # sparse_grad 为 1 时实体和用户的 embedding 只产生 batch 中出现的行的稀疏梯度，用 SparseAdam 更新
+        self.entity_user_embed = nn.Embedding(self.n_entities + self.n_users, self.entity_dim, sparse=args.sparse_grad == 1)
         if (self.use_pretrain == 1) and (user_pre_embed is not None) and (item_pre_embed is not None):
             other_entity_embed = nn.Parameter(torch.Tensor(self.n_entities - item_pre_embed.shape[0], self.entity_dim))
             nn.init.xavier_uniform_(other_entity_embed, gain=nn.init.calculate_gain('relu'))  # 均匀分布
@@ -105,29 +112,99 @@ class KGAT(nn.Module):
         self.W_R = nn.Parameter(torch.Tensor(self.n_relations, self.entity_dim, self.relation_dim))
         nn.init.xavier_uniform_(self.W_R, gain=nn.init.calculate_gain('relu'))
 
+        # 注意力计算时按关系排好序的边索引，只对 relation_cache_graph 这个图对象有效
+        self.relation_cache = None
+        self.relation_cache_graph = None
+        # freeze 之后保存的传播结果，参数改变时失效
+        self.frozen_embed = None
+
         # 聚合层
         self.aggregator_layers = nn.ModuleList()
         for k in range(self.n_layers):
             self.aggregator_layers.append(Aggregator(self.conv_dim_list[k], self.conv_dim_list[k + 1], self.mess_dropout[k], self.aggregation_type))
 
-    def att_score(self, edges):
+    def relation_index(self, g):
+        """
+        把边按关系稳定排序，只在第一次调用（或图改变）时计算，之后每种关系的边都是连续的一段
+            - edge_order:       排序后的边在原图中的位置
+            - src_ids/dst_ids:  排序后每条边的尾/头节点 id
+            - relation_sizes:   每种关系的边数
+            - dst_index:        edge softmax 用的按目标节点排序的边索引
+        g 为 block 时每个 batch 都不同，不缓存；整个图按对象缓存（is 比较），传入另一个图（即使边数相同）时重新计算，
+        所以调用时要传入原来的图，不能传入 local_var() / to() 得到的新对象
+        """
+        if not g.is_block and self.relation_cache_graph is g:
+            return self.relation_cache
+
+        src, dst = g.edges()
+        if g.is_block:
+            src_id, dst_id = g.srcdata['id'][src], g.dstdata['id'][dst]
+        else:
+            src_id, dst_id = g.ndata['id'][src], g.ndata['id'][dst]
+        edge_type = g.edata['type']
+        edge_order = torch.sort(edge_type, stable=True)[1]
+
+        index = {
+            'edge_order': edge_order,
+            'src_ids': src_id[edge_order],
+            'dst_ids': dst_id[edge_order],
+            'relation_sizes': torch.bincount(edge_type, minlength=self.n_relations).tolist(),
+            'dst_index': dst_sorted_index(g),
+        }
+        if not g.is_block:
+            self.relation_cache = index
+            self.relation_cache_graph = g
+        return index
+
+    def autocast(self):
+        return bf16_autocast(self.use_bf16, self.W_R.device)
+
+    def attention_logits(self, index, start, end):
+        """
+        按关系排序后第 [start, end) 条边 softmax 之前的注意力
+        """
         # Equation (4)
-        r_mul_t = torch.matmul(self.entity_user_embed(edges.src['id']), self.W_r)                       # (n_edge, relation_dim)
-        r_mul_h = torch.matmul(self.entity_user_embed(edges.dst['id']), self.W_r)                       # (n_edge, relation_dim)
-        r_embed = self.relation_embed(edges.data['type'])                                               # (1, relation_dim)
-        att = torch.bmm(r_mul_t.unsqueeze(1), torch.tanh(r_mul_h + r_embed).unsqueeze(2)).squeeze(-1)   # (n_edge, 1)
-        return {'att': att}
-
-    def compute_attention(self, g):
-        g = g.local_var()  # 返回局部变量的图形对象，避免在退出函数时更改图形特征
-        for i in range(self.n_relations):
-            edge_idxs = g.filter_edges(lambda edge: edge.data['type'] == i)  # 返回满足给定边类型的边ID
-            self.W_r = self.W_R[i]  # [entity_dim, relation_dim]
-            g.apply_edges(self.att_score, edge_idxs)  # 添加新的边缘特征，也就是文章中的pi值，Knowledge-aware Attention
+        # 每种关系的边是连续的一段，直接切片做矩阵乘法，不用每种关系都遍历一遍所有边
+        att = torch.empty(end - start, device=self.W_R.device, dtype=self.W_R.dtype)
+        embed, W_R = self.entity_user_embed.weight, self.W_R
+        if self.use_bf16:
+            # 注意力总是在 no_grad 下计算：先把整张表转换为 bfloat16 再按边取行，取行的内存读写减半，矩阵乘法也用 bfloat16；
+            # CPU 上 bfloat16 的 tanh 比 float32 慢，逐元素运算和求和仍然用 float32
+            embed, W_R = embed.to(torch.bfloat16), W_R.to(torch.bfloat16)
+        r_start = 0
+        for r, size in enumerate(index['relation_sizes']):
+            r_end = r_start + size
+            lo, hi = max(r_start, start), min(r_end, end)
+            if lo < hi:
+                W_r = W_R[r]                                                                    # (entity_dim, relation_dim)
+                r_mul_t = torch.matmul(embed[index['src_ids'][lo: hi]], W_r).float()            # (n_r_edge, relation_dim)
+                r_mul_h = torch.matmul(embed[index['dst_ids'][lo: hi]], W_r).float()            # (n_r_edge, relation_dim)
+                r_embed = self.relation_embed.weight[r]                                         # (relation_dim)
+                att[lo - start: hi - start] = torch.sum(r_mul_t * torch.tanh(r_mul_h + r_embed), dim=1)
+            r_start = r_end
+        return att
+
+    def compute_attention(self, g, rank=0, world_size=1):
+        """
+        world_size > 1 时（数据并行，参数在各进程中相同）每个进程只计算按关系排序后的一段边，再用 all_gather 拼接
+        """
+        index = self.relation_index(g)
+        n_edges = len(index['edge_order'])
+        if world_size > 1:
+            chunk = -(-n_edges // world_size)
+            start, end = min(rank * chunk, n_edges), min((rank + 1) * chunk, n_edges)
+            att = F.pad(self.attention_logits(index, start, end), (0, chunk - (end - start)))
+            att_list = [torch.empty_like(att) for _ in range(world_size)]
+            dist.all_gather(att_list, att)
+            att = torch.cat(att_list)[:n_edges]
+        else:
+            att = self.attention_logits(index, 0, n_edges)
+
+        # 恢复原来的边顺序
+        att = torch.empty_like(att).index_copy_(0, index['edge_order'], att).unsqueeze(1)     # (n_edge, 1)
 
         # Equation (5)
-        g.edata['att'] = edge_softmax_fix(g, g.edata.pop('att'))
-        return g.edata.pop('att')
+        return edge_softmax_fix(g, att, index['dst_index'])
 
     def calc_kg_loss(self, h, r, pos_t, neg_t):
         """
@@ -143,9 +220,12 @@ class KGAT(nn.Module):
         pos_t_embed = self.entity_user_embed(pos_t)      # (kg_batch_size, entity_dim)
         neg_t_embed = self.entity_user_embed(neg_t)      # (kg_batch_size, entity_dim)
 
-        r_mul_h = torch.bmm(h_embed.unsqueeze(1), W_r).squeeze(1)             # (kg_batch_size, relation_dim)
-        r_mul_pos_t = torch.bmm(pos_t_embed.unsqueeze(1), W_r).squeeze(1)     # (kg_batch_size, relation_dim)
-        r_mul_neg_t = torch.bmm(neg_t_embed.unsqueeze(1), W_r).squeeze(1)     # (kg_batch_size, relation_dim)
+        # h、pos_t、neg_t 共用 W_r，合并为一次 bmm，W_r 只读取（autocast 时只转换）一次
+        # autocast 时只有 bmm 用 bfloat16，之后的距离和损失用 float32 计算
+        hpn_embed = torch.stack([h_embed, pos_t_embed, neg_t_embed], dim=1)     # (kg_batch_size, 3, entity_dim)
+        with self.autocast():
+            r_mul_hpn = torch.bmm(hpn_embed, W_r).float()                         # (kg_batch_size, 3, relation_dim)
+        r_mul_h, r_mul_pos_t, r_mul_neg_t = r_mul_hpn.unbind(dim=1)             # (kg_batch_size, relation_dim)
 
         # Equation (1)
         pos_score = torch.sum(torch.pow(r_mul_h + r_embed - r_mul_pos_t, 2), dim=1)     # (kg_batch_size)
@@ -160,26 +240,80 @@ class KGAT(nn.Module):
         return loss
 
     def cf_embedding(self, mode, g):
+        # 高阶传播，整个图的 CSR 邻接矩阵结构在 relation_index 中按图对象缓存，要在 local_var() 之前取出
+        dst_index = self.relation_index(g)['dst_index']
         g = g.local_var()
         ego_embed = self.entity_user_embed(g.ndata['id'])
         all_embed = [ego_embed]
 
-        # 高阶传播
-        for i, layer in enumerate(self.aggregator_layers):
-            ego_embed = layer(mode, g, ego_embed)
-            norm_embed = F.normalize(ego_embed, p=2, dim=1)
-            all_embed.append(norm_embed)
+        # autocast 时 Aggregator 中的 Linear 用 bfloat16，输出在归一化前转换回 float32
+        with self.autocast():
+            for i, layer in enumerate(self.aggregator_layers):
+                ego_embed = layer(mode, g, ego_embed, dst_index)
+                norm_embed = F.normalize(ego_embed.float(), p=2, dim=1)
+                all_embed.append(norm_embed)
 
         # Equation (11)  串联运算
         all_embed = torch.cat(all_embed, dim=1)         # (n_users + n_entities, cf_concat_dim)
         return all_embed
 
+    def freeze(self, g):
+        """
+        在整个图上传播一次，把所有层拼接后的编码保存为连续的矩阵，之后 cf_score 直接使用，不再重复传播
+        调用前 g.edata['att'] 需要是最新的注意力
+        """
+        with torch.no_grad():
+            self.frozen_embed = self.cf_embedding('predict', g).contiguous()       # (n_users + n_entities, cf_concat_dim)
+        return self.frozen_embed
+
+    def freeze_blocks(self, block_fn):
+        """
+        out-of-core 模式下没有整个图，逐层、逐块传播：
+        block_fn() 每次返回一个新的 block 迭代器（DataLoaderKGAT.in_blocks），每个 block 包含一段目标节点的全部入边，
+        所以每一块的注意力 softmax 和在整个图上计算的结果相同
+        注意力只和参数有关，在第一层时按块计算一次（总大小和整个图的注意力相同），之后的层按相同的块顺序复用
+        """
+        device = self.W_R.device
+        with torch.no_grad():
+            ego_embed = self.entity_user_embed.weight
+            all_embed = [ego_embed]
+            block_att = []
+            for i, layer in enumerate(self.aggregator_layers):
+                out = torch.empty(ego_embed.shape[0], layer.out_dim, device=device, dtype=ego_embed.dtype)
+                for j, block in enumerate(block_fn()):
+                    block = block.to(device)
+                    if i == 0:
+                        block_att.append(self.compute_attention(block))
+                    block.edata['att'] = block_att[j]
+                    with self.autocast():
+                        out[block.dstdata['id']] = layer('predict', block, ego_embed[block.srcdata['id']])
+                ego_embed = out
+                all_embed.append(F.normalize(ego_embed, p=2, dim=1))
+            self.frozen_embed = torch.cat(all_embed, dim=1).contiguous()         # (n_users + n_entities, cf_concat_dim)
+        return self.frozen_embed
+
+    def unfreeze(self):
+        self.frozen_embed = None
+
+    def train(self, mode=True):
+        # 进入训练模式后参数会被更新，保存的编码失效
+        if mode:
+            self.unfreeze()
+        return super(KGAT, self).train(mode)
+
+    def load_state_dict(self, state_dict, strict=True):
+        self.unfreeze()
+        return super(KGAT, self).load_state_dict(state_dict, strict)
+
     def cf_score(self, mode, g, user_ids, item_ids):
         """
         user_ids:   number of users to evaluate   (n_eval_users)
         item_ids:   number of items to evaluate   (n_eval_items)
         """
-        all_embed = self.cf_embedding(mode, g)          # (n_users + n_entities, cf_concat_dim)
+        if self.frozen_embed is not None:
+            all_embed = self.frozen_embed               # (n_users + n_entities, cf_concat_dim)
+        else:
+            all_embed = self.cf_embedding(mode, g)      # (n_users + n_entities, cf_concat_dim)
         user_embed = all_embed[user_ids]                # (n_eval_users, cf_concat_dim)
         item_embed = all_embed[item_ids]                # (n_eval_items, cf_concat_dim)
 
@@ -187,13 +321,51 @@ class KGAT(nn.Module):
         cf_score = torch.matmul(user_embed, item_embed.transpose(0, 1))    # (n_eval_users, n_eval_items)
         return cf_score
 
+    def export_embed(self, n_items, g=None):
+        """
+        返回所有用户和项目的最终编码 (n_users, cf_concat_dim), (n_items, cf_concat_dim)，用于构建 MIPS 索引
+        第 u 行为原始 id 为 u 的用户（图中的节点为 n_entities + u），项目为实体 0 ~ n_items - 1
+        没有调用过 freeze / freeze_blocks 时在 g 上传播一次
+        """
+        all_embed = self.frozen_embed if self.frozen_embed is not None else self.freeze(g)
+        return all_embed[self.n_entities:].cpu(), all_embed[:n_items].cpu()
+
+    def cf_embedding_blocks(self, mode, blocks):
+        """
+        只在 batch 的感受野上传播，blocks 由 DataLoaderKGAT.sample_blocks 生成
+        最后一个 block 的目标节点（batch 中的节点）是每一层节点的前缀，所以每一层的输出只取前 n_seeds 行
+        """
+        ego_embed = self.entity_user_embed(blocks[0].srcdata['id'])
+        n_seeds = blocks[-1].num_dst_nodes()
+        all_embed = [ego_embed[:n_seeds]]
+
+        with self.autocast():
+            for layer, block in zip(self.aggregator_layers, blocks):
+                ego_embed = layer(mode, block, ego_embed)
+                norm_embed = F.normalize(ego_embed.float(), p=2, dim=1)
+                all_embed.append(norm_embed[:n_seeds])
+
+        # Equation (11)
+        all_embed = torch.cat(all_embed, dim=1)         # (n_seeds, cf_concat_dim)
+        return all_embed
+
     def calc_cf_loss(self, mode, g, user_ids, item_pos_ids, item_neg_ids):
         """
+        g:              整个图，或者 DataLoaderKGAT.sample_blocks 得到的 blocks（list）
         user_ids:       (cf_batch_size)
         item_pos_ids:   (cf_batch_size)
         item_neg_ids:   (cf_batch_size)
         """
-        all_embed = self.cf_embedding(mode, g)                      # (n_users + n_entities, cf_concat_dim)
+        if isinstance(g, list):
+            # 目标节点 id 已排序，把 batch 中的 id 换成在目标节点中的位置
+            all_embed = self.cf_embedding_blocks(mode, g)                   # (n_seeds, cf_concat_dim)
+            seeds = g[-1].dstdata['id']
+            user_ids = torch.searchsorted(seeds, user_ids)
+            item_pos_ids = torch.searchsorted(seeds, item_pos_ids)
+            item_neg_ids = torch.searchsorted(seeds, item_neg_ids)
+        else:
+            all_embed = self.cf_embedding(mode, g)                          # (n_users + n_entities, cf_concat_dim)
+
         user_embed = all_embed[user_ids]                            # (cf_batch_size, cf_concat_dim)
         item_pos_embed = all_embed[item_pos_ids]                    # (cf_batch_size, cf_concat_dim)
         item_neg_embed = all_embed[item_neg_ids]                    # (cf_batch_size, cf_concat_dim)
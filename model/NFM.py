@@ -70,6 +70,11 @@ class NFM(nn.Module):
                 self.hidden_layers.append(HiddenLayer(self.hidden_dim_list[idx], self.hidden_dim_list[idx + 1], self.mess_dropout[idx + 1]))
             self.h = nn.Linear(self.hidden_dim_list[-1], 1, bias=False)
 
+        # 所有项目的特征（feat_matrix），由 set_item_features 设置
+        self.item_feature_values = None
+        # 推理时缓存的项目部分 (S_i, B_i, lin_i)，参数改变时失效
+        self.item_cache = None
+
 
     def predict(self, feature_values):
         """
@@ -97,13 +102,122 @@ class NFM(nn.Module):
         return y.squeeze()                                  # (batch_size)
 
 
-    def calc_loss(self, pos_feature_value, neg_feature_value):
+    def predict_bag(self, indices, offsets, weights):
+        """
+        indices:    (n_total_features), 所有样本的特征下标拼接在一起
+        offsets:    (batch_size), 每个样本的特征在 indices 中的起始位置
+        weights:    (n_total_features), 每个特征的取值
+        和 predict 的计算相同，用 F.embedding_bag 代替稀疏矩阵乘法
+        """
+        # Bi-Interaction layer
+        # Equation (4) / (3)
+        sum_square_embed = F.embedding_bag(indices, self.feature_embed, offsets, mode='sum', per_sample_weights=weights).pow(2)                 # (batch_size, embed_dim)
+        square_sum_embed = F.embedding_bag(indices, self.feature_embed.pow(2), offsets, mode='sum', per_sample_weights=weights.pow(2))          # (batch_size, embed_dim)
+        bi = 0.5 * (sum_square_embed - square_sum_embed)                                                                                        # (batch_size, embed_dim)
+
+        # Hidden layers
+        z = self.dropout(bi)                                # (batch_size, embed_dim)
+
+        if self.model_type == 'nfm':
+            # Equation (5)
+            for i, layer in enumerate(self.hidden_layers):
+                z = layer(z)                                # (batch_size, hidden_dim)
+
+        # Prediction layer
+        # Equation (6)
+        y = self.h(z)                                       # (batch_size, 1)
+        # Equation (2) / (7) / (8)
+        linear = F.embedding_bag(indices, self.linear.weight.t(), offsets, mode='sum', per_sample_weights=weights) + self.linear.bias     # (batch_size, 1)
+        y = linear + y                                      # (batch_size, 1)
+        return y.squeeze()                                  # (batch_size)
+
+
+    def item_bi_interaction(self, item_feature_values):
+        """
+        item_feature_values:   (n_eval_items, n_entities), 即 feat_matrix 的行, torch.sparse.FloatTensor
+        返回每个项目特征的编码和 S_i、项目特征之间的 Bi-Interaction B_i 以及项目特征的一阶项 lin_i
+        """
+        entity_embed = self.feature_embed[:self.n_entities]                                                 # (n_entities, embed_dim)
+        item_sum_embed = torch.sparse.mm(item_feature_values, entity_embed)                                 # (n_eval_items, embed_dim)
+        item_square_embed = torch.sparse.mm(item_feature_values.pow(2), entity_embed.pow(2))                # (n_eval_items, embed_dim)
+        item_bi = 0.5 * (item_sum_embed.pow(2) - item_square_embed)                                         # (n_eval_items, embed_dim)
+        item_linear = torch.sparse.mm(item_feature_values, self.linear.weight[:, :self.n_entities].t())     # (n_eval_items, 1)
+        return item_sum_embed, item_bi, item_linear.squeeze(1)
+
+
+    def predict_block(self, user_ids, item_sum_embed, item_bi, item_linear):
+        """
+        user_ids:   (n_eval_users), 已经加上 n_entities 的用户 id, 即用户在 feature_embed 中的下标
+        其余参数为 item_bi_interaction 的结果
+        返回 (n_eval_users, n_eval_items) 的分数，和对每个 (user, item) 调用 predict 的结果一致
+
+        用户特征是 one-hot，Bi-Interaction 可以分解为 bi = B_i + S_i * e_u，一阶项为 lin_i + w_u + b，
+        项目部分只需要计算一次，再和用户广播组合
+        """
+        user_embed = self.feature_embed[user_ids]                                       # (n_eval_users, embed_dim)
+        user_linear = self.linear.weight[0, user_ids] + self.linear.bias                # (n_eval_users)
+
+        if self.model_type == 'fm' and not self.training:
+            # h 为线性且没有 dropout 时，sum(h * (B_i + S_i * e_u)) = h(B_i) + (h * e_u) · S_i，直接用矩阵乘法
+            y = self.h(item_bi).t() + torch.matmul(user_embed * self.h.weight, item_sum_embed.t())        # (n_eval_users, n_eval_items)
+        else:
+            bi = item_bi.unsqueeze(0) + item_sum_embed.unsqueeze(0) * user_embed.unsqueeze(1)             # (n_eval_users, n_eval_items, embed_dim)
+            z = self.dropout(bi)
+            if self.model_type == 'nfm':
+                for i, layer in enumerate(self.hidden_layers):
+                    z = layer(z)                                                        # (n_eval_users, n_eval_items, hidden_dim)
+            y = self.h(z).squeeze(2)                                                    # (n_eval_users, n_eval_items)
+        return y + item_linear.unsqueeze(0) + user_linear.unsqueeze(1)
+
+
+    def set_item_features(self, item_feature_values):
+        """
+        item_feature_values:   (n_items, n_entities), feat_matrix 转换成的 torch.sparse.FloatTensor, 需要和模型在同一设备上
+        """
+        self.item_feature_values = item_feature_values
+        self.item_cache = None
+
+
+    def cache_items(self):
+        """
+        计算并缓存所有项目的 S_i、B_i 和 lin_i，之后给用户打分只需要稠密的向量运算
+        """
+        with torch.no_grad():
+            self.item_cache = self.item_bi_interaction(self.item_feature_values)
+        return self.item_cache
+
+
+    def train(self, mode=True):
+        # 进入训练模式后参数会被更新，缓存的项目编码失效
+        if mode:
+            self.item_cache = None
+        return super(NFM, self).train(mode)
+
+
+    def load_state_dict(self, state_dict, strict=True):
+        self.item_cache = None
+        return super(NFM, self).load_state_dict(state_dict, strict)
+
+
+    def score_all_items(self, user_ids):
+        """
+        user_ids:   (n_eval_users), 已经加上 n_entities 的用户 id
+        返回 (n_eval_users, n_items) 的分数；推理时使用缓存的项目编码，训练模式下每次重新计算
+        """
+        if self.training:
+            return self.predict_block(user_ids, *self.item_bi_interaction(self.item_feature_values))
+        if self.item_cache is None:
+            self.cache_items()
+        return self.predict_block(user_ids, *self.item_cache)
+
+
+    def calc_loss(self, pos_feature_bag, neg_feature_bag):
         """
-        pos_feature_value:  (batch_size, n_features), torch.sparse.FloatTensor
-        neg_feature_value:  (batch_size, n_features), torch.sparse.FloatTensor
+        pos_feature_bag:    (indices, offsets, weights), DataLoaderNFM.generate_feature_bag 的结果
+        neg_feature_bag:    (indices, offsets, weights)
         """
-        pos_score = self.predict(pos_feature_value)         # (batch_size)
-        neg_score = self.predict(neg_feature_value)         # (batch_size)
+        pos_score = self.predict_bag(*pos_feature_bag)      # (batch_size)
+        neg_score = self.predict_bag(*neg_feature_bag)      # (batch_size)
 
         loss = (-1.0) * F.logsigmoid(pos_score - neg_score)
         loss = torch.mean(loss)
@@ -0,0 +1,5 @@
+import os
+import sys
+
+# 仓库没有安装成包，测试中直接 import model / utility
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,44 @@
+import argparse
+
+import torch
+
+from model.KGAT import KGAT
+from utility.sparse_graph import SparseGraph
+
+
+def small_kgat():
+    args = argparse.Namespace(use_pretrain=0, entity_dim=8, relation_dim=8, aggregation_type='bi-interaction',
+                              conv_dim_list='[8]', mess_dropout='[0.0]', kg_l2loss_lambda=0, cf_l2loss_lambda=0,
+                              sparse_grad=0, use_bf16=0)
+    return KGAT(args, 5, 20, 3)
+
+
+def random_ckg(seed, n_nodes=25, n_edges=60):
+    gen = torch.Generator().manual_seed(seed)
+    g = SparseGraph(torch.randint(0, n_nodes, (n_edges,), generator=gen), torch.randint(0, n_nodes, (n_edges,), generator=gen), n_nodes)
+    g.ndata['id'] = torch.arange(n_nodes)
+    g.edata['type'] = torch.randint(0, 3, (n_edges,), generator=gen)
+    return g
+
+
+def test_relation_index_cached_per_graph_object():
+    model = small_kgat()
+    g1, g2 = random_ckg(0), random_ckg(1)
+
+    index1 = model.relation_index(g1)
+    assert model.relation_index(g1) is index1
+    # 边数和设备相同的另一个图不能复用缓存
+    index2 = model.relation_index(g2)
+    assert index2 is not index1
+    assert torch.equal(index2['src_ids'], g2.edges()[0][index2['edge_order']])
+
+
+def test_cf_embedding_uses_cached_index():
+    model = small_kgat().eval()
+    g = random_ckg(2)
+    g.edata['att'] = torch.rand(g.num_edges(), 1)
+
+    model.cf_embedding('predict', g)
+    index = model.relation_cache
+    model.cf_embedding('predict', g)
+    assert model.relation_cache is index
@@ -0,0 +1,173 @@
+import pytest
+import torch
+
+from model.KGAT import Aggregator
+from utility.helper import dst_sorted_index, SegmentSoftmax, edge_softmax_fix, SegmentSpMM, spmm_aggregate
+from utility.sparse_graph import SparseGraph
+
+
+def random_graph(n_src=200, n_dst=None, n_edges=3000, seed=0, is_block=False):
+    """
+    随机图，目标节点的入度不均匀，部分目标节点没有入边
+    """
+    gen = torch.Generator().manual_seed(seed)
+    n_dst = n_src if n_dst is None else n_dst
+    src = torch.randint(0, n_src, (n_edges,), generator=gen)
+    # 只有偶数编号的目标节点有入边，编号越小入度越大
+    dst = (torch.rand(n_edges, generator=gen) ** 2 * ((n_dst + 1) // 2)).long() * 2
+    return SparseGraph(src, dst, n_src, n_dst, is_block)
+
+
+def with_threads(n, fn):
+    n_threads = torch.get_num_threads()
+    torch.set_num_threads(n)
+    try:
+        return fn()
+    finally:
+        torch.set_num_threads(n_threads)
+
+
+def spmm_forward_backward(graph, att, feat):
+    att = att.clone().requires_grad_(True)
+    feat = feat.clone().requires_grad_(True)
+    out = spmm_aggregate(graph, att, feat)
+    grad_out = torch.arange(out.numel(), dtype=out.dtype).reshape(out.shape).sin()
+    out.backward(grad_out)
+    return out.detach(), att.grad, feat.grad
+
+
+def spmm_reference(graph, att, feat):
+    src, dst = graph.edges()
+    return torch.zeros(graph.num_dst_nodes(), feat.shape[1], dtype=feat.dtype).index_add_(0, dst, att * feat[src])
+
+
+@pytest.mark.parametrize('is_block', [False, True])
+def test_spmm_bitwise_reproducible(is_block):
+    graph = random_graph(n_dst=120 if is_block else None, is_block=is_block)
+    gen = torch.Generator().manual_seed(1)
+    att = torch.rand(graph.num_edges(), 1, generator=gen)
+    feat = torch.randn(graph.num_src_nodes(), 16, generator=gen)
+
+    first = spmm_forward_backward(graph, att, feat)
+    runs = [spmm_forward_backward(graph, att, feat)] + [with_threads(n, lambda: spmm_forward_backward(graph, att, feat)) for n in [1, 2, 4]]
+    for run in runs:
+        for a, b in zip(first, run):
+            assert torch.equal(a, b)
+
+
+@pytest.mark.parametrize('is_block', [False, True])
+def test_spmm_matches_index_add(is_block):
+    graph = random_graph(n_dst=120 if is_block else None, is_block=is_block)
+    gen = torch.Generator().manual_seed(2)
+    att = torch.rand(graph.num_edges(), 1, generator=gen)
+    feat = torch.randn(graph.num_src_nodes(), 16, generator=gen)
+
+    out, att_grad, feat_grad = spmm_forward_backward(graph, att, feat)
+
+    att_ref = att.clone().requires_grad_(True)
+    feat_ref = feat.clone().requires_grad_(True)
+    out_ref = spmm_reference(graph, att_ref, feat_ref)
+    out_ref.backward(torch.arange(out_ref.numel(), dtype=out_ref.dtype).reshape(out_ref.shape).sin())
+
+    assert torch.allclose(out, out_ref, atol=1e-5)
+    assert torch.allclose(att_grad, att_ref.grad, atol=1e-4)
+    assert torch.allclose(feat_grad, feat_ref.grad, atol=1e-5)
+
+
+def test_spmm_chunked_att_grad(monkeypatch):
+    graph = random_graph()
+    gen = torch.Generator().manual_seed(4)
+    att = torch.rand(graph.num_edges(), 1, generator=gen)
+    feat = torch.randn(graph.num_src_nodes(), 16, generator=gen)
+
+    full = spmm_forward_backward(graph, att, feat)
+    monkeypatch.setattr(SegmentSpMM, 'chunk_size', 100)
+    chunked = spmm_forward_backward(graph, att, feat)
+    for a, b in zip(full, chunked):
+        assert torch.equal(a, b)
+
+
+def test_spmm_gradcheck():
+    graph = random_graph(n_src=30, n_edges=200, seed=3)
+    index = dst_sorted_index(graph)
+    gen = torch.Generator().manual_seed(3)
+    att = torch.rand(graph.num_edges(), 1, generator=gen, dtype=torch.float64).requires_grad_(True)
+    feat = torch.randn(graph.num_src_nodes(), 4, generator=gen, dtype=torch.float64).requires_grad_(True)
+    assert torch.autograd.gradcheck(lambda a, f: SegmentSpMM.apply(a, f, index), (att, feat))
+
+
+@pytest.mark.parametrize('aggregator_type', ['gcn', 'graphsage', 'bi-interaction'])
+def test_aggregator_bitwise_reproducible(aggregator_type):
+    graph = random_graph()
+    gen = torch.Generator().manual_seed(5)
+    graph.edata['att'] = torch.rand(graph.num_edges(), 1, generator=gen)
+    embed = torch.randn(graph.num_src_nodes(), 16, generator=gen)
+    torch.manual_seed(5)
+    layer = Aggregator(16, 8, 0.1, aggregator_type).eval()
+    index = dst_sorted_index(graph)
+
+    def run():
+        layer.zero_grad()
+        x = embed.clone().requires_grad_(True)
+        out = layer('predict', graph, x, index)
+        out.sum().backward()
+        return [out.detach(), x.grad] + [p.grad.clone() for p in layer.parameters()]
+
+    first = run()
+    runs = [run()] + [with_threads(n, run) for n in [1, 2, 4]]
+    for other in runs:
+        for a, b in zip(first, other):
+            assert torch.equal(a, b)
+
+
+def softmax_forward_backward(graph, score):
+    score = score.clone().requires_grad_(True)
+    out = edge_softmax_fix(graph, score)
+    grad_out = torch.arange(out.numel(), dtype=out.dtype).reshape(out.shape).cos()
+    out.backward(grad_out)
+    return out.detach(), score.grad
+
+
+def test_softmax_bitwise_reproducible():
+    graph = random_graph()
+    score = torch.randn(graph.num_edges(), 1, generator=torch.Generator().manual_seed(6)) * 5
+
+    first = softmax_forward_backward(graph, score)
+    runs = [softmax_forward_backward(graph, score)] + [with_threads(n, lambda: softmax_forward_backward(graph, score)) for n in [1, 2, 4]]
+    for run in runs:
+        for a, b in zip(first, run):
+            assert torch.equal(a, b)
+
+
+def test_softmax_matches_per_destination_softmax():
+    graph = random_graph()
+    score = torch.randn(graph.num_edges(), 1, generator=torch.Generator().manual_seed(7)) * 5
+    out = edge_softmax_fix(graph, score)
+
+    _, dst = graph.edges()
+    for v in torch.unique(dst).tolist():
+        mask = dst == v
+        assert torch.allclose(out[mask], torch.softmax(score[mask], dim=0), atol=1e-6)
+    # 每个目标节点的入边注意力之和为 1
+    sums = torch.zeros(graph.num_dst_nodes()).index_add_(0, dst, out.squeeze(1))
+    assert torch.allclose(sums[torch.unique(dst)], torch.ones(len(torch.unique(dst))), atol=1e-5)
+
+
+def test_softmax_large_logits_finite():
+    graph = random_graph()
+    score = torch.randn(graph.num_edges(), 1, generator=torch.Generator().manual_seed(8)) * 1e4 + 1e30
+    out, grad = softmax_forward_backward(graph, score)
+    assert torch.isfinite(out).all()
+    assert torch.isfinite(grad).all()
+
+    # 同一目标节点上的分数相差 1000 时（exp(1000) 在 float32 中溢出），分数最大的边的注意力为 1
+    small = torch.tensor([[1000.], [0.], [-1000.]])
+    g = SparseGraph(torch.tensor([0, 1, 2]), torch.tensor([0, 0, 0]), 3)
+    assert torch.allclose(edge_softmax_fix(g, small).squeeze(1), torch.tensor([1., 0., 0.]))
+
+
+def test_softmax_gradcheck():
+    graph = random_graph(n_src=30, n_edges=200, seed=9)
+    index = dst_sorted_index(graph)
+    score = torch.randn(graph.num_edges(), 1, generator=torch.Generator().manual_seed(9), dtype=torch.float64).requires_grad_(True)
+    assert torch.autograd.gradcheck(lambda x: SegmentSoftmax.apply(x, index['order'], index['seg_ids'], index['lengths']), (score,))
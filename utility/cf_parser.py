@@ -0,0 +1,169 @@
+import os
+import multiprocessing
+
+import numpy as np
+
+
+"""
+    train.txt / test.txt 的快速解析
+    每一行为 user_id item_id item_id ...，只有用户没有项目的行会被跳过，同一行中重复的项目只保留一次
+
+    整个文件按块读入，每一块直接在字节数组上用 numpy 切分数字，不再逐行 split 和 int()；
+    n_jobs > 1 时把文件按行对齐切成若干字节范围，用多进程分别解析后拼接
+
+    load_cf_file 返回：
+        - user:     (n_interactions) int32
+        - item:     (n_interactions) int32，每一行的项目有序去重后依次拼接
+        - users:    (n_lines) int32，每一行的用户
+        - indptr:   (n_lines + 1) int64，第 i 行的项目为 item[indptr[i]: indptr[i + 1]]
+"""
+
+CHUNK_SIZE = 1 << 26
+
+_NEWLINE = ord('\n')
+_ZERO = ord('0')
+
+
+def _empty_result():
+    empty = np.zeros(0, dtype=np.int32)
+    return empty, empty, empty, np.zeros(1, dtype=np.int64)
+
+
+def parse_buffer(buf):
+    """
+    buf:    只包含完整行的 bytes
+    返回 user, item, users, indptr
+    """
+    data = np.frombuffer(buf, dtype=np.uint8)
+    digit = data - np.uint8(_ZERO)
+    is_digit = digit < 10
+    if not is_digit.any():
+        return _empty_result()
+
+    # 每个数字的起止位置
+    flag = np.zeros(len(data) + 2, dtype=np.int8)
+    flag[1: -1] = is_digit
+    change = np.diff(flag)
+    starts = np.flatnonzero(change == 1)
+    ends = np.flatnonzero(change == -1)
+    lengths = ends - starts
+
+    # 每个数字的值：从高位开始逐位累加，循环次数为最长数字的位数
+    values = np.zeros(len(starts), dtype=np.int64)
+    for k in range(int(lengths.max())):
+        idx = np.flatnonzero(lengths > k)
+        values[idx] = values[idx] * 10 + digit[starts[idx] + k]
+
+    # 每个数字所在的行（前面有几个换行符），行内第一个数字是用户
+    line = np.searchsorted(np.flatnonzero(data == _NEWLINE), starts)
+    first = np.ones(len(line), dtype=bool)
+    first[1:] = line[1:] != line[:-1]
+    line_start = np.flatnonzero(first)
+    line_length = np.diff(np.append(line_start, len(line)))
+
+    # 跳过只有用户的行
+    keep = line_length > 1
+    users = values[line_start[keep]]
+    if len(users) == 0:
+        return _empty_result()
+    kept_line = np.cumsum(keep) - 1
+    is_item = np.repeat(keep, line_length) & ~first
+    row = np.repeat(kept_line, line_length)[is_item]
+    items = values[is_item]
+
+    # 行内项目去重排序：(行号, 项目) 打包成一个 int64 键，排序后去掉相邻的重复键
+    n_keys = int(items.max()) + 1
+    keys = np.sort(row * n_keys + items)
+    keys = keys[np.append(True, keys[1:] != keys[:-1])]
+    row = keys // n_keys
+    item = (keys - row * n_keys).astype(np.int32)
+
+    indptr = np.zeros(len(users) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(row, minlength=len(users)), out=indptr[1:])
+    user = users[row].astype(np.int32)
+    return user, item, users.astype(np.int32), indptr
+
+
+def concat_results(results):
+    results = [r for r in results if len(r[2]) > 0]
+    if len(results) == 0:
+        return _empty_result()
+    user = np.concatenate([r[0] for r in results])
+    item = np.concatenate([r[1] for r in results])
+    users = np.concatenate([r[2] for r in results])
+
+    indptr = [np.zeros(1, dtype=np.int64)]
+    offset = 0
+    for r in results:
+        indptr.append(r[3][1:] + offset)
+        offset += r[3][-1]
+    return user, item, users, np.concatenate(indptr)
+
+
+def parse_range(filename, start, end, chunk_size=CHUNK_SIZE):
+    """
+    解析文件中 [start, end) 的字节，start 和 end 需要在行首
+    每次读入 chunk_size 字节，在最后一个换行符处截断，剩下的部分留给下一块
+    """
+    results = []
+    with open(filename, 'rb') as f:
+        f.seek(start)
+        remain = end - start
+        tail = b''
+        while remain > 0:
+            buf = f.read(min(chunk_size, remain))
+            if not buf:
+                break
+            remain -= len(buf)
+            buf = tail + buf
+            if remain > 0:
+                cut = buf.rfind(b'\n') + 1
+                buf, tail = buf[:cut], buf[cut:]
+            else:
+                tail = b''
+            results.append(parse_buffer(buf))
+        if tail:
+            results.append(parse_buffer(tail))
+    return concat_results(results)
+
+
+def _parse_range(task):
+    return parse_range(*task)
+
+
+def split_ranges(filename, n_jobs):
+    """
+    把文件切成 n_jobs 个大小接近、按行对齐的字节范围
+    """
+    size = os.path.getsize(filename)
+    bounds = [0]
+    with open(filename, 'rb') as f:
+        for i in range(1, n_jobs):
+            f.seek(max(size * i // n_jobs, bounds[-1]))
+            if f.tell() > 0:
+                f.seek(f.tell() - 1)
+                f.readline()
+            bounds.append(min(f.tell(), size))
+    bounds.append(size)
+    return [(bounds[i], bounds[i + 1]) for i in range(n_jobs) if bounds[i] < bounds[i + 1]]
+
+
+def load_cf_file(filename, n_jobs=1, chunk_size=CHUNK_SIZE):
+    """
+    filename:   train.txt / test.txt
+    n_jobs:     解析的进程数，小于等于 1 时在当前进程中解析
+    """
+    if n_jobs <= 1:
+        return parse_range(filename, 0, os.path.getsize(filename), chunk_size)
+
+    tasks = [(filename, start, end, chunk_size) for start, end in split_ranges(filename, n_jobs)]
+    with multiprocessing.Pool(len(tasks)) as pool:
+        results = pool.map(_parse_range, tasks)
+    return concat_results(results)
+
+
+def to_user_dict(users, indptr, item):
+    """
+    每个用户对应的项目数组，同一个用户出现在多行时保留最后一行，和原来逐行赋值的行为一致
+    """
+    return {int(u): item[indptr[i]: indptr[i + 1]] for i, u in enumerate(users)}
@@ -0,0 +1,149 @@
+import os
+import json
+import hashlib
+
+import numpy as np
+import pandas as pd
+
+from utility.kg_index import KGIndex
+from utility.sampler import CFSampler, KGSampler
+
+
+"""
+    DataLoaderKGAT 的二进制缓存
+    第一次运行时把解析好的 cf 数据、CKG 三元组（按头实体排序的 CSR 形式）和边类型保存为 .npy 文件，
+    之后再次启动同一个数据集时直接用 mmap 读取，省去解析 txt 和构建三元组的时间
+
+    缓存目录中的文件：
+        - meta.json              版本号、源文件哈希以及各种数量统计
+        - cf_*.npy               cf 训练/测试数据（用户 id 已经加上 n_entities）
+        - *_user_keys.npy ...    train_user_dict / test_user_dict 的 CSR 形式
+        - kg_indptr.npy          CSR 行偏移，长度为 n_users_entities + 1
+        - kg_tail.npy            尾实体
+        - kg_relation.npy        边类型
+        - *_sampler_key.npy      CFSampler / KGSampler 排好序的查询键，读取后不需要再排序
+
+    out-of-core 模式下所有数组都保持 mmap，不再构建 kg_train_data 的 DataFrame
+"""
+
+# 缓存格式改变时需要加一，旧缓存会自动失效
+CACHE_VERSION = 2
+
+META_FILE = 'meta.json'
+META_KEYS = ['n_users', 'n_items', 'n_entities', 'n_relations', 'n_users_entities',
+             'n_cf_train', 'n_cf_test', 'n_kg_train']
+
+
+def source_hash(filenames):
+    md5 = hashlib.md5()
+    md5.update(str(CACHE_VERSION).encode())
+    for filename in filenames:
+        md5.update(os.path.basename(filename).encode())
+        with open(filename, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 24), b''):
+                md5.update(chunk)
+    return md5.hexdigest()
+
+
+def dict_to_csr(user_dict):
+    keys = np.array(sorted(user_dict.keys()), dtype=np.int32)
+    lengths = np.array([len(user_dict[k]) for k in keys], dtype=np.int64)
+    indptr = np.zeros(len(keys) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=indptr[1:])
+    if len(keys) > 0:
+        values = np.concatenate([np.asarray(user_dict[k], dtype=np.int32) for k in keys])
+    else:
+        values = np.zeros(0, dtype=np.int32)
+    return keys, indptr, values
+
+
+def csr_to_dict(keys, indptr, values):
+    values = np.asarray(values)
+    return {int(k): values[indptr[i]: indptr[i + 1]] for i, k in enumerate(keys)}
+
+
+def _save_array(cache_dir, name, array):
+    np.save(os.path.join(cache_dir, name + '.npy'), np.ascontiguousarray(array))
+
+
+def _load_array(cache_dir, name):
+    return np.load(os.path.join(cache_dir, name + '.npy'), mmap_mode='r')
+
+
+def save(data, cache_dir, source_files):
+    """
+    data:           DataLoaderKGAT，construct_data 并构建采样器之后调用
+    cache_dir:      缓存目录
+    source_files:   用于计算哈希的源文件 train.txt / test.txt / kg_final.txt
+    """
+    if not os.path.exists(cache_dir):
+        os.makedirs(cache_dir)
+
+    # 先删除旧的 meta，写入中断时缓存不会被误读
+    meta_path = os.path.join(cache_dir, META_FILE)
+    if os.path.exists(meta_path):
+        os.remove(meta_path)
+
+    _save_array(cache_dir, 'cf_train_user', data.cf_train_data[0])
+    _save_array(cache_dir, 'cf_train_item', data.cf_train_data[1])
+    _save_array(cache_dir, 'cf_test_user', data.cf_test_data[0])
+    _save_array(cache_dir, 'cf_test_item', data.cf_test_data[1])
+
+    for name, user_dict in [('train', data.train_user_dict), ('test', data.test_user_dict)]:
+        keys, indptr, values = dict_to_csr(user_dict)
+        _save_array(cache_dir, name + '_user_keys', keys)
+        _save_array(cache_dir, name + '_user_indptr', indptr)
+        _save_array(cache_dir, name + '_user_items', values)
+
+    # CKG 按头实体排序后的 CSR，头实体由 indptr 还原
+    _save_array(cache_dir, 'kg_indptr', data.train_kg_dict.offsets)
+    _save_array(cache_dir, 'kg_tail', data.train_kg_dict.tails)
+    _save_array(cache_dir, 'kg_relation', data.train_kg_dict.relations)
+
+    # 采样器的查询键
+    _save_array(cache_dir, 'cf_sampler_key', data.cf_sampler.keys)
+    _save_array(cache_dir, 'kg_sampler_key', data.kg_sampler.keys)
+
+    meta = {'version': CACHE_VERSION, 'hash': source_hash(source_files)}
+    for key in META_KEYS:
+        meta[key] = int(getattr(data, key))
+    with open(meta_path, 'w') as f:
+        json.dump(meta, f, indent=4)
+
+
+def load(data, cache_dir, source_files, out_of_core=False):
+    """
+    读取成功返回 True，缓存不存在、版本不一致或源文件被修改时返回 False
+    同时由缓存中的数组构建 data.cf_sampler / data.kg_sampler
+    out_of_core:    为 True 时 data.kg_train_data 为 None，三元组只通过 mmap 的 data.train_kg_dict 访问
+    """
+    meta_path = os.path.join(cache_dir, META_FILE)
+    if not os.path.exists(meta_path):
+        return False
+
+    with open(meta_path, 'r') as f:
+        meta = json.load(f)
+    if meta.get('version') != CACHE_VERSION or meta.get('hash') != source_hash(source_files):
+        return False
+
+    for key in META_KEYS:
+        setattr(data, key, meta[key])
+
+    data.cf_train_data = (_load_array(cache_dir, 'cf_train_user'), _load_array(cache_dir, 'cf_train_item'))
+    data.cf_test_data = (_load_array(cache_dir, 'cf_test_user'), _load_array(cache_dir, 'cf_test_item'))
+
+    data.train_user_dict = csr_to_dict(*[_load_array(cache_dir, 'train_user_' + s) for s in ['keys', 'indptr', 'items']])
+    data.test_user_dict = csr_to_dict(*[_load_array(cache_dir, 'test_user_' + s) for s in ['keys', 'indptr', 'items']])
+
+    kg_index = KGIndex(_load_array(cache_dir, 'kg_indptr'), _load_array(cache_dir, 'kg_tail'), _load_array(cache_dir, 'kg_relation'))
+    if out_of_core:
+        data.kg_train_data = None
+    else:
+        heads = np.repeat(np.arange(data.n_users_entities, dtype=np.int32), kg_index.degrees)
+        data.kg_train_data = pd.DataFrame({'h': heads, 'r': np.asarray(kg_index.relations), 't': np.asarray(kg_index.tails)})
+    data.train_kg_dict = kg_index
+
+    train_csr = [_load_array(cache_dir, 'train_user_' + s) for s in ['keys', 'indptr', 'items']]
+    data.cf_sampler = CFSampler.from_csr(*train_csr, data.n_items, keys=_load_array(cache_dir, 'cf_sampler_key'), user_dict=data.train_user_dict)
+    data.kg_sampler = KGSampler(kg_index, data.n_users_entities, keys=_load_array(cache_dir, 'kg_sampler_key'))
+    return True
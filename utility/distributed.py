@@ -0,0 +1,63 @@
+import os
+
+import torch
+import torch.distributed as dist
+
+
+"""
+    单机多进程数据并行
+    用 torchrun 启动时会设置 RANK / WORLD_SIZE / LOCAL_RANK / MASTER_ADDR / MASTER_PORT 环境变量：
+        torchrun --standalone --nproc_per_node=4 main_kgat.py --distributed 1
+    只有 --distributed 1 并且 WORLD_SIZE 大于 1 时才初始化进程组，直接用 python 运行时仍然是单进程
+    CPU 上使用 gloo，CUDA 上使用 nccl（每个进程使用 LOCAL_RANK 对应的 GPU）
+"""
+
+
+def init_distributed(args):
+    """
+    返回 (rank, world_size)，不使用分布式时为 (0, 1)
+    """
+    world_size = int(os.environ.get('WORLD_SIZE', 1))
+    if args.distributed != 1 or world_size <= 1:
+        return 0, 1
+
+    if torch.cuda.is_available():
+        torch.cuda.set_device(int(os.environ.get('LOCAL_RANK', args.local_rank)))
+        backend = 'nccl'
+    else:
+        backend = 'gloo'
+    dist.init_process_group(backend=backend)
+    return dist.get_rank(), dist.get_world_size()
+
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized()
+
+
+def barrier():
+    if is_distributed():
+        dist.barrier()
+
+
+def cleanup():
+    if is_distributed():
+        dist.destroy_process_group()
+
+
+def shard(items, rank, world_size):
+    """
+    第 rank 个进程负责第 rank, rank + world_size, ... 个元素
+    """
+    return items[rank::world_size]
+
+
+def all_reduce_sum(values):
+    """
+    values: 一组数（评估指标的和、用户数等），返回所有进程相加后的结果
+    """
+    if not is_distributed():
+        return list(values)
+    device = torch.device('cuda') if dist.get_backend() == 'nccl' else torch.device('cpu')
+    tensor = torch.tensor(values, dtype=torch.float64, device=device)
+    dist.all_reduce(tensor, op=dist.ReduceOp.SUM)
+    return tensor.tolist()
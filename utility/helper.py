@@ -1,26 +1,150 @@
 import os
+import sys
+import resource
+import warnings
 from collections import OrderedDict
 
 import torch
-from dgl import function as fn
+import torch.nn.functional as F
 
 
 # DGL: dgl-cu101(0.4.3)
 # We will get different results when using the function `fn.sum`, and the randomness is due to `atomicAdd`.
-# Use custom function to ensure deterministic behavior.
-def edge_softmax_fix(graph, score):
-
-    def reduce_sum(nodes):
-        accum = torch.sum(nodes.mailbox['temp'], 1)
-        return {'out_sum': accum}
-
-    graph = graph.local_var()
-    graph.edata['out'] = score
-    graph.edata['out'] = torch.exp(graph.edata['out'])
-    graph.update_all(fn.copy_e('out', 'temp'), reduce_sum)
-    graph.apply_edges(fn.e_div_v('out', 'out_sum', 'out'))
-    out = graph.edata['out']
-    return out
+# 原来用自定义的 reduce 函数（nodes.mailbox）求和来保证结果确定，但 DGL 会按入度分桶逐桶执行，很慢，而且 exp 之前没有减去最大值
+# 现在把边按目标节点稳定排序，用 torch.segment_reduce 在每个目标节点的一段边上求最大值和求和：
+#   - 每段内按固定顺序归约，没有 atomicAdd，前向和反向的结果都是确定的
+#   - exp 之前减去每段的最大值，分数很大时也不会溢出
+def dst_sorted_index(graph):
+    """
+    把边按目标节点稳定排序，图不变时可以缓存（KGAT.relation_index）
+        - order:    排序后的边在原图中的位置
+        - seg_ids:  排序后每条边的目标节点
+        - lengths:  每个目标节点的入边数 (n_dst_nodes)
+        - indptr / src_ids:         邻接矩阵 A (n_dst_nodes, n_src_nodes) 的 CSR，A[v, u] 为边 u -> v 的注意力
+        - t_order / t_indptr / t_dst_ids:   A 的转置的 CSR（边按源节点稳定排序），反向传播时使用
+    """
+    src, dst = graph.edges()
+    n_src, n_dst = graph.num_src_nodes(), graph.num_dst_nodes()
+    seg_ids, order = torch.sort(dst, stable=True)
+    lengths = torch.bincount(seg_ids, minlength=n_dst)
+    t_src, t_order = torch.sort(src, stable=True)
+    return {
+        'order': order,
+        'seg_ids': seg_ids,
+        'lengths': lengths,
+        'indptr': F.pad(torch.cumsum(lengths, 0), (1, 0)),
+        'src_ids': src[order],
+        't_order': t_order,
+        't_indptr': F.pad(torch.cumsum(torch.bincount(t_src, minlength=n_src), 0), (1, 0)),
+        't_dst_ids': dst[t_order],
+        'shape': (n_dst, n_src),
+    }
+
+
+class SegmentSoftmax(torch.autograd.Function):
+    """
+    score 按原来的边顺序传入和返回，内部按目标节点排序后分段计算
+    反向为 grad_score = out * (grad_out - sum_{同一目标节点} grad_out * out)，同样用 segment_reduce 求和
+    """
+
+    @staticmethod
+    def forward(ctx, score, order, seg_ids, lengths):
+        sorted_score = score[order]
+        score_max = torch.segment_reduce(sorted_score, 'max', lengths=lengths, unsafe=True)
+        out = torch.exp(sorted_score - score_max[seg_ids])
+        out_sum = torch.segment_reduce(out, 'sum', lengths=lengths, unsafe=True)
+        out = out / out_sum[seg_ids]
+        ctx.save_for_backward(out, order, seg_ids, lengths)
+        return torch.empty_like(out).index_copy_(0, order, out)
+
+    @staticmethod
+    def backward(ctx, grad_out):
+        out, order, seg_ids, lengths = ctx.saved_tensors
+        grad_score = out * grad_out[order]
+        grad_sum = torch.segment_reduce(grad_score, 'sum', lengths=lengths, unsafe=True)
+        grad_score = grad_score - out * grad_sum[seg_ids]
+        return torch.empty_like(grad_score).index_copy_(0, order, grad_score), None, None, None
+
+
+def edge_softmax_fix(graph, score, dst_index=None):
+    """
+    score:      (n_edge, 1)，在每个目标节点的所有入边上做 softmax，总是用 float32 计算
+    dst_index:  dst_sorted_index(graph) 的结果，不传入时在这里计算
+    """
+    if dst_index is None:
+        dst_index = dst_sorted_index(graph)
+    return SegmentSoftmax.apply(score.float(), dst_index['order'], dst_index['seg_ids'], dst_index['lengths'])
+
+
+class SegmentSpMM(torch.autograd.Function):
+    """
+    N_h = A @ feat，A 为按目标节点排序的 CSR（每一行在 CSR 内部按固定顺序累加，没有 atomicAdd）
+    反向 grad_feat = A^T @ grad_out 用转置的 CSR 计算，同样是确定的；
+    注意力需要梯度时 grad_att[e] = <grad_out[dst_e], feat[src_e]>，按 chunk_size 条边分块计算，不保存 (n_edge, dim) 的消息
+    """
+
+    chunk_size = 1 << 20
+
+    @staticmethod
+    def forward(ctx, att, feat, index):
+        att = att.reshape(-1)
+        # CSR 张量每次创建都会提示 beta 状态，只在这里忽略
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', UserWarning)
+            adj = torch.sparse_csr_tensor(index['indptr'], index['src_ids'], att[index['order']], size=index['shape'], check_invariants=False)
+        ctx.index = index
+        ctx.save_for_backward(att, feat)
+        return torch.sparse.mm(adj, feat)
+
+    @staticmethod
+    def backward(ctx, grad_out):
+        att, feat = ctx.saved_tensors
+        index = ctx.index
+        grad_att = grad_feat = None
+        if ctx.needs_input_grad[1]:
+            n_dst, n_src = index['shape']
+            with warnings.catch_warnings():
+                warnings.simplefilter('ignore', UserWarning)
+                adj_t = torch.sparse_csr_tensor(index['t_indptr'], index['t_dst_ids'], att[index['t_order']], size=(n_src, n_dst), check_invariants=False)
+            grad_feat = torch.sparse.mm(adj_t, grad_out.contiguous())
+        if ctx.needs_input_grad[0]:
+            src, dst = index['src_ids'], index['seg_ids']
+            grad_sorted = torch.cat([torch.sum(grad_out[dst[i: i + SegmentSpMM.chunk_size]] * feat[src[i: i + SegmentSpMM.chunk_size]], dim=1)
+                                     for i in range(0, len(src), SegmentSpMM.chunk_size)])
+            grad_att = torch.empty_like(grad_sorted).index_copy_(0, index['order'], grad_sorted).unsqueeze(1)
+        return grad_att, grad_feat, None
+
+
+def spmm_aggregate(graph, att, feat, dst_index=None):
+    """
+    sum_{u -> v} att(u, v) * feat[u]，和 update_all(u_mul_e, sum) 相同，但结果确定
+    att:        (n_edge, 1)
+    feat:       (n_src_nodes, dim)
+    返回        (n_dst_nodes, dim)
+    """
+    if dst_index is None:
+        dst_index = dst_sorted_index(graph)
+    # CPU 上 CSR 的 SpMM 没有 bfloat16 的实现，autocast 时关闭 autocast，输入也转换为 float32
+    with torch.autocast(device_type=feat.device.type, enabled=False):
+        return SegmentSpMM.apply(att.float(), feat.float(), dst_index)
+
+
+def bf16_autocast(enabled, device):
+    """
+    --use_bf16 为 1 时在 autocast 下用 bfloat16 做矩阵乘法（Linear / matmul / bmm），
+    softmax、消息聚合（SpMM）和损失仍然用 float32 计算；bfloat16 的指数范围和 float32 相同，不需要 GradScaler
+    """
+    return torch.autocast(device_type=device.type, dtype=torch.bfloat16, enabled=enabled)
+
+
+def peak_rss():
+    """
+    当前进程的峰值常驻内存（MB），Linux 的 ru_maxrss 单位为 KB，macOS 为字节
+    """
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    if sys.platform == 'darwin':
+        return rss / 2 ** 20
+    return rss / 2 ** 10
 
 
 def early_stopping(recall_list, stopping_steps):
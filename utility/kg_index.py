@@ -0,0 +1,121 @@
+import numpy as np
+
+
+class KGIndex(object):
+    """
+    按头实体排序的 CSR 邻接索引，用来代替 defaultdict(list) 形式的 kg_dict
+        - offsets:      (n_heads + 1)   头实体 h 的边在 [offsets[h], offsets[h + 1]) 中
+        - tails:        (n_triples)     尾实体，int32
+        - relations:    (n_triples)     关系，int32
+
+    kg_dict[h] 返回 (n_edges_of_h, 2) 的数组，每一行为 (tail, relation)，和原来 list of tuple 的下标方式一致
+    """
+
+    def __init__(self, offsets, tails, relations):
+        self.offsets = offsets
+        self.tails = tails
+        self.relations = relations
+        self.degrees = np.diff(offsets)
+        self.heads = np.flatnonzero(self.degrees).astype(np.int32)     # 至少有一条边的头实体
+
+    @classmethod
+    def from_triples(cls, heads, relations, tails, n_heads=None):
+        heads = np.asarray(heads)
+        if n_heads is None:
+            n_heads = int(heads.max()) + 1 if len(heads) > 0 else 0
+
+        # 一次稳定排序，已经按头实体排好序的数据保持原来的顺序
+        order = np.argsort(heads, kind='stable')
+        counts = np.bincount(heads, minlength=n_heads)
+        offsets = np.zeros(n_heads + 1, dtype=np.int64)
+        np.cumsum(counts, out=offsets[1:])
+
+        tails = np.asarray(tails)[order].astype(np.int32)
+        relations = np.asarray(relations)[order].astype(np.int32)
+        return cls(offsets, tails, relations)
+
+    def __len__(self):
+        return len(self.heads)
+
+    def __contains__(self, head):
+        return 0 <= head < len(self.degrees) and self.degrees[head] > 0
+
+    def __getitem__(self, head):
+        start, end = self.offsets[head], self.offsets[head + 1]
+        return np.stack([self.tails[start: end], self.relations[start: end]], axis=1)
+
+    def keys(self):
+        return self.heads.tolist()
+
+    def contains(self, head, relation, tail):
+        start, end = self.offsets[head], self.offsets[head + 1]
+        return bool(np.any((self.tails[start: end] == tail) & (self.relations[start: end] == relation)))
+
+    def edge_ids(self, heads):
+        """
+        heads 的所有边在 tails / relations 中的位置
+        返回 rows（每条边属于 heads 中的第几个）和 edge_ids，按 heads 的顺序排列
+        """
+        heads = np.asarray(heads, dtype=np.int64)
+        degrees = self.degrees[heads].astype(np.int64)
+        rows = np.repeat(np.arange(len(heads), dtype=np.int64), degrees)
+        starts = self.offsets[heads] - (np.cumsum(degrees) - degrees)
+        return rows, np.repeat(starts, degrees) + np.arange(len(rows), dtype=np.int64)
+
+    def sample_edge_ids(self, heads, fanout, rng=np.random):
+        """
+        每个头实体最多取 fanout 条边：边数不超过 fanout 时全部保留，否则有放回地采样 fanout 次再去重
+        """
+        heads = np.asarray(heads, dtype=np.int64)
+        degrees = self.degrees[heads].astype(np.int64)
+        full = np.flatnonzero(degrees <= fanout)
+        rows_full, edges_full = self.edge_ids(heads[full])
+
+        sampled = np.repeat(np.flatnonzero(degrees > fanout), fanout)
+        edges_sampled = self.offsets[heads[sampled]] + (rng.random_sample(len(sampled)) * degrees[sampled]).astype(np.int64)
+
+        # 排序后去掉相邻的重复边（np.unique 在 numpy 2 中走哈希，比排序慢）
+        order = np.argsort(edges_sampled)
+        edges_sampled = edges_sampled[order]
+        first = np.ones(len(order), dtype=bool)
+        first[1:] = edges_sampled[1:] != edges_sampled[:-1]
+
+        rows = np.concatenate([full[rows_full], sampled[order[first]]])
+        edges = np.concatenate([edges_full, edges_sampled[first]])
+        return rows, edges
+
+    @property
+    def nbytes(self):
+        return self.offsets.nbytes + self.tails.nbytes + self.relations.nbytes
+
+
+def relabel_nodes(seeds, tails):
+    """
+    构建 block 时把尾实体的全局 id 换成源节点中的位置
+        - seeds:    目标节点（不重复，顺序任意），是源节点的前缀
+        - tails:    每条边的尾实体
+    返回 src_nodes（seeds 加上其它尾实体，后者有序）和每条边的源节点位置
+    尾实体只排序一次，去重和查找都在有序数组上完成
+    """
+    perm = np.argsort(tails)
+    sorted_tails = tails[perm]
+    first = np.ones(len(tails), dtype=bool)
+    first[1:] = sorted_tails[1:] != sorted_tails[:-1]
+    uniq = sorted_tails[first]
+
+    # 哪些尾实体已经在 seeds 中
+    seed_order = np.argsort(seeds)
+    sorted_seeds = seeds[seed_order]
+    pos = np.minimum(np.searchsorted(sorted_seeds, uniq), max(len(seeds) - 1, 0))
+    if len(seeds) > 0:
+        is_seed = sorted_seeds[pos] == uniq
+    else:
+        is_seed = np.zeros(len(uniq), dtype=bool)
+
+    uniq_local = np.empty(len(uniq), dtype=np.int64)
+    uniq_local[is_seed] = seed_order[pos[is_seed]]
+    uniq_local[~is_seed] = len(seeds) + np.arange(len(uniq) - int(is_seed.sum()), dtype=np.int64)
+
+    src_local = np.empty(len(tails), dtype=np.int64)
+    src_local[perm] = uniq_local[np.cumsum(first) - 1]
+    return np.concatenate([seeds, uniq[~is_seed]]), src_local
@@ -0,0 +1,59 @@
+import os
+
+import numpy as np
+import pandas as pd
+
+
+"""
+    kg_final.txt 的快速读取
+    每一行为 h r t，用 pandas 的 C 引擎直接读成 int32，
+    去重时把 (h, r, t) 打包成一个 int64 键，排序后只保留每个键第一次出现的位置，结果和 drop_duplicates() 一致（保持原来的顺序）
+    可以把去重后的三元组保存为 kg_final.npy，之后直接读取二进制文件
+"""
+
+KG_COLUMNS = ['h', 'r', 't']
+
+
+def read_triples(filename):
+    kg_data = pd.read_csv(filename, sep=r'\s+', names=KG_COLUMNS, header=None, usecols=[0, 1, 2],
+                          engine='c', dtype=np.int32)
+    return kg_data.values
+
+
+def drop_duplicate_triples(triples):
+    """
+    triples:    (n_triples, 3) int32
+    返回去重后的三元组，保留每个三元组第一次出现的位置
+    """
+    if len(triples) == 0:
+        return triples
+    h, r, t = [triples[:, i].astype(np.int64) for i in range(3)]
+    n_r = int(r.max()) + 1
+    n_t = int(t.max()) + 1
+    keys = (h * n_r + r) * n_t + t
+
+    order = np.argsort(keys, kind='stable')
+    sorted_keys = keys[order]
+    first = np.ones(len(keys), dtype=bool)
+    first[1:] = sorted_keys[1:] != sorted_keys[:-1]
+    return triples[np.sort(order[first])]
+
+
+def binary_file_of(filename):
+    return os.path.splitext(filename)[0] + '.npy'
+
+
+def load_kg_file(filename, use_binary=False):
+    """
+    filename:   kg_final.txt
+    use_binary: 为 True 时优先读取同目录下的 kg_final.npy（比 txt 旧时重新生成），不存在时解析 txt 后保存
+    返回 int32 的 DataFrame，列为 h / r / t
+    """
+    binary_file = binary_file_of(filename)
+    if use_binary and os.path.exists(binary_file) and os.path.getmtime(binary_file) >= os.path.getmtime(filename):
+        triples = np.load(binary_file)
+    else:
+        triples = drop_duplicate_triples(read_triples(filename))
+        if use_binary:
+            np.save(binary_file, triples)
+    return pd.DataFrame(triples, columns=KG_COLUMNS)
@@ -1,11 +1,13 @@
 import os
-import random
 import collections
 
 import torch
 import numpy as np
 import pandas as pd
 
+from utility.cf_parser import load_cf_file, to_user_dict
+from utility.sampler import CFSampler
+
 
 class DataLoaderBPRMF(object):
 
@@ -26,31 +28,17 @@ class DataLoaderBPRMF(object):
         self.statistic_cf()
         self.print_info(logging)
 
+        # 采样索引在这里一次构建好，预取线程之间共享
+        self.cf_sampler = CFSampler(self.train_user_dict, self.n_items)
+
         if self.use_pretrain == 1:
             self.load_pretrained_data()
 
 
     def load_cf(self, filename):
-        user = []
-        item = []
-        user_dict = dict()
-
-        lines = open(filename, 'r').readlines()
-        for l in lines:
-            tmp = l.strip()
-            inter = [int(i) for i in tmp.split()]
-
-            if len(inter) > 1:
-                user_id, item_ids = inter[0], inter[1:]
-                item_ids = list(set(item_ids))
-
-                for item_id in item_ids:
-                    user.append(user_id)
-                    item.append(item_id)
-                user_dict[user_id] = item_ids
-
-        user = np.array(user, dtype=np.int32)
-        item = np.array(item, dtype=np.int32)
+        # 整块读入后用 numpy 解析，每一行的项目有序去重，user / item 为 int32
+        user, item, users, indptr = load_cf_file(filename, self.args.parse_workers)
+        user_dict = to_user_dict(users, indptr, item)
         return (user, item), user_dict
 
 
@@ -68,47 +56,11 @@ class DataLoaderBPRMF(object):
         logging.info('n_cf_test:          %d' % self.n_cf_test)
 
 
-    def sample_pos_items_for_u(self, user_dict, user_id, n_sample_pos_items):
-        pos_items = user_dict[user_id]
-        n_pos_items = len(pos_items)
-
-        sample_pos_items = []
-        while True:
-            if len(sample_pos_items) == n_sample_pos_items:
-                break
-
-            pos_item_idx = np.random.randint(low=0, high=n_pos_items, size=1)[0]
-            pos_item_id = pos_items[pos_item_idx]
-            if pos_item_id not in sample_pos_items:
-                sample_pos_items.append(pos_item_id)
-        return sample_pos_items
-
-
-    def sample_neg_items_for_u(self, user_dict, user_id, n_sample_neg_items):
-        pos_items = user_dict[user_id]
-
-        sample_neg_items = []
-        while True:
-            if len(sample_neg_items) == n_sample_neg_items:
-                break
-
-            neg_item_id = np.random.randint(low=0, high=self.n_items, size=1)[0]
-            if neg_item_id not in pos_items and neg_item_id not in sample_neg_items:
-                sample_neg_items.append(neg_item_id)
-        return sample_neg_items
-
-
-    def generate_train_batch(self, user_dict):
-        exist_users = user_dict.keys()
-        if self.train_batch_size <= len(exist_users):
-            batch_user = random.sample(exist_users, self.train_batch_size)
-        else:
-            batch_user = [random.choice(exist_users) for _ in range(self.train_batch_size)]
-
-        batch_pos_item, batch_neg_item = [], []
-        for u in batch_user:
-            batch_pos_item += self.sample_pos_items_for_u(user_dict, u, 1)
-            batch_neg_item += self.sample_neg_items_for_u(user_dict, u, 1)
+    def generate_train_batch(self, user_dict, rng=np.random):
+        # 整个 batch 一次采样，传入其它 user_dict 时重新构建正样本索引
+        if self.cf_sampler.user_dict is not user_dict:
+            self.cf_sampler = CFSampler(user_dict, self.n_items)
+        batch_user, batch_pos_item, batch_neg_item = self.cf_sampler.sample(self.train_batch_size, rng)
 
         batch_user = torch.LongTensor(batch_user)
         batch_pos_item = torch.LongTensor(batch_pos_item)
@@ -1,11 +1,15 @@
 import os
-import random
-import collections
+import time
 
 import torch
 import numpy as np
 import pandas as pd
 
+from utility.kg_index import KGIndex
+from utility.cf_parser import load_cf_file, to_user_dict
+from utility.kg_parser import load_kg_file
+from utility.sampler import CFSampler, KGSampler
+
 
 class DataLoaderCKE(object):
 
@@ -31,31 +35,18 @@ class DataLoaderCKE(object):
         self.construct_data(kg_data)
         self.print_info(logging)
 
+        # 采样索引在这里一次构建好，预取线程之间共享
+        self.cf_sampler = CFSampler(self.train_user_dict, self.n_items)
+        self.kg_sampler = KGSampler(self.kg_dict, self.n_entities)
+
         if self.use_pretrain == 1:
             self.load_pretrained_data()
 
 
     def load_cf(self, filename):
-        user = []
-        item = []
-        user_dict = dict()
-
-        lines = open(filename, 'r').readlines()
-        for l in lines:
-            tmp = l.strip()
-            inter = [int(i) for i in tmp.split()]
-
-            if len(inter) > 1:
-                user_id, item_ids = inter[0], inter[1:]
-                item_ids = list(set(item_ids))
-
-                for item_id in item_ids:
-                    user.append(user_id)
-                    item.append(item_id)
-                user_dict[user_id] = item_ids
-
-        user = np.array(user, dtype=np.int32)
-        item = np.array(item, dtype=np.int32)
+        # 整块读入后用 numpy 解析，每一行的项目有序去重，user / item 为 int32
+        user, item, users, indptr = load_cf_file(filename, self.args.parse_workers)
+        user_dict = to_user_dict(users, indptr, item)
         return (user, item), user_dict
 
 
@@ -67,8 +58,11 @@ class DataLoaderCKE(object):
 
 
     def load_kg(self, filename):
-        kg_data = pd.read_csv(filename, sep=' ', names=['h', 'r', 't'], engine='python')
-        kg_data = kg_data.drop_duplicates()
+        # C 引擎读取为 int32，打包成 int64 键去重，kg_binary 为 1 时读取转换好的 kg_final.npy
+        time0 = time.time()
+        kg_data = load_kg_file(filename, self.args.kg_binary == 1)
+        self.kg_load_time = time.time() - time0
+        self.kg_load_nbytes = int(kg_data.memory_usage(index=False).sum())
         return kg_data
 
 
@@ -85,12 +79,10 @@ class DataLoaderCKE(object):
         self.n_kg_data = len(self.kg_data)
 
         # construct kg dict
-        self.kg_dict = collections.defaultdict(list)
-        self.relation_dict = collections.defaultdict(list)
-        for row in self.kg_data.iterrows():
-            h, r, t = row[1]
-            self.kg_dict[h].append((t, r))
-            self.relation_dict[r].append((h, t))
+        # 按头实体排序的 CSR 索引，kg_dict[h] 仍然返回 (tail, relation) 对
+        # relation_dict 没有被使用，不再构建
+        self.kg_dict = KGIndex.from_triples(self.kg_data['h'].values, self.kg_data['r'].values,
+                                            self.kg_data['t'].values, self.n_entities)
 
 
     def print_info(self, logging):
@@ -100,52 +92,18 @@ class DataLoaderCKE(object):
         logging.info('n_relations:        %d' % self.n_relations)
 
         logging.info('n_kg_data:          %d' % self.n_kg_data)
+        logging.info('kg load time:       %.2fs' % self.kg_load_time)
+        logging.info('kg triples size:    %.1f MB' % (self.kg_load_nbytes / 2 ** 20))
 
         logging.info('n_cf_train:         %d' % self.n_cf_train)
         logging.info('n_cf_test:          %d' % self.n_cf_test)
 
 
-    def sample_pos_items_for_u(self, user_dict, user_id, n_sample_pos_items):
-        pos_items = user_dict[user_id]
-        n_pos_items = len(pos_items)
-
-        sample_pos_items = []
-        while True:
-            if len(sample_pos_items) == n_sample_pos_items:
-                break
-
-            pos_item_idx = np.random.randint(low=0, high=n_pos_items, size=1)[0]
-            pos_item_id = pos_items[pos_item_idx]
-            if pos_item_id not in sample_pos_items:
-                sample_pos_items.append(pos_item_id)
-        return sample_pos_items
-
-
-    def sample_neg_items_for_u(self, user_dict, user_id, n_sample_neg_items):
-        pos_items = user_dict[user_id]
-
-        sample_neg_items = []
-        while True:
-            if len(sample_neg_items) == n_sample_neg_items:
-                break
-
-            neg_item_id = np.random.randint(low=0, high=self.n_items, size=1)[0]
-            if neg_item_id not in pos_items and neg_item_id not in sample_neg_items:
-                sample_neg_items.append(neg_item_id)
-        return sample_neg_items
-
-
-    def generate_cf_batch(self, user_dict):
-        exist_users = user_dict.keys()
-        if self.cf_batch_size <= len(exist_users):
-            batch_user = random.sample(exist_users, self.cf_batch_size)
-        else:
-            batch_user = [random.choice(exist_users) for _ in range(self.cf_batch_size)]
-
-        batch_pos_item, batch_neg_item = [], []
-        for u in batch_user:
-            batch_pos_item += self.sample_pos_items_for_u(user_dict, u, 1)
-            batch_neg_item += self.sample_neg_items_for_u(user_dict, u, 1)
+    def generate_cf_batch(self, user_dict, rng=np.random):
+        # 整个 batch 一次采样，传入其它 user_dict 时重新构建正样本索引
+        if self.cf_sampler.user_dict is not user_dict:
+            self.cf_sampler = CFSampler(user_dict, self.n_items)
+        batch_user, batch_pos_item, batch_neg_item = self.cf_sampler.sample(self.cf_batch_size, rng)
 
         batch_user = torch.LongTensor(batch_user)
         batch_pos_item = torch.LongTensor(batch_pos_item)
@@ -153,54 +111,11 @@ class DataLoaderCKE(object):
         return batch_user, batch_pos_item, batch_neg_item
 
 
-    def sample_pos_triples_for_h(self, kg_dict, head, n_sample_pos_triples):
-        pos_triples = kg_dict[head]
-        n_pos_triples = len(pos_triples)
-
-        sample_relations, sample_pos_tails = [], []
-        while True:
-            if len(sample_relations) == n_sample_pos_triples:
-                break
-
-            pos_triple_idx = np.random.randint(low=0, high=n_pos_triples, size=1)[0]
-            tail = pos_triples[pos_triple_idx][0]
-            relation = pos_triples[pos_triple_idx][1]
-
-            if relation not in sample_relations and tail not in sample_pos_tails:
-                sample_relations.append(relation)
-                sample_pos_tails.append(tail)
-        return sample_relations, sample_pos_tails
-
-
-    def sample_neg_triples_for_h(self, kg_dict, head, relation, n_sample_neg_triples):
-        pos_triples = kg_dict[head]
-
-        sample_neg_tails = []
-        while True:
-            if len(sample_neg_tails) == n_sample_neg_triples:
-                break
-
-            tail = np.random.randint(low=0, high=self.n_entities, size=1)[0]
-            if (tail, relation) not in pos_triples and tail not in sample_neg_tails:
-                sample_neg_tails.append(tail)
-        return sample_neg_tails
-
-
-    def generate_kg_batch(self, kg_dict):
-        exist_heads = kg_dict.keys()
-        if self.kg_batch_size <= len(exist_heads):
-            batch_head = random.sample(exist_heads, self.kg_batch_size)
-        else:
-            batch_head = [random.choice(exist_heads) for _ in range(self.kg_batch_size)]
-
-        batch_relation, batch_pos_tail, batch_neg_tail = [], [], []
-        for h in batch_head:
-            relation, pos_tail = self.sample_pos_triples_for_h(kg_dict, h, 1)
-            batch_relation += relation
-            batch_pos_tail += pos_tail
-
-            neg_tail = self.sample_neg_triples_for_h(kg_dict, h, relation[0], 1)
-            batch_neg_tail += neg_tail
+    def generate_kg_batch(self, kg_dict, rng=np.random):
+        # 整个 batch 一次采样，传入其它 kg_dict 时重新构建三元组索引
+        if self.kg_sampler.kg_index is not kg_dict:
+            self.kg_sampler = KGSampler(kg_dict, self.n_entities)
+        batch_head, batch_relation, batch_pos_tail, batch_neg_tail = self.kg_sampler.sample(self.kg_batch_size, rng)
 
         batch_head = torch.LongTensor(batch_head)
         batch_relation = torch.LongTensor(batch_relation)
@@ -1,14 +1,17 @@
 import os
 import time
-import random
-import collections
 
-import dgl
 import torch
 import numpy as np
 import pandas as pd
 
 from utility import dgl_graphs
+from utility.kg_index import KGIndex, relabel_nodes
+from utility.cf_parser import load_cf_file, to_user_dict
+from utility.kg_parser import load_kg_file
+from utility.sampler import CFSampler, KGSampler
+from utility.helper import peak_rss
+from utility.sparse_graph import SparseGraph
 
 
 """
@@ -48,6 +51,49 @@ class DataLoaderKGAT(object):
         kg_file = os.path.join(data_dir, "kg_final.txt")
         print('--', data_dir, '--')
 
+        # 二进制缓存，以源文件的哈希作为键，源文件改变后自动重建
+        # out-of-core 模式下三元组、邻接 CSR 和采样索引都留在缓存的 mmap 文件中，不创建整个 DGL 图，
+        # 训练时从 mmap 采样 batch，再按需构建 batch 的子图（block）
+        self.out_of_core = args.out_of_core == 1
+        # dgl: 用 DGL 的图和 block，sparse: 用 utility.sparse_graph.SparseGraph，不需要安装 DGL
+        self.graph_backend = args.graph_backend
+        if self.graph_backend not in ['dgl', 'sparse']:
+            raise NotImplementedError
+        use_cache = args.use_graph == 1 or self.out_of_core
+        source_files = [train_file, test_file, kg_file]
+        self.kg_load_time = None        # 从缓存读取时不解析 kg_final.txt
+        cache_dir = os.path.join(data_dir, 'kgat_cache')
+        if use_cache and dgl_graphs.load(self, cache_dir, source_files, self.out_of_core):
+            print(time.strftime("%Y-%m-%d %H:%M:%S ", time.localtime()), '-- load data from cache --')
+        else:
+            self.load_data(train_file, test_file, kg_file)
+
+            # 采样索引在这里一次构建好，预取线程之间共享
+            self.cf_sampler = CFSampler(self.train_user_dict, self.n_items)
+            self.kg_sampler = KGSampler(self.train_kg_dict, self.n_users_entities)
+            if use_cache:
+                dgl_graphs.save(self, cache_dir, source_files)
+                print(time.strftime("%Y-%m-%d %H:%M:%S ", time.localtime()), '-- save data to cache --')
+            if self.out_of_core:
+                # 第一次构建仍然在内存中完成，保存后换成 mmap 读取，释放内存中的数组
+                dgl_graphs.load(self, cache_dir, source_files, True)
+
+        if self.out_of_core:
+            self.train_graph = None
+        else:
+            # 用dgl创建知识图
+            # 这一块创建知识图需要十几分钟的时间，目前来说好像通过list批量构建是最快的
+            self.train_graph = self.create_graph(self.kg_train_data, self.n_users_entities)
+            # self.test_graph = self.create_graph(self.kg_test_data, self.n_users_entities)  # test_graph not use
+
+        print(time.strftime("%Y-%m-%d %H:%M:%S ", time.localtime()), '-- kg data finish --')
+
+        if self.use_pretrain == 1:
+            self.load_pretrained_data()
+
+        self.print_info(logging)
+
+    def load_data(self, train_file, test_file, kg_file):
         # 获取数据
         """ 
         self.load_cf:
@@ -70,50 +116,10 @@ class DataLoaderKGAT(object):
         # 创建知识图预处理
         self.construct_data(kg_data)
 
-        # 保存读取出来是list，也没有加快速度
-        # if args.use_graph == 0:
-        #     self.train_graph = self.create_graph(self.kg_train_data, self.n_users_entities)
-        #     dgl_graphs.save(self, data_dir)
-        #     print('-- save train_graph --')
-        # else:
-        #     dgl_graphs.load(self, data_dir)
-        #     print('-- load train_graph --')
-
-        # 用dgl创建知识图
-        # 这一块创建知识图需要十几分钟的时间，目前来说好像通过list批量构建是最快的
-        self.train_graph = self.create_graph(self.kg_train_data, self.n_users_entities)
-        # self.test_graph = self.create_graph(self.kg_test_data, self.n_users_entities)  # test_graph not use
-
-        print(time.strftime("%Y-%m-%d %H:%M:%S ", time.localtime()), '-- kg data finish --')
-
-        if self.use_pretrain == 1:
-            self.load_pretrained_data()
-
-        self.print_info(logging)
-
     def load_cf(self, filename):
-        user = []
-        item = []
-        user_dict = dict()
-
-        lines = open(filename, 'r').readlines()
-        for l in lines:
-            tmp = l.strip()
-            inter = [int(i) for i in tmp.split()]
-
-            if len(inter) > 1:
-                user_id, item_ids = inter[0], inter[1:]
-                item_ids = list(set(item_ids))
-
-                # 这里user和item提取出关系放在list中保持对应关系
-                # user_dict作为字典重新保持关系
-                for item_id in item_ids:
-                    user.append(user_id)
-                    item.append(item_id)
-                user_dict[user_id] = item_ids
-
-        user = np.array(user, dtype=np.int32)
-        item = np.array(item, dtype=np.int32)
+        # 整块读入后用 numpy 解析，每一行的项目有序去重，user / item 为 int32
+        user, item, users, indptr = load_cf_file(filename, self.args.parse_workers)
+        user_dict = to_user_dict(users, indptr, item)
         return (user, item), user_dict
 
     def statistic_cf(self):
@@ -123,8 +129,11 @@ class DataLoaderKGAT(object):
         self.n_cf_test = len(self.cf_test_data[0])
 
     def load_kg(self, filename):
-        kg_data = pd.read_csv(filename, sep=' ', names=['h', 'r', 't'], engine='python')
-        kg_data = kg_data.drop_duplicates()  # 去除重复项
+        # C 引擎读取为 int32，打包成 int64 键去重，kg_binary 为 1 时读取转换好的 kg_final.npy
+        time0 = time.time()
+        kg_data = load_kg_file(filename, self.args.kg_binary == 1)
+        self.kg_load_time = time.time() - time0
+        self.kg_load_nbytes = int(kg_data.memory_usage(index=False).sum())
         return kg_data
 
     def construct_data(self, kg_data):
@@ -174,26 +183,18 @@ class DataLoaderKGAT(object):
         # kg_data: 关系的无向图三元组 [5115492, 3]
         # cf2kg_train_data: 关系值为零的用户和项目三元组 [None, 3]
         # reverse_cf2kg_train_data: 关系值为一的项目和用户三元组 [None, 3]
+        # 按头实体稳定排序，和缓存中的 CSR 顺序保持一致
         self.kg_train_data = pd.concat([kg_data, cf2kg_train_data, reverse_cf2kg_train_data], ignore_index=True)
+        self.kg_train_data = self.kg_train_data.sort_values('h', kind='mergesort', ignore_index=True)
         # self.kg_test_data = pd.concat([kg_data, cf2kg_test_data, reverse_cf2kg_test_data], ignore_index=True)
 
         self.n_kg_train = len(self.kg_train_data)
         # self.n_kg_test = len(self.kg_test_data)
 
         # construct kg dict
-        self.train_kg_dict = collections.defaultdict(list)  # 便于查询，不存在时不会报错
-        # self.train_relation_dict = collections.defaultdict(list)
-        for row in self.kg_train_data.iterrows():  # 遍历行数据,index, row
-            h, r, t = row[1]
-            self.train_kg_dict[h].append((t, r))
-            # self.train_relation_dict[r].append((h, t))
-
-        # self.test_kg_dict = collections.defaultdict(list)
-        # self.test_relation_dict = collections.defaultdict(list)
-        # for row in self.kg_test_data.iterrows():
-        #     h, r, t = row[1]
-        #     self.test_kg_dict[h].append((t, r))
-        #     self.test_relation_dict[r].append((h, t))
+        # 按头实体排序的 CSR 索引，一次 argsort 完成，train_kg_dict[h] 仍然返回 (tail, relation) 对
+        self.train_kg_dict = KGIndex.from_triples(self.kg_train_data['h'].values, self.kg_train_data['r'].values,
+                                                  self.kg_train_data['t'].values, self.n_users_entities)
 
     def print_info(self, logging):
         logging.info('n_users:            %d' % self.n_users)
@@ -206,6 +207,11 @@ class DataLoaderKGAT(object):
         logging.info('n_cf_test:          %d' % self.n_cf_test)
 
         logging.info('n_kg_train:         %d' % self.n_kg_train)
+        logging.info('train_kg_dict size: %.1f MB' % (self.train_kg_dict.nbytes / 2 ** 20))
+        if self.kg_load_time is not None:
+            logging.info('kg load time:       %.2fs' % self.kg_load_time)
+            logging.info('kg triples size:    %.1f MB' % (self.kg_load_nbytes / 2 ** 20))
+        logging.info('peak RSS:           %.1f MB' % peak_rss())
         # logging.info('n_kg_test:          %d' % self.n_kg_test)
 
     def create_graph(self, kg_data, n_nodes):
@@ -218,92 +224,141 @@ class DataLoaderKGAT(object):
         # g = dgl.graph((kg_data['t'], kg_data['h']), device=device)
 
         # amazon-book中有六百多万个节点，80种关系
-        g = dgl.graph((kg_data['t'], kg_data['h']))
+        # 边按头实体（目标节点）排序，缓存读取和重新构建得到的图完全一致
+        src = torch.from_numpy(kg_data['t'].values.astype(np.int64))
+        dst = torch.from_numpy(kg_data['h'].values.astype(np.int64))
+        if self.graph_backend == 'sparse':
+            g = SparseGraph(src, dst, n_nodes)
+        else:
+            import dgl
+            g = dgl.graph((src, dst), num_nodes=n_nodes)
         g.ndata['id'] = torch.arange(n_nodes, dtype=torch.long)  # 节点
-        g.edata['type'] = torch.LongTensor(kg_data['r'])  # 边
+        g.edata['type'] = torch.from_numpy(kg_data['r'].values.astype(np.int64))  # 边
         return g
 
-    def sample_pos_items_for_u(self, user_dict, user_id, n_sample_pos_items):
-        pos_items = user_dict[user_id]
-        n_pos_items = len(pos_items)
-
-        sample_pos_items = []
-        while True:
-            if len(sample_pos_items) == n_sample_pos_items:
-                break
-
-            pos_item_idx = np.random.randint(low=0, high=n_pos_items, size=1)[0]
-            pos_item_id = pos_items[pos_item_idx]
-            if pos_item_id not in sample_pos_items:
-                sample_pos_items.append(pos_item_id)
-        return sample_pos_items
-
-    def sample_neg_items_for_u(self, user_dict, user_id, n_sample_neg_items):
-        pos_items = user_dict[user_id]
-
-        sample_neg_items = []
-        while True:
-            if len(sample_neg_items) == n_sample_neg_items:
-                break
-
-            neg_item_id = np.random.randint(low=0, high=self.n_items, size=1)[0]
-            if neg_item_id not in pos_items and neg_item_id not in sample_neg_items:
-                sample_neg_items.append(neg_item_id)
-        return sample_neg_items
-
-    """
-    返回参数：
-        1，一批用户的id
-        2，正面的项目id（用户与该项目产生了交互）
-        3，反面的项目id（用户与该项目没有交互）
-    """
-    def generate_cf_batch(self, user_dict):
-        exist_users = user_dict.keys()
-        if self.cf_batch_size <= len(exist_users):
-            batch_user = random.sample(exist_users, self.cf_batch_size)
-        else:
-            batch_user = [random.choice(exist_users) for _ in range(self.cf_batch_size)]
-
-        batch_pos_item, batch_neg_item = [], []
-        for u in batch_user:
-            batch_pos_item += self.sample_pos_items_for_u(user_dict, u, 1)
-            batch_neg_item += self.sample_neg_items_for_u(user_dict, u, 1)
+    def generate_cf_batch(self, user_dict, rng=np.random):
+        # 整个 batch 一次采样，传入其它 user_dict 时重新构建正样本索引
+        if self.cf_sampler.user_dict is not user_dict:
+            self.cf_sampler = CFSampler(user_dict, self.n_items)
+        batch_user, batch_pos_item, batch_neg_item = self.cf_sampler.sample(self.cf_batch_size, rng)
 
         batch_user = torch.LongTensor(batch_user)  # [cf_batch_size]
         batch_pos_item = torch.LongTensor(batch_pos_item)
         batch_neg_item = torch.LongTensor(batch_neg_item)
         return batch_user, batch_pos_item, batch_neg_item
 
-    def sample_pos_triples_for_h(self, kg_dict, head, n_sample_pos_triples):
-        pos_triples = kg_dict[head]
-        n_pos_triples = len(pos_triples)
-
-        sample_relations, sample_pos_tails = [], []
-        while True:
-            if len(sample_relations) == n_sample_pos_triples:
-                break
-
-            pos_triple_idx = np.random.randint(low=0, high=n_pos_triples, size=1)[0]
-            tail = pos_triples[pos_triple_idx][0]
-            relation = pos_triples[pos_triple_idx][1]
-
-            if relation not in sample_relations and tail not in sample_pos_tails:
-                sample_relations.append(relation)
-                sample_pos_tails.append(tail)
-        return sample_relations, sample_pos_tails
+    def sample_blocks(self, g, seeds, fanouts):
+        """
+        从 seeds（排好序、去重的 batch 节点）出发逐层向外取入边，得到每一层聚合需要的 DGL block
+            - fanouts:  每一层采样的邻居数，-1 表示取全部邻居
+        返回的 blocks 按聚合层的顺序排列，最后一个 block 的目标节点就是 seeds
+        采样邻居时把注意力乘以 全部入度 / 采样入度，保持 N_h 的期望不变
+        """
+        if self.graph_backend == 'sparse':
+            return self.sample_blocks_from_graph(g, seeds, fanouts)
+
+        import dgl
+        blocks = []
+        for fanout in reversed(fanouts):
+            if fanout < 0:
+                frontier = dgl.in_subgraph(g, seeds)
+            else:
+                frontier = dgl.sampling.sample_neighbors(g, seeds, fanout)
+            block = dgl.to_block(frontier, seeds)
+
+            # frontier 和 block 都会复制原图的边特征，注意力直接从 block 中取
+            # （block.edata[dgl.EID] 是 frontier 中的边 id，不能用来索引原图）
+            att = block.edata['att']
+            if fanout >= 0:
+                scale = g.in_degrees(seeds).float() / frontier.in_degrees(seeds).float().clamp(min=1)
+                att = att * scale[block.edges()[1]].unsqueeze(1)
+            block.edata['att'] = att
+
+            block.srcdata['id'] = block.srcdata[dgl.NID]
+            block.dstdata['id'] = block.dstdata[dgl.NID]
+            seeds = block.srcdata[dgl.NID]
+            blocks.insert(0, block)
+        return blocks
+
+    def sample_blocks_from_graph(self, g, seeds, fanouts, rng=np.random):
+        """
+        sparse 后端的 sample_blocks：图的边和 KGIndex 一样按头实体排序，第 i 条边就是 KGIndex 的第 i 条边，
+        所以邻居直接从 KGIndex 采样，注意力用 block.edata['eid'] 从整个图中取
+        """
+        device = seeds.device
+        seeds = seeds.cpu().numpy()
+        degrees = self.train_kg_dict.degrees
+        blocks = []
+        for fanout in reversed(fanouts):
+            block = self.in_block(seeds, fanout, rng)
+            _, dst = block.edges()
+            att = g.edata['att'][block.edata['eid'].to(g.device)]
+            if fanout >= 0:
+                scale = torch.from_numpy(degrees[seeds].astype(np.float32)) / block.in_degrees().float().clamp(min=1)
+                att = att * scale.to(att.device)[dst.to(att.device)].unsqueeze(1)
+            block = block.to(device)
+            block.edata['att'] = att.to(device)
+            seeds = block.srcdata['id'].cpu().numpy()
+            blocks.insert(0, block)
+        return blocks
+
+    def create_block(self, src, dst, num_src_nodes, num_dst_nodes):
+        if self.graph_backend == 'sparse':
+            return SparseGraph(src, dst, num_src_nodes, num_dst_nodes, is_block=True)
+        import dgl
+        return dgl.create_block((src, dst), num_src_nodes=num_src_nodes, num_dst_nodes=num_dst_nodes)
+
+    def in_block(self, seeds, fanout=-1, rng=np.random):
+        """
+        out-of-core 模式（以及 sparse 后端的 sample_blocks）下直接由 KGIndex 构建 seeds 的入边 block，不需要整个 DGL 图
+            - seeds:    目标节点 id（int64 数组，不重复）
+            - fanout:   每个节点最多取的入边数，-1 表示取全部入边
+        源节点为 seeds 加上其它出现过的尾实体，seeds 是源节点的前缀，和 dgl.to_block 的约定一致
+        """
+        kg_index = self.train_kg_dict
+        if fanout < 0:
+            rows, edge_ids = kg_index.edge_ids(seeds)
+        else:
+            rows, edge_ids = kg_index.sample_edge_ids(seeds, fanout, rng)
+        tails = np.asarray(kg_index.tails[edge_ids], dtype=np.int64)
+        relations = np.asarray(kg_index.relations[edge_ids], dtype=np.int64)
 
-    def sample_neg_triples_for_h(self, kg_dict, head, relation, n_sample_neg_triples):
-        pos_triples = kg_dict[head]
+        # 把尾实体的全局 id 换成在源节点中的位置
+        src_nodes, src_local = relabel_nodes(np.asarray(seeds, dtype=np.int64), tails)
 
-        sample_neg_tails = []
-        while True:
-            if len(sample_neg_tails) == n_sample_neg_triples:
-                break
+        block = self.create_block(torch.from_numpy(src_local), torch.from_numpy(rows), len(src_nodes), len(seeds))
+        block.srcdata['id'] = torch.from_numpy(src_nodes)
+        block.dstdata['id'] = torch.from_numpy(np.asarray(seeds, dtype=np.int64))
+        block.edata['type'] = torch.from_numpy(relations)
+        block.edata['eid'] = torch.from_numpy(edge_ids)
+        return block
 
-            tail = np.random.randint(low=0, high=self.n_users_entities, size=1)[0]
-            if (tail, relation) not in pos_triples and tail not in sample_neg_tails:
-                sample_neg_tails.append(tail)
-        return sample_neg_tails
+    def sample_blocks_from_index(self, seeds, fanouts, rng=np.random):
+        """
+        和 sample_blocks 相同，但邻居直接从 mmap 中的 KGIndex 采样
+        注意力在训练循环中对每个 block 重新计算，softmax 只在采样到的边上归一化，所以不需要按入度缩放
+        """
+        blocks = []
+        for fanout in reversed(fanouts):
+            block = self.in_block(seeds, fanout, rng)
+            seeds = block.srcdata['id'].numpy()
+            blocks.insert(0, block)
+        return blocks
+
+    def generate_cf_block_batch(self, user_dict, fanouts, rng=np.random):
+        # 在预取线程中同时完成采样和子图构建，返回 (user, pos_item, neg_item, blocks)
+        batch_user, batch_pos_item, batch_neg_item = self.generate_cf_batch(user_dict, rng)
+        seeds = np.unique(torch.cat([batch_user, batch_pos_item, batch_neg_item]).numpy())
+        blocks = self.sample_blocks_from_index(seeds, fanouts, rng)
+        return batch_user, batch_pos_item, batch_neg_item, blocks
+
+    def in_blocks(self, chunk_size):
+        """
+        按节点 id 顺序，每次取 chunk_size 个目标节点的全部入边构建 block，用于 out-of-core 模式下在整个 CKG 上传播
+        """
+        for start in range(0, self.n_users_entities, chunk_size):
+            end = min(start + chunk_size, self.n_users_entities)
+            yield self.in_block(np.arange(start, end, dtype=np.int64))
 
     """
     返回参数：
@@ -312,21 +367,11 @@ class DataLoaderKGAT(object):
         3，正面的实体id（实体之间产生了交互）
         4，反面的实体id（实体之间没有交互）
     """
-    def generate_kg_batch(self, kg_dict):
-        exist_heads = kg_dict.keys()
-        if self.kg_batch_size <= len(exist_heads):
-            batch_head = random.sample(exist_heads, self.kg_batch_size)
-        else:
-            batch_head = [random.choice(exist_heads) for _ in range(self.kg_batch_size)]
-
-        batch_relation, batch_pos_tail, batch_neg_tail = [], [], []
-        for h in batch_head:
-            relation, pos_tail = self.sample_pos_triples_for_h(kg_dict, h, 1)
-            batch_relation += relation
-            batch_pos_tail += pos_tail
-
-            neg_tail = self.sample_neg_triples_for_h(kg_dict, h, relation[0], 1)
-            batch_neg_tail += neg_tail
+    def generate_kg_batch(self, kg_dict, rng=np.random):
+        # 整个 batch 一次采样，传入其它 kg_dict 时重新构建三元组索引
+        if self.kg_sampler.kg_index is not kg_dict:
+            self.kg_sampler = KGSampler(kg_dict, self.n_users_entities)
+        batch_head, batch_relation, batch_pos_tail, batch_neg_tail = self.kg_sampler.sample(self.kg_batch_size, rng)
 
         batch_head = torch.LongTensor(batch_head)
         batch_relation = torch.LongTensor(batch_relation)
@@ -1,13 +1,15 @@
 import os
 import time
-import random
 import collections
 
 import torch
 import numpy as np
-import pandas as pd
 import scipy.sparse as sp
 
+from utility.cf_parser import load_cf_file, to_user_dict
+from utility.kg_parser import load_kg_file
+from utility.sampler import CFSampler
+
 
 class DataLoaderNFM(object):
 
@@ -33,32 +35,16 @@ class DataLoaderNFM(object):
         self.construct_data(kg_data)
         self.print_info(logging)
 
+        # 采样索引在这里一次构建好，预取线程之间共享
+        self.cf_sampler = CFSampler(self.train_user_dict, self.n_items)
+
         if self.use_pretrain == 1:
             self.load_pretrained_data()
 
     def load_cf(self, filename):
-        user = []
-        item = []
-        user_dict = dict()
-
-        lines = open(filename, 'r').readlines()
-        for l in lines:
-            tmp = l.strip()
-            inter = [int(i) for i in tmp.split()]
-
-            if len(inter) > 1:
-                user_id, item_ids = inter[0], inter[1:]
-                item_ids = list(set(item_ids))
-
-                # 这里user和item提取出关系放在list中保持对应关系
-                # user_dict作为字典重新保持关系
-                for item_id in item_ids:
-                    user.append(user_id)
-                    item.append(item_id)
-                user_dict[user_id] = item_ids
-
-        user = np.array(user, dtype=np.int32)
-        item = np.array(item, dtype=np.int32)
+        # 整块读入后用 numpy 解析，每一行的项目有序去重，user / item 为 int32
+        user, item, users, indptr = load_cf_file(filename, self.args.parse_workers)
+        user_dict = to_user_dict(users, indptr, item)
         return (user, item), user_dict
 
     def statistic_cf(self):
@@ -68,9 +54,11 @@ class DataLoaderNFM(object):
         self.n_cf_test = len(self.cf_test_data[0])
 
     def load_kg(self, filename):
-        kg_data = pd.read_csv(filename, sep=' ', names=['h', 'r', 't'], engine='python')
-        kg_data = kg_data.drop_duplicates()  # 去除重复项
-        # print(kg_data)  # [10896 rows x 3 columns]
+        # C 引擎读取为 int32，打包成 int64 键去重，kg_binary 为 1 时读取转换好的 kg_final.npy
+        time0 = time.time()
+        kg_data = load_kg_file(filename, self.args.kg_binary == 1)
+        self.kg_load_time = time.time() - time0
+        self.kg_load_nbytes = int(kg_data.memory_usage(index=False).sum())
         return kg_data
 
     def construct_data(self, kg_data):
@@ -119,6 +107,12 @@ class DataLoaderNFM(object):
         # COO不支持元素的存取和增删
         self.feat_matrix = sp.coo_matrix((feat_data, (feat_rows, feat_cols)), shape=(self.n_items, self.n_entities)).tocsr()
 
+        # 训练时直接从 feat_matrix 的 CSR 数组生成 EmbeddingBag 形式的 batch
+        self.feat_indptr = self.feat_matrix.indptr.astype(np.int64)
+        self.feat_indices = self.feat_matrix.indices.astype(np.int64)
+        self.feat_weights = self.feat_matrix.data.astype(np.float32)
+        self.feat_degrees = np.diff(self.feat_indptr)
+
     def print_info(self, logging):
         logging.info('n_users:              %d' % self.n_users)
         logging.info('n_items:              %d' % self.n_items)
@@ -127,38 +121,12 @@ class DataLoaderNFM(object):
 
         logging.info('n_cf_train:           %d' % self.n_cf_train)
         logging.info('n_cf_test:            %d' % self.n_cf_test)
+        logging.info('kg load time:         %.2fs' % self.kg_load_time)
+        logging.info('kg triples size:      %.1f MB' % (self.kg_load_nbytes / 2 ** 20))
 
         logging.info('shape of user_matrix: {}'.format(self.user_matrix.shape))
         logging.info('shape of feat_matrix: {}'.format(self.feat_matrix.shape))
 
-    def sample_pos_items_for_u(self, user_dict, user_id, n_sample_pos_items):
-        pos_items = user_dict[user_id]
-        n_pos_items = len(pos_items)
-
-        sample_pos_items = []
-        while True:
-            if len(sample_pos_items) == n_sample_pos_items:
-                break
-
-            pos_item_idx = np.random.randint(low=0, high=n_pos_items, size=1)[0]
-            pos_item_id = pos_items[pos_item_idx]
-            if pos_item_id not in sample_pos_items:
-                sample_pos_items.append(pos_item_id)
-        return sample_pos_items
-
-    def sample_neg_items_for_u(self, user_dict, user_id, n_sample_neg_items):
-        pos_items = user_dict[user_id]
-
-        sample_neg_items = []
-        while True:
-            if len(sample_neg_items) == n_sample_neg_items:
-                break
-
-            neg_item_id = np.random.randint(low=0, high=self.n_items, size=1)[0]
-            if neg_item_id not in pos_items and neg_item_id not in sample_neg_items:
-                sample_neg_items.append(neg_item_id)
-        return sample_neg_items
-
     def convert_coo2tensor(self, coo):
         values = coo.data
         indices = np.vstack((coo.row, coo.col))
@@ -169,36 +137,41 @@ class DataLoaderNFM(object):
 
         return torch.sparse.FloatTensor(i, v, torch.Size(shape))
 
-    def generate_train_batch(self, user_dict):
-        exist_users = user_dict.keys()
-        if self.train_batch_size <= len(exist_users):
-            batch_user = random.sample(exist_users, self.train_batch_size)
-        else:
-            batch_user = [random.choice(exist_users) for _ in range(self.train_batch_size)]
-
-        batch_pos_item, batch_neg_item = [], []
-        for u in batch_user:
-            batch_pos_item += self.sample_pos_items_for_u(user_dict, u, 1)
-            batch_neg_item += self.sample_neg_items_for_u(user_dict, u, 1)
-
-        batch_user_sp = self.user_matrix[[i - self.n_entities for i in batch_user]]
-        batch_pos_item_sp = self.feat_matrix[batch_pos_item]
-        batch_neg_item_sp = self.feat_matrix[batch_neg_item]
-
-        pos_feature_values = sp.hstack([batch_pos_item_sp, batch_user_sp])
-        neg_feature_values = sp.hstack([batch_neg_item_sp, batch_user_sp])
-
-        pos_feature_values = self.convert_coo2tensor(pos_feature_values.tocoo())
-        neg_feature_values = self.convert_coo2tensor(neg_feature_values.tocoo())
-
-        return pos_feature_values, neg_feature_values
-
-    def generate_test_batch(self, batch_user, batch_item):
-        batch_user_sp = self.user_matrix[np.array(batch_user) - self.n_entities]
-        batch_item_sp = self.feat_matrix[batch_item]
-        feature_values = sp.hstack([batch_item_sp, batch_user_sp])
-        feature_values = self.convert_coo2tensor(feature_values.tocoo())
-        return feature_values
+    def generate_train_batch(self, user_dict, rng=np.random):
+        # 整个 batch 一次采样，传入其它 user_dict 时重新构建正样本索引
+        if self.cf_sampler.user_dict is not user_dict:
+            self.cf_sampler = CFSampler(user_dict, self.n_items)
+        batch_user, batch_pos_item, batch_neg_item = self.cf_sampler.sample(self.train_batch_size, rng)
+
+        pos_feature_bag = self.generate_feature_bag(batch_user, batch_pos_item)
+        neg_feature_bag = self.generate_feature_bag(batch_user, batch_neg_item)
+        return pos_feature_bag + neg_feature_bag
+
+    def generate_feature_bag(self, batch_user, batch_item):
+        """
+        生成 EmbeddingBag 形式的特征：第 i 个样本的特征为 indices[offsets[i]: offsets[i + 1]]，权重为 weights 中对应的位置
+        每个样本先是项目在 feat_matrix 中的特征，最后是用户特征（用户 id 已经加上 n_entities，正好是用户在特征中的下标，权重为 1）
+        和 hstack([feat_matrix[item], user_matrix[user - n_entities]]) 表示的特征相同
+        """
+        degrees = self.feat_degrees[batch_item]
+        lengths = degrees + 1
+        offsets = np.zeros(len(batch_item), dtype=np.int64)
+        np.cumsum(lengths[:-1], out=offsets[1:])
+
+        # 每个位置在样本中的序号，序号等于项目特征数的位置放用户特征
+        n_total = int(lengths.sum())
+        position = np.arange(n_total, dtype=np.int64) - np.repeat(offsets, lengths)
+        is_user = position == np.repeat(degrees, lengths)
+        is_item = ~is_user
+        feat_pos = (np.repeat(self.feat_indptr[batch_item], lengths) + position)[is_item]
+
+        indices = np.empty(n_total, dtype=np.int64)
+        weights = np.empty(n_total, dtype=np.float32)
+        indices[is_item] = self.feat_indices[feat_pos]
+        weights[is_item] = self.feat_weights[feat_pos]
+        indices[is_user] = batch_user
+        weights[is_user] = 1
+        return torch.from_numpy(indices), torch.from_numpy(offsets), torch.from_numpy(weights)
 
     def load_pretrained_data(self):
         pre_model = 'mf'
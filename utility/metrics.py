@@ -1,5 +1,6 @@
 import torch
 import numpy as np
+import scipy.sparse as sp
 from sklearn.metrics import roc_auc_score, log_loss, mean_squared_error
 
 
@@ -115,32 +116,125 @@ def logloss(ground_truth, prediction):
     return logloss
 
 
-def calc_metrics_at_k(cf_scores, train_user_dict, test_user_dict, user_ids, item_ids, K):
+def user_dict_to_csr(user_dict, n_items=None):
     """
-    cf_scores: (n_eval_users, n_eval_items)
+    把 train_user_dict / test_user_dict 转换为 (max_user_id + 1, n_items) 的 csr_matrix，只需要转换一次
+    第 u 行的 indices 为用户 u 交互过的项目，重复的项目只保留一次，每行内部有序
     """
-    test_pos_item_binary = np.zeros([len(user_ids), len(item_ids)], dtype=np.float32)
-    for idx, u in enumerate(user_ids):
-        train_pos_item_list = train_user_dict[u]
-        test_pos_item_list = test_user_dict[u]
-        cf_scores[idx][train_pos_item_list] = 0
-        test_pos_item_binary[idx][test_pos_item_list] = 1
+    users = np.array(sorted(user_dict.keys()), dtype=np.int64)
+    lengths = np.array([len(user_dict[u]) for u in users], dtype=np.int64)
+    if lengths.sum() > 0:
+        items = np.concatenate([np.asarray(user_dict[u], dtype=np.int64) for u in users])
+    else:
+        items = np.zeros(0, dtype=np.int64)
 
-    # torch.sort 第一维度是排序结果，第二维度是排序索引
-    try:
-        _, rank_indices = torch.sort(cf_scores.cuda(), descending=True)    # try to speed up the sorting process
-    except:
-        _, rank_indices = torch.sort(cf_scores, descending=True)
-    rank_indices = rank_indices.cpu()
-
-    binary_hit = []
-    for i in range(len(user_ids)):
-        binary_hit.append(test_pos_item_binary[i][rank_indices[i]])
-    binary_hit = np.array(binary_hit, dtype=np.float32)
-
-    precision = precision_at_k_batch(binary_hit, K)
-    recall = recall_at_k_batch(binary_hit, K)
-    ndcg = ndcg_at_k_batch(binary_hit, K)
-    return precision, recall, ndcg
+    n_rows = int(users.max()) + 1 if len(users) > 0 else 0
+    if n_items is None:
+        n_items = int(items.max()) + 1 if len(items) > 0 else 0
+    rows = np.repeat(users, lengths)
+    csr = sp.csr_matrix((np.ones(len(items), dtype=np.float32), (rows, items)), shape=(n_rows, n_items))
+    csr.sum_duplicates()
+    csr.data[:] = 1
+    return csr
+
+
+def mask_items(cf_scores, user_csr, user_ids, value=-np.inf):
+    """
+    cf_scores:  (n_batch_users, n_eval_items)，第 i 行对应 user_ids[i]
+    把每个用户在 user_csr 中的项目一次性 scatter 为 value，原地修改
+    """
+    sub = user_csr[user_ids]
+    rows = np.repeat(np.arange(len(user_ids), dtype=np.int64), np.diff(sub.indptr))
+    rows = torch.from_numpy(rows).to(cf_scores.device)
+    cols = torch.from_numpy(sub.indices.astype(np.int64)).to(cf_scores.device)
+    cf_scores.index_put_((rows, cols), torch.tensor(value, dtype=cf_scores.dtype, device=cf_scores.device))
+    return cf_scores
+
+
+def build_test_index(test_user_csr, user_ids, n_keys):
+    """
+    把测试集保存为有序的键 row * n_keys + item（row 为用户在 user_ids 中的行号）
+    n_keys 至少为项目数
+    返回 keys、每个用户的测试项目数 n_test 和实际使用的 n_keys
+    """
+    sub = test_user_csr[user_ids]
+    sub.sort_indices()
+    n_keys = max(n_keys, sub.shape[1])
+    n_test = np.diff(sub.indptr)
+    keys = np.repeat(np.arange(len(user_ids), dtype=np.int64), n_test) * n_keys + sub.indices
+    return keys, n_test, n_keys
+
+
+def topk_items(cf_scores, train_user_csr, user_ids, item_ids, K, chunk_size=1024):
+    """
+    cf_scores: (n_eval_users, n_eval_items)，可以直接传入 gpu 上的 tensor
+    训练集中的项目一次性 scatter 为 -inf，每个用户只用 torch.topk 取分数最高的 K 个项目（不对整行做完整排序），用户按 chunk_size 分块处理
+    返回 (n_eval_users, K) 的项目 id；没有被屏蔽的项目不足 K 个时，topk 会在 -inf 中任意选取，这些位置填充为 -1（不会命中）
+    """
+    device = cf_scores.device
+    n_eval_users, n_eval_items = cf_scores.shape
+    K = min(K, n_eval_items)
+    user_ids = np.asarray(user_ids, dtype=np.int64)
+    item_ids = torch.from_numpy(np.asarray(item_ids, dtype=np.int64)).to(device)
+
+    rank_items = []
+    for start in range(0, n_eval_users, chunk_size):
+        end = min(start + chunk_size, n_eval_users)
+        scores = mask_items(cf_scores[start: end], train_user_csr, user_ids[start: end])
+        rank_scores, rank_indices = torch.topk(scores, K, dim=1)
+        rank_items.append(torch.where(torch.isneginf(rank_scores), -1, item_ids[rank_indices]))
+    if len(rank_items) == 0:
+        return torch.zeros((0, K), dtype=torch.long, device=device)
+    return torch.cat(rank_items)
+
+
+def calc_metrics_from_rank(rank_items, test_user_csr, user_ids):
+    """
+    rank_items: (n_eval_users, K) 每个用户按分数从大到小的前 K 个项目 id（torch.LongTensor），第 i 行对应 user_ids[i]
+                不足 K 个时用 -1 填充，-1 永远不会命中，precision 的分母仍然是 K
+    和有序的测试集键做二分查找得到是否命中，不构建 (n_eval_users, n_eval_items) 的 0/1 矩阵
+    """
+    if isinstance(test_user_csr, dict):
+        test_user_csr = user_dict_to_csr(test_user_csr)
+
+    device = rank_items.device
+    K = rank_items.shape[1]
+    user_ids = np.asarray(user_ids, dtype=np.int64)
+    n_keys = int(rank_items.max()) + 1 if rank_items.numel() > 0 else 1
+    test_keys, n_test, n_keys = build_test_index(test_user_csr, user_ids, n_keys)
+
+    test_keys = torch.from_numpy(test_keys).to(device)
+    n_test = torch.from_numpy(n_test).to(device)
+
+    discount = 1. / torch.log2(torch.arange(2, K + 2, dtype=torch.float64, device=device))
+    idcg_table = torch.cat([torch.full((1,), float('inf'), dtype=torch.float64, device=device), torch.cumsum(discount, 0)])
+
+    rows = torch.arange(len(user_ids), dtype=torch.long, device=device).unsqueeze(1)
+    query = rows * n_keys + rank_items
+    if len(test_keys) > 0:
+        pos = torch.searchsorted(test_keys, query).clamp(max=len(test_keys) - 1)
+        # 填充的 -1 对应的键为上一个用户的最后一个项目，需要排除
+        hits = ((test_keys[pos] == query) & (rank_items >= 0)).double()       # (n_eval_users, K)
+    else:
+        hits = torch.zeros(query.shape, dtype=torch.float64, device=device)
+
+    precision = hits.mean(dim=1)
+    recall = hits.sum(dim=1) / n_test.double()
+    dcg = (hits * discount).sum(dim=1)
+    idcg = idcg_table[torch.clamp(n_test, max=K)]
+    ndcg = dcg / idcg
+    return precision.cpu().numpy(), recall.cpu().numpy(), ndcg.cpu().numpy()
+
+
+def calc_metrics_at_k(cf_scores, train_user_csr, test_user_csr, user_ids, item_ids, K, chunk_size=1024):
+    """
+    cf_scores: (n_eval_users, n_eval_items)，可以直接传入 gpu 上的 tensor
+    train_user_csr / test_user_csr: user_dict_to_csr 的结果，传入 dict 时在这里转换
+    训练集中的项目设置为 -inf（设置为 0 时负分的项目会排在已经看过的项目后面），并且不会被当作命中
+    """
+    if isinstance(train_user_csr, dict):
+        train_user_csr = user_dict_to_csr(train_user_csr)
+    rank_items = topk_items(cf_scores, train_user_csr, user_ids, item_ids, K, chunk_size)
+    return calc_metrics_from_rank(rank_items, test_user_csr, user_ids)
 
 
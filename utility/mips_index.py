@@ -0,0 +1,332 @@
+import os
+import time
+
+import numpy as np
+import scipy.sparse as sp
+import torch
+
+from utility.metrics import topk_items, calc_metrics_from_rank
+
+
+"""
+    线上服务用的最大内积检索（MIPS）索引，推荐时不再对所有项目做 matmul 再排序
+    - IVFIndex:         纯 numpy 的倒排索引（IVF）
+        - 给每个项目向量加一维 sqrt(M^2 - |x|^2)（M 为最大范数），查询向量加一维 0，
+          这样所有项目的范数相同，内积最大等价于欧氏距离最近，可以直接用 k-means 聚类
+        - 项目按所属的簇排序后连续存放，查询时只扫描和查询内积最大的 n_probe 个簇中心，在候选中用精确的内积取 top-K
+          （按簇中心的内积选簇比按欧氏距离选簇的召回率高：amazon-book 上扫描同样多的项目，top-20 召回率 0.67 对 0.44）
+    - FaissIVFIndex:    可选的 faiss-cpu 后端（IndexIVFFlat，内积度量），没有安装 faiss 时报错
+    - Recommender:      用户向量 + 索引 + 训练集中交互过的项目，recommend(user_id, k) 返回用户没有交互过的 top-K 项目
+
+    两种索引都可以 save 到文件，之后用 load 读取，不依赖模型和训练数据
+"""
+
+
+def augment_items(item_embed):
+    norms = np.sum(item_embed ** 2, axis=1)
+    extra = np.sqrt(np.maximum(norms.max() - norms, 0))
+    return np.hstack([item_embed, extra[:, None]]).astype(np.float32)
+
+
+def kmeans(x, n_clusters, n_iter=10, rng=np.random, chunk_size=8192):
+    """
+    x:  (n, d) float32，返回 (n_clusters, d) 的簇中心和每个点所属的簇
+    """
+    n = len(x)
+    centroids = x[rng.choice(n, n_clusters, replace=False)].copy()
+    for _ in range(n_iter + 1):
+        # 距离最近 = x · c - |c|^2 / 2 最大
+        half_norms = np.sum(centroids ** 2, axis=1) / 2
+        assign = np.concatenate([np.argmax(x[i: i + chunk_size] @ centroids.T - half_norms, axis=1)
+                                 for i in range(0, n, chunk_size)])
+        if _ == n_iter:
+            break
+        counts = np.bincount(assign, minlength=n_clusters)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assign, x)
+        nonempty = counts > 0
+        centroids[nonempty] = sums[nonempty] / counts[nonempty, None]
+        # 空簇重新随机取一个点
+        n_empty = int((~nonempty).sum())
+        if n_empty > 0:
+            centroids[~nonempty] = x[rng.choice(n, n_empty, replace=False)]
+    return centroids, assign
+
+
+class IVFIndex(object):
+    """
+        - centroids:    (n_lists, d + 1)    增广后的簇中心
+        - offsets:      (n_lists + 1)       第 c 个簇的项目在 [offsets[c], offsets[c + 1]) 中
+        - item_ids:     (n_items)           按簇排序后的项目 id
+        - vectors:      (n_items, d)        按簇排序后的项目向量（原始向量，不含增广的一维）
+        - n_probe:      查询时扫描的簇数，等于 n_lists 时为精确检索
+    """
+
+    def __init__(self, centroids, offsets, item_ids, vectors, n_probe=64):
+        self.centroids = centroids
+        self.offsets = offsets
+        self.item_ids = item_ids
+        self.vectors = vectors
+        self.n_probe = int(n_probe)
+
+        # 查询向量增广的一维为 0，只需要簇中心的前 d 维
+        self.coarse = np.ascontiguousarray(centroids[:, :-1])
+
+    @classmethod
+    def build(cls, item_embed, n_lists=0, n_probe=64, n_iter=10, seed=2020):
+        """
+        item_embed:     (n_items, d)
+        n_lists:        簇数，0 表示取 4 * sqrt(n_items)
+        """
+        item_embed = np.asarray(item_embed, dtype=np.float32)
+        n_items = len(item_embed)
+        if n_lists <= 0:
+            n_lists = int(4 * np.sqrt(n_items))
+        n_lists = max(1, min(n_lists, n_items))
+
+        centroids, assign = kmeans(augment_items(item_embed), n_lists, n_iter, np.random.RandomState(seed))
+        order = np.argsort(assign, kind='stable')
+        offsets = np.zeros(n_lists + 1, dtype=np.int64)
+        np.cumsum(np.bincount(assign, minlength=n_lists), out=offsets[1:])
+        return cls(centroids, offsets, order.astype(np.int64), np.ascontiguousarray(item_embed[order]), n_probe)
+
+    @property
+    def n_lists(self):
+        return len(self.centroids)
+
+    def candidates(self, query):
+        """
+        和查询内积最大的 n_probe 个簇中所有项目在 vectors 中的位置
+        """
+        n_probe = min(self.n_probe, self.n_lists)
+        coarse_score = self.coarse @ query
+        if n_probe < self.n_lists:
+            lists = np.argpartition(-coarse_score, n_probe - 1)[:n_probe]
+        else:
+            lists = np.arange(self.n_lists)
+        starts = self.offsets[lists]
+        lengths = self.offsets[lists + 1] - starts
+        total = int(lengths.sum())
+        return np.repeat(starts - np.cumsum(lengths) + lengths, lengths) + np.arange(total)
+
+    def search(self, query, k):
+        """
+        query:  (d) 用户向量
+        返回内积最大的 k 个项目 id 和内积（从大到小）
+        """
+        pos = self.candidates(np.asarray(query, dtype=np.float32))
+        scores = self.vectors[pos] @ query
+        if k < len(scores):
+            top = np.argpartition(-scores, k - 1)[:k]
+        else:
+            top = np.arange(len(scores))
+        top = top[np.argsort(-scores[top], kind='stable')]
+        return self.item_ids[pos[top]], scores[top]
+
+    def save(self, path):
+        np.savez(path, centroids=self.centroids, offsets=self.offsets, item_ids=self.item_ids,
+                 vectors=self.vectors, n_probe=self.n_probe)
+
+    @classmethod
+    def load(cls, path):
+        data = np.load(path)
+        return cls(data['centroids'], data['offsets'], data['item_ids'], data['vectors'], int(data['n_probe']))
+
+
+class FaissIVFIndex(object):
+    """
+    faiss-cpu 的 IndexIVFFlat（METRIC_INNER_PRODUCT），接口和 IVFIndex 相同
+    """
+
+    def __init__(self, index, n_probe=64):
+        self.index = index
+        self.index.nprobe = int(n_probe)
+        self.n_probe = int(n_probe)
+
+    @staticmethod
+    def _faiss():
+        try:
+            import faiss
+        except ImportError:
+            raise ImportError('--ann_backend faiss requires faiss-cpu (pip install faiss-cpu)')
+        return faiss
+
+    @classmethod
+    def build(cls, item_embed, n_lists=0, n_probe=64, n_iter=10, seed=2020):
+        faiss = cls._faiss()
+        item_embed = np.ascontiguousarray(item_embed, dtype=np.float32)
+        n_items, dim = item_embed.shape
+        if n_lists <= 0:
+            n_lists = int(4 * np.sqrt(n_items))
+        n_lists = max(1, min(n_lists, n_items))
+
+        quantizer = faiss.IndexFlatIP(dim)
+        index = faiss.IndexIVFFlat(quantizer, dim, n_lists, faiss.METRIC_INNER_PRODUCT)
+        index.cp.niter = n_iter
+        index.cp.seed = seed
+        index.train(item_embed)
+        index.add(item_embed)
+        return cls(index, n_probe)
+
+    def search(self, query, k):
+        scores, ids = self.index.search(np.asarray(query, dtype=np.float32)[None, :], k)
+        valid = ids[0] >= 0
+        return ids[0][valid], scores[0][valid]
+
+    def save(self, path):
+        self._faiss().write_index(self.index, path)
+
+    @classmethod
+    def load(cls, path, n_probe=64):
+        return cls(cls._faiss().read_index(path), n_probe)
+
+
+INDEX_BACKENDS = {'numpy': IVFIndex, 'faiss': FaissIVFIndex}
+
+
+def build_index(item_embed, backend='numpy', n_lists=0, n_probe=64, seed=2020):
+    if backend not in INDEX_BACKENDS:
+        raise NotImplementedError
+    return INDEX_BACKENDS[backend].build(item_embed, n_lists, n_probe, seed=seed)
+
+
+class Recommender(object):
+    """
+        - user_embed:   (n_users, d)    第 u 行为用户 u 的向量
+        - index:        IVFIndex / FaissIVFIndex
+        - seen_csr:     (n_users, n_items) 训练集中交互过的项目，推荐时过滤掉，None 表示不过滤
+    """
+
+    def __init__(self, user_embed, index, seen_csr=None):
+        self.user_embed = np.ascontiguousarray(user_embed, dtype=np.float32)
+        self.index = index
+        self.seen_csr = seen_csr
+
+    def seen_items(self, user_id):
+        if self.seen_csr is None or user_id >= self.seen_csr.shape[0]:
+            return np.zeros(0, dtype=np.int64)
+        return self.seen_csr.indices[self.seen_csr.indptr[user_id]: self.seen_csr.indptr[user_id + 1]]
+
+    def recommend(self, user_id, k):
+        """
+        返回用户 user_id 的 top-k 项目 id 和分数（从大到小）
+        多取 len(seen) 个候选，过滤掉交互过的项目后保留前 k 个
+        """
+        seen = self.seen_items(user_id)
+        item_ids, scores = self.index.search(self.user_embed[user_id], k + len(seen))
+        if len(seen) > 0:
+            keep = ~np.isin(item_ids, seen)
+            item_ids, scores = item_ids[keep], scores[keep]
+        return item_ids[:k], scores[:k]
+
+    def save(self, save_dir):
+        if not os.path.exists(save_dir):
+            os.makedirs(save_dir)
+        np.save(os.path.join(save_dir, 'user_embed.npy'), self.user_embed)
+        if self.seen_csr is not None:
+            sp.save_npz(os.path.join(save_dir, 'seen_items.npz'), self.seen_csr)
+        if isinstance(self.index, FaissIVFIndex):
+            self.index.save(os.path.join(save_dir, 'item_index.faiss'))
+        else:
+            self.index.save(os.path.join(save_dir, 'item_index.npz'))
+
+    @classmethod
+    def load(cls, save_dir, n_probe=64):
+        user_embed = np.load(os.path.join(save_dir, 'user_embed.npy'))
+        seen_path = os.path.join(save_dir, 'seen_items.npz')
+        seen_csr = sp.load_npz(seen_path) if os.path.exists(seen_path) else None
+        faiss_path = os.path.join(save_dir, 'item_index.faiss')
+        if os.path.exists(faiss_path):
+            index = FaissIVFIndex.load(faiss_path, n_probe)
+        else:
+            index = IVFIndex.load(os.path.join(save_dir, 'item_index.npz'))
+        return cls(user_embed, index, seen_csr)
+
+
+def compare_with_exact(recommender, item_embed, train_user_csr, test_user_csr, user_ids, K, batch_size=1024):
+    """
+    在 user_ids 上分别用精确打分和索引检索计算 Precision / Recall / NDCG@K，同时统计索引的 top-K 和精确 top-K 的重合率
+    索引的指标只用 recommend 返回的项目计算，不足 K 个时用 -1 填充（不会命中），不再对填充了 -inf 的分数矩阵排序
+    """
+    user_embed = torch.from_numpy(recommender.user_embed)
+    item_embed = torch.from_numpy(np.asarray(item_embed, dtype=np.float32))
+    item_ids = np.arange(len(item_embed))
+    metrics = {'exact': [[], [], []], 'index': [[], [], []]}
+    overlap = 0
+    n_exact = 0
+    for i in range(0, len(user_ids), batch_size):
+        batch_users = np.asarray(user_ids[i: i + batch_size])
+        exact_top = topk_items(user_embed[batch_users] @ item_embed.t(), train_user_csr, batch_users, item_ids, K)
+        index_top = torch.full_like(exact_top, -1)
+        for row, user_id in enumerate(batch_users):
+            ids, _ = recommender.recommend(int(user_id), exact_top.shape[1])
+            index_top[row, :len(ids)] = torch.from_numpy(ids.astype(np.int64))
+
+        for name, rank_items in [('exact', exact_top), ('index', index_top)]:
+            for m, values in zip(metrics[name], calc_metrics_from_rank(rank_items, test_user_csr, batch_users)):
+                m.append(values)
+
+        # 精确 top-K（已屏蔽训练集）中被索引检索到的比例
+        found = (exact_top.unsqueeze(2) == index_top.unsqueeze(1)).any(dim=2) & (exact_top >= 0)
+        overlap += int(found.sum())
+        n_exact += int((exact_top >= 0).sum())
+
+    result = {}
+    for name in ['exact', 'index']:
+        for metric, values in zip(['precision', 'recall', 'ndcg'], metrics[name]):
+            result[name + '_' + metric] = float(np.concatenate(values).mean())
+    result['topk_recall'] = overlap / max(n_exact, 1)
+    return result
+
+
+def benchmark(recommender, item_embed, user_ids, k, n_queries=1000):
+    """
+    单个用户查询的延迟（毫秒）和 QPS，和精确打分（所有项目的内积 + argpartition）比较
+    """
+    item_embed = np.ascontiguousarray(item_embed, dtype=np.float32)
+    queries = np.asarray(user_ids[:n_queries])
+
+    def exact(user_id):
+        scores = item_embed @ recommender.user_embed[user_id]
+        seen = recommender.seen_items(user_id)
+        scores[seen] = -np.inf
+        top = np.argpartition(-scores, k - 1)[:k]
+        return top[np.argsort(-scores[top])]
+
+    result = {}
+    for name, fn in [('exact', exact), ('index', lambda u: recommender.recommend(u, k))]:
+        latency = []
+        for user_id in queries:
+            time0 = time.perf_counter()
+            fn(int(user_id))
+            latency.append(time.perf_counter() - time0)
+        latency = np.array(latency) * 1000
+        result[name + '_p50_ms'] = float(np.percentile(latency, 50))
+        result[name + '_p99_ms'] = float(np.percentile(latency, 99))
+        result[name + '_qps'] = float(1000 / latency.mean())
+    return result
+
+
+def export_index(args, user_embed, item_embed, train_user_csr, test_user_csr, user_ids):
+    """
+    predict 中 --ann_index 1 时调用：构建索引，和精确打分比较，测试延迟，保存到 save_dir/ann_index/
+    user_embed / item_embed 为模型 export_embed 的结果，user_ids 和 csr 的行都对应 user_embed 的行
+    """
+    item_embed = item_embed.numpy()
+    time0 = time.time()
+    index = build_index(item_embed, args.ann_backend, args.ann_n_lists, args.ann_n_probe, args.seed)
+    recommender = Recommender(user_embed.numpy(), index, train_user_csr)
+    print('ANN Index: backend {} | n_probe {} | build time {:.1f}s'.format(args.ann_backend, args.ann_n_probe, time.time() - time0))
+
+    result = compare_with_exact(recommender, item_embed, train_user_csr, test_user_csr, user_ids, args.K)
+    print('ANN Evaluation: Exact Precision {:.4f} Recall {:.4f} NDCG {:.4f} | Index Precision {:.4f} Recall {:.4f} NDCG {:.4f} | Top-{} Recall vs Exact {:.4f}'.format(
+        result['exact_precision'], result['exact_recall'], result['exact_ndcg'],
+        result['index_precision'], result['index_recall'], result['index_ndcg'], args.K, result['topk_recall']))
+
+    result = benchmark(recommender, item_embed, user_ids, args.K)
+    print('ANN Latency: Exact p50 {:.3f}ms p99 {:.3f}ms QPS {:.0f} | Index p50 {:.3f}ms p99 {:.3f}ms QPS {:.0f}'.format(
+        result['exact_p50_ms'], result['exact_p99_ms'], result['exact_qps'],
+        result['index_p50_ms'], result['index_p99_ms'], result['index_qps']))
+
+    recommender.save(os.path.join(args.save_dir, 'ann_index'))
+    return recommender
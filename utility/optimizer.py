@@ -0,0 +1,81 @@
+import torch.nn as nn
+import torch.optim as optim
+
+
+"""
+    稀疏梯度训练
+    模型的大 embedding 表用 nn.Embedding(sparse=True) 创建时，反向传播只得到 batch 中出现的行的梯度（稀疏张量），
+    这些表用 optim.SparseAdam 更新：只有出现的行的参数和 Adam 状态会被更新（lazy Adam），
+    其它参数（关系矩阵、聚合层等）仍然用 optim.Adam
+
+    注意 SparseAdam 的一阶、二阶矩和 Adam 一样是整张表大小的稠密张量，省下的是每一步整张表的梯度和更新
+"""
+
+
+def split_parameters(model):
+    """
+    返回 (稀疏参数, 稠密参数)，稀疏参数为 sparse=True 的 nn.Embedding 的权重
+    """
+    sparse_ids = set()
+    for module in model.modules():
+        if isinstance(module, nn.Embedding) and module.sparse:
+            sparse_ids.add(id(module.weight))
+    sparse_params, dense_params = [], []
+    for param in model.parameters():
+        if param.requires_grad:
+            (sparse_params if id(param) in sparse_ids else dense_params).append(param)
+    return sparse_params, dense_params
+
+
+class SparseDenseAdam(object):
+    """
+    SparseAdam + Adam 的组合，接口和 torch.optim.Optimizer 相同（step / zero_grad / state_dict / load_state_dict）
+    """
+
+    def __init__(self, model, lr):
+        sparse_params, dense_params = split_parameters(model)
+        self.optimizers = []
+        if len(sparse_params) > 0:
+            self.optimizers.append(optim.SparseAdam(sparse_params, lr=lr))
+        if len(dense_params) > 0:
+            self.optimizers.append(optim.Adam(dense_params, lr=lr))
+
+    @property
+    def param_groups(self):
+        return [group for optimizer in self.optimizers for group in optimizer.param_groups]
+
+    def step(self):
+        for optimizer in self.optimizers:
+            optimizer.step()
+
+    def zero_grad(self, set_to_none=True):
+        for optimizer in self.optimizers:
+            optimizer.zero_grad(set_to_none=set_to_none)
+
+    def state_dict(self):
+        return [optimizer.state_dict() for optimizer in self.optimizers]
+
+    def load_state_dict(self, state_dicts):
+        for optimizer, state_dict in zip(self.optimizers, state_dicts):
+            optimizer.load_state_dict(state_dict)
+
+
+def create_optimizer(model, lr, sparse_grad=False):
+    """
+    sparse_grad 为 False 时和原来一样用 Adam 更新所有参数
+    """
+    if sparse_grad:
+        return SparseDenseAdam(model, lr)
+    return optim.Adam(model.parameters(), lr=lr)
+
+
+def optimizer_state_nbytes(optimizer):
+    """
+    优化器状态（Adam 的一阶、二阶矩等）占用的字节数
+    """
+    optimizers = optimizer.optimizers if isinstance(optimizer, SparseDenseAdam) else [optimizer]
+    nbytes = 0
+    for opt in optimizers:
+        for state in opt.state.values():
+            nbytes += sum(v.numel() * v.element_size() for v in state.values() if hasattr(v, 'numel'))
+    return nbytes
@@ -6,6 +6,8 @@ def parse_cke_args():
 
     parser.add_argument('--local_rank', type=int, default=0,
                         help='Local rank for using multi GPUs.')
+    parser.add_argument('--distributed', type=int, default=0,
+                        help='0: Single process, 1: Data-parallel training over the processes started by torchrun (gloo on CPU, nccl on CUDA).')
 
     parser.add_argument('--seed', type=int, default=2020,
                         help='Random seed.')
@@ -14,6 +16,10 @@ def parse_cke_args():
                         help='Choose a dataset from {yelp2018, last-fm, amazon-book}')
     parser.add_argument('--data_dir', nargs='?', default='datasets/',
                         help='Input data path.')
+    parser.add_argument('--parse_workers', type=int, default=1,
+                        help='Number of processes parsing train.txt / test.txt. 1: parse in the main process.')
+    parser.add_argument('--kg_binary', type=int, default=0,
+                        help='0: Parse kg_final.txt, 1: Use (and create if missing or outdated) kg_final.npy next to kg_final.txt.')
 
     parser.add_argument('--use_pretrain', type=int, default=1,
                         help='0: No pretrain, 1: Pretrain with the learned embeddings, 2: Pretrain with stored model.')
@@ -29,6 +35,13 @@ def parse_cke_args():
     parser.add_argument('--test_batch_size', type=int, default=10000,
                         help='Test batch size (the user number to test every batch).')
 
+    parser.add_argument('--n_workers', type=int, default=1,
+                        help='Number of background threads generating training batches. 0: generate batches in the training loop.')
+    parser.add_argument('--prefetch_depth', type=int, default=4,
+                        help='Max number of prefetched training batches waiting in the queue.')
+    parser.add_argument('--pin_memory', type=int, default=0,
+                        help='0: No pin memory, 1: Put prefetched batches in pinned memory (only with CUDA).')
+
     parser.add_argument('--embed_dim', type=int, default=64,
                         help='User / item / entity Embedding size.')
     parser.add_argument('--relation_dim', type=int, default=64,
@@ -39,6 +52,11 @@ def parse_cke_args():
     parser.add_argument('--cf_l2loss_lambda', type=float, default=1e-5,
                         help='Lambda when calculating CF l2 loss.')
 
+    parser.add_argument('--sparse_grad', type=int, default=0,
+                        help='0: Dense embedding gradients updated with Adam, 1: Sparse embedding gradients updated with SparseAdam (other parameters with Adam).')
+    parser.add_argument('--use_bf16', type=int, default=0,
+                        help='0: Float32, 1: bfloat16 autocast for matrix multiplications (softmax, message aggregation and losses stay in float32).')
+
     parser.add_argument('--lr', type=float, default=0.0001,
                         help='Learning rate.')
     parser.add_argument('--n_epoch', type=int, default=1000,
@@ -54,6 +72,18 @@ def parse_cke_args():
     parser.add_argument('--K', type=int, default=20,
                         help='Calculate metric@K when evaluating.')
 
+    parser.add_argument('--ann_index', type=int, default=0,
+                        help='0: Only exact scoring in predict, 1: Also build a MIPS index over the final embeddings, compare it with exact scoring, benchmark it and save it to save_dir/ann_index/.')
+    parser.add_argument('--ann_backend', nargs='?', default='numpy',
+                        help='Backend of the MIPS index: {numpy, faiss} (faiss requires faiss-cpu).')
+    parser.add_argument('--ann_n_lists', type=int, default=0,
+                        help='Number of IVF lists. 0: 4 * sqrt(n_items).')
+    parser.add_argument('--ann_n_probe', type=int, default=64,
+                        help='Number of IVF lists scanned per query.')
+
+    parser.add_argument('--quantize_embed', nargs='?', default='none',
+                        help='Inference embedding file exported in predict: {none, float32, float16, int8}. int8: per-row scale. predict also evaluates with it and reports size, load time, throughput and metrics.')
+
     args = parser.parse_args()
 
     save_dir = 'trained_model/CKE/{}/embeddim{}_relationdim{}_lr{}_pretrain{}/'.format(
@@ -6,6 +6,8 @@ def parse_kgat_args():
 
     parser.add_argument('--local_rank', type=int, default=0,
                         help='Local rank for using multi GPUs.')
+    parser.add_argument('--distributed', type=int, default=0,
+                        help='0: Single process, 1: Data-parallel training over the processes started by torchrun (gloo on CPU, nccl on CUDA).')
 
     parser.add_argument('--seed', type=int, default=2020,
                         help='Random seed.')
@@ -14,9 +16,19 @@ def parse_kgat_args():
                         help='Choose a dataset from {yelp2018, last-fm, amazon-book, douban250}')
     parser.add_argument('--data_dir', nargs='?', default='datasets/',
                         help='Input data path.')
+    parser.add_argument('--parse_workers', type=int, default=1,
+                        help='Number of processes parsing train.txt / test.txt. 1: parse in the main process.')
+    parser.add_argument('--kg_binary', type=int, default=0,
+                        help='0: Parse kg_final.txt, 1: Use (and create if missing or outdated) kg_final.npy next to kg_final.txt.')
 
     parser.add_argument('--use_graph', type=int, default=1,
-                        help='0: No pre graph, 1: use pre graph data')
+                        help='0: Rebuild graph data from txt files, 1: Use (and create if missing) the binary cache in {data_dir}/{data_name}/kgat_cache.')
+    parser.add_argument('--out_of_core', type=int, default=0,
+                        help='0: Keep the whole CKG in memory, 1: Keep triples and adjacency in the mmap files of kgat_cache, sample batches and build per-batch subgraphs from them (always uses the cache and block propagation).')
+    parser.add_argument('--ooc_chunk_size', type=int, default=65536,
+                        help='Number of destination nodes per subgraph when propagating over the whole CKG in out-of-core mode.')
+    parser.add_argument('--graph_backend', nargs='?', default='dgl',
+                        help='Graph backend of the CKG and its blocks: {dgl, sparse}. sparse: torch CSR tensors only, DGL is not required.')
 
     parser.add_argument('--use_pretrain', type=int, default=1,
                         help='0: No pretrain, 1: Pretrain with the learned embeddings, 2: Pretrain with stored model.')
@@ -32,6 +44,13 @@ def parse_kgat_args():
     parser.add_argument('--test_batch_size', type=int, default=1024,
                         help='Test batch size (the user number to test every batch).')
 
+    parser.add_argument('--n_workers', type=int, default=1,
+                        help='Number of background threads generating training batches. 0: generate batches in the training loop.')
+    parser.add_argument('--prefetch_depth', type=int, default=4,
+                        help='Max number of prefetched training batches waiting in the queue.')
+    parser.add_argument('--pin_memory', type=int, default=0,
+                        help='0: No pin memory, 1: Put prefetched batches in pinned memory (only with CUDA).')
+
     parser.add_argument('--entity_dim', type=int, default=64,
                         help='User / entity Embedding size.')
     parser.add_argument('--relation_dim', type=int, default=64,
@@ -44,11 +63,21 @@ def parse_kgat_args():
     parser.add_argument('--mess_dropout', nargs='?', default='[0.1, 0.1, 0.1]',
                         help='Dropout probability w.r.t. message dropout for each deep layer. 0: no dropout.')
 
+    parser.add_argument('--use_block', type=int, default=0,
+                        help='0: Propagate over the whole CKG for every CF batch, 1: Propagate only over the receptive field of the batch (DGL blocks).')
+    parser.add_argument('--fanout', nargs='?', default='[-1, -1, -1]',
+                        help='Number of sampled in-neighbors for every aggregation layer when use_block is 1. -1: all neighbors.')
+
     parser.add_argument('--kg_l2loss_lambda', type=float, default=1e-5,
                         help='Lambda when calculating KG l2 loss.')
     parser.add_argument('--cf_l2loss_lambda', type=float, default=1e-5,
                         help='Lambda when calculating CF l2 loss.')
 
+    parser.add_argument('--sparse_grad', type=int, default=0,
+                        help='0: Dense embedding gradients updated with Adam, 1: Sparse embedding gradients updated with SparseAdam (other parameters with Adam).')
+    parser.add_argument('--use_bf16', type=int, default=0,
+                        help='0: Float32, 1: bfloat16 autocast for matrix multiplications (softmax, message aggregation and losses stay in float32).')
+
     parser.add_argument('--lr', type=float, default=0.0001,
                         help='Learning rate.')
     parser.add_argument('--n_epoch', type=int, default=1000,
@@ -66,6 +95,18 @@ def parse_kgat_args():
     parser.add_argument('--K', type=int, default=20,
                         help='Calculate metric@K when evaluating.')
 
+    parser.add_argument('--ann_index', type=int, default=0,
+                        help='0: Only exact scoring in predict, 1: Also build a MIPS index over the final embeddings, compare it with exact scoring, benchmark it and save it to save_dir/ann_index/.')
+    parser.add_argument('--ann_backend', nargs='?', default='numpy',
+                        help='Backend of the MIPS index: {numpy, faiss} (faiss requires faiss-cpu).')
+    parser.add_argument('--ann_n_lists', type=int, default=0,
+                        help='Number of IVF lists. 0: 4 * sqrt(n_items).')
+    parser.add_argument('--ann_n_probe', type=int, default=64,
+                        help='Number of IVF lists scanned per query.')
+
+    parser.add_argument('--quantize_embed', nargs='?', default='none',
+                        help='Inference embedding file exported in predict: {none, float32, float16, int8}. int8: per-row scale. predict also evaluates with it and reports size, load time, throughput and metrics.')
+
     args = parser.parse_args()
 
     save_dir = 'trained_model/KGAT/{}/entitydim{}_relationdim{}_{}_{}_lr{}_pretrain{}/'.format(
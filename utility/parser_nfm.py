@@ -14,6 +14,10 @@ def parse_nfm_args():
                         help='Choose a dataset from {yelp2018, last-fm, amazon-book, douban250}')
     parser.add_argument('--data_dir', nargs='?', default='datasets/',
                         help='Input data path.')
+    parser.add_argument('--parse_workers', type=int, default=1,
+                        help='Number of processes parsing train.txt / test.txt. 1: parse in the main process.')
+    parser.add_argument('--kg_binary', type=int, default=0,
+                        help='0: Parse kg_final.txt, 1: Use (and create if missing or outdated) kg_final.npy next to kg_final.txt.')
 
     parser.add_argument('--use_pretrain', type=int, default=1,
                         help='0: No pretrain, 1: Pretrain with the learned embeddings, 2: Pretrain with stored model.')
@@ -34,6 +38,13 @@ def parse_nfm_args():
     parser.add_argument('--test_batch_size', type=int, default=1048576,
                         help='Test batch size.')
 
+    parser.add_argument('--n_workers', type=int, default=1,
+                        help='Number of background threads generating training batches. 0: generate batches in the training loop.')
+    parser.add_argument('--prefetch_depth', type=int, default=4,
+                        help='Max number of prefetched training batches waiting in the queue.')
+    parser.add_argument('--pin_memory', type=int, default=0,
+                        help='0: No pin memory, 1: Put prefetched batches in pinned memory (only with CUDA).')
+
     parser.add_argument('--lr', type=float, default=0.0001,
                         help='Learning rate.')
     parser.add_argument('--n_epoch', type=int, default=1000,
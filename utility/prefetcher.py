@@ -0,0 +1,89 @@
+import queue
+import threading
+
+import numpy as np
+import torch
+
+
+class BatchPrefetcher(object):
+    """
+    后台线程预取训练数据，训练循环以迭代器的方式读取
+        - make_batch(rng):  生成一个 batch（tensor 的元组），rng 为 np.random.RandomState
+        - n_batch:          一共生成多少个 batch
+        - n_workers:        线程数，0 表示在训练循环中同步生成（使用全局 np.random，和原来的行为一致）
+        - queue_depth:      预取队列的最大长度，平均分给每个线程
+        - seed:             整数或整数列表，第 i 个线程的随机数种子为 seed + [i]
+        - pin_memory:       把 batch 放到锁页内存，之后可以用 non_blocking 的方式拷贝到 GPU
+
+    第 i 个线程负责第 i, i + n_workers, i + 2 * n_workers ... 个 batch，读取时按顺序轮流从各线程的队列中取，
+    所以只要 seed 相同，batch 的顺序和内容与线程的调度无关，结果可以复现
+    """
+
+    def __init__(self, make_batch, n_batch, n_workers=1, queue_depth=4, seed=None, pin_memory=False):
+        self.make_batch = make_batch
+        self.n_batch = n_batch
+        self.n_workers = max(0, min(n_workers, n_batch))
+        self.queue_depth = max(1, queue_depth)
+        self.seed = [] if seed is None else list(np.atleast_1d(seed))
+        self.pin_memory = pin_memory and torch.cuda.is_available()
+
+        self.queues = []
+        self.threads = []
+        self.stop_event = threading.Event()
+
+    def __len__(self):
+        return self.n_batch
+
+    def _pin(self, batch):
+        if not self.pin_memory:
+            return batch
+        return tuple(d.pin_memory() if isinstance(d, torch.Tensor) and not d.is_sparse else d for d in batch)
+
+    def _put(self, q, item):
+        while not self.stop_event.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _worker(self, worker_id):
+        q = self.queues[worker_id]
+        rng = np.random.RandomState(self.seed + [worker_id])
+        try:
+            for _ in range(worker_id, self.n_batch, self.n_workers):
+                if not self._put(q, (self._pin(self.make_batch(rng)), None)):
+                    return
+        except Exception as e:
+            self._put(q, (None, e))
+
+    def start(self):
+        depth = max(1, -(-self.queue_depth // self.n_workers))
+        self.queues = [queue.Queue(maxsize=depth) for _ in range(self.n_workers)]
+        self.threads = [threading.Thread(target=self._worker, args=(i,), daemon=True) for i in range(self.n_workers)]
+        for t in self.threads:
+            t.start()
+
+    def close(self):
+        self.stop_event.set()
+        for t in self.threads:
+            t.join()
+        self.threads = []
+
+    def __iter__(self):
+        if self.n_workers == 0:
+            for _ in range(self.n_batch):
+                yield self._pin(self.make_batch(np.random))
+            return
+
+        self.stop_event.clear()
+        self.start()
+        try:
+            for i in range(self.n_batch):
+                batch, error = self.queues[i % self.n_workers].get()
+                if error is not None:
+                    raise error
+                yield batch
+        finally:
+            self.close()
@@ -0,0 +1,122 @@
+import os
+import time
+
+import numpy as np
+import torch
+
+
+"""
+    推理用的低精度编码文件：只保存打分需要的最终用户 / 项目编码（模型 export_embed 的结果），
+    不保存训练用的参数（关系、W_R、Aggregator 等），KGAT 也不需要在推理时重新传播
+    - float32:  不量化，作为对照
+    - float16:  直接转换，大小为 float32 的一半
+    - int8:     每一行对称量化 x ≈ q * scale，scale = max|x| / 127，每行多存一个 float32 的 scale，大小约为 float32 的 1/4
+    打分时把 batch 中的用户行和所有项目反量化为 float32 后做 matmul（CPU 上没有更快的 float16 / int8 matmul），
+    分数的形状和 model.predict 相同，evaluate 中直接用 calc_metrics_at_k 计算指标
+"""
+
+
+QUANTIZE_DTYPES = ['float32', 'float16', 'int8']
+
+
+class QuantizedTable(object):
+    """
+        - data:     (n, d) float32 / float16 / int8
+        - scale:    (n) float32，int8 时每一行的 scale，其他情况为 None
+    """
+
+    def __init__(self, data, scale=None):
+        self.data = torch.as_tensor(data)
+        self.scale = None if scale is None else torch.as_tensor(scale)
+
+    @classmethod
+    def quantize(cls, x, dtype):
+        if dtype not in QUANTIZE_DTYPES:
+            raise NotImplementedError
+        x = torch.as_tensor(x, dtype=torch.float32)
+        if dtype == 'float32':
+            return cls(x.clone())
+        if dtype == 'float16':
+            return cls(x.half())
+        # int8
+        scale = x.abs().max(dim=1)[0] / 127
+        scale[scale == 0] = 1
+        return cls(torch.round(x / scale[:, None]).to(torch.int8), scale)
+
+    def dequantize(self, ids=None):
+        """
+        返回 ids 对应的行（None 时为所有行）的 float32 编码
+        """
+        data = self.data if ids is None else self.data[ids]
+        if self.scale is None:
+            return data.float()
+        scale = self.scale if ids is None else self.scale[ids]
+        return data.float() * scale[:, None]
+
+    def to(self, device):
+        return QuantizedTable(self.data.to(device), None if self.scale is None else self.scale.to(device))
+
+
+class QuantizedEmbedding(object):
+    """
+        - user_table / item_table:  QuantizedTable
+        - user_offset:              evaluate 中的用户 id 减去 user_offset 为 user_table 的行（KGAT 图中的用户为 n_entities + u）
+    """
+
+    def __init__(self, user_table, item_table, user_offset=0):
+        self.user_table = user_table
+        self.item_table = item_table
+        self.user_offset = user_offset
+
+    @classmethod
+    def build(cls, user_embed, item_embed, dtype='int8', user_offset=0):
+        return cls(QuantizedTable.quantize(user_embed, dtype), QuantizedTable.quantize(item_embed, dtype), user_offset)
+
+    def to(self, device):
+        return QuantizedEmbedding(self.user_table.to(device), self.item_table.to(device), self.user_offset)
+
+    def predict(self, user_ids, item_ids):
+        """
+        user_ids:   (n_eval_users)
+        item_ids:   (n_eval_items)
+        返回        (n_eval_users, n_eval_items)，和 model.predict 相同
+        """
+        user_embed = self.user_table.dequantize(user_ids - self.user_offset)       # (n_eval_users, d)
+        item_embed = self.item_table.dequantize(item_ids)                          # (n_eval_items, d)
+        return torch.matmul(user_embed, item_embed.transpose(0, 1))
+
+    def save(self, path):
+        arrays = {'user_data': self.user_table.data.cpu().numpy(), 'item_data': self.item_table.data.cpu().numpy(),
+                  'user_offset': self.user_offset}
+        if self.user_table.scale is not None:
+            arrays['user_scale'] = self.user_table.scale.cpu().numpy()
+            arrays['item_scale'] = self.item_table.scale.cpu().numpy()
+        np.savez(path, **arrays)
+
+    @classmethod
+    def load(cls, path):
+        data = np.load(path)
+        user_scale = data['user_scale'] if 'user_scale' in data else None
+        item_scale = data['item_scale'] if 'item_scale' in data else None
+        return cls(QuantizedTable(data['user_data'], user_scale), QuantizedTable(data['item_data'], item_scale), int(data['user_offset']))
+
+
+def export_quantized(args, user_embed, item_embed, user_offset=0):
+    """
+    predict 中 --quantize_embed 不为 none 时调用：量化 export_embed 的结果，保存到 save_dir/embed_{dtype}.npz，
+    再从文件读取（之后 evaluate 使用读取的结果打分），输出文件大小和读取时间，和 float32 的模型文件比较
+    """
+    path = os.path.join(args.save_dir, 'embed_{}.npz'.format(args.quantize_embed))
+    QuantizedEmbedding.build(user_embed, item_embed, args.quantize_embed, user_offset).save(path)
+
+    time0 = time.time()
+    torch.load(args.pretrain_model_path, map_location=torch.device('cpu'))
+    model_load_time = time.time() - time0
+    time0 = time.time()
+    quantized = QuantizedEmbedding.load(path)
+    load_time = time.time() - time0
+
+    print('Quantized Embedding: {} | File {:.1f} MB (model checkpoint {:.1f} MB) | Load Time {:.3f}s (model checkpoint {:.3f}s)'.format(
+        args.quantize_embed, os.path.getsize(path) / 2 ** 20, os.path.getsize(args.pretrain_model_path) / 2 ** 20,
+        load_time, model_load_time))
+    return quantized
@@ -0,0 +1,158 @@
+import numpy as np
+
+
+class CFSampler(object):
+    """
+    向量化的 cf 采样器，一次生成整个 batch 的 (user, pos_item, neg_item)
+        - 用户的正样本保存为 CSR：indptr / items，每个用户的项目已排序去重
+        - 正样本的查询键为 user_idx * n_items + item_id，整体有序，用 np.searchsorted 批量判断是否为正样本
+        - 负样本先整体随机，只对和正样本冲突的位置重新采样
+    """
+
+    def __init__(self, user_dict, n_items):
+        users = np.array(sorted(user_dict.keys()), dtype=np.int64)
+        pos_items = [np.unique(np.asarray(user_dict[u], dtype=np.int64)) for u in users]
+        degrees = np.array([len(items) for items in pos_items], dtype=np.int64)
+
+        indptr = np.zeros(len(users) + 1, dtype=np.int64)
+        np.cumsum(degrees, out=indptr[1:])
+        items = np.concatenate(pos_items) if len(pos_items) > 0 else np.zeros(0, dtype=np.int64)
+        self.set_csr(users, indptr, items, n_items)
+        self.user_dict = user_dict
+
+    @classmethod
+    def from_csr(cls, users, indptr, items, n_items, keys=None, user_dict=None):
+        """
+        直接由 CSR 数组构建（可以是 np.load(mmap_mode='r') 读取的数组），每个用户的项目需要已经有序去重
+        keys 为之前保存的查询键，传入时不再重新计算
+        """
+        sampler = cls.__new__(cls)
+        sampler.set_csr(np.asarray(users, dtype=np.int64), np.asarray(indptr, dtype=np.int64), items, n_items, keys)
+        sampler.user_dict = user_dict
+        return sampler
+
+    def set_csr(self, users, indptr, items, n_items, keys=None):
+        self.n_items = int(n_items)
+        self.users = users
+        self.indptr = indptr
+        self.degrees = np.diff(indptr)
+        self.items = items
+        if keys is None:
+            keys = np.repeat(np.arange(len(users), dtype=np.int64), self.degrees) * self.n_items + items
+        self.keys = keys
+        self.user_pool = None
+
+    def shard(self, rank, world_size):
+        """
+        数据并行时每个进程只从第 rank, rank + world_size, ... 个用户中采样
+        """
+        self.user_pool = np.arange(rank, len(self.users), world_size)
+
+    def is_positive(self, user_idx, item_ids):
+        query = user_idx * self.n_items + item_ids
+        pos = np.searchsorted(self.keys, query)
+        pos[pos == len(self.keys)] = 0
+        return self.keys[pos] == query
+
+    def sample_users(self, batch_size, rng=np.random):
+        n_users = len(self.users) if self.user_pool is None else len(self.user_pool)
+        if batch_size <= n_users:
+            user_idx = rng.choice(n_users, batch_size, replace=False)
+        else:
+            user_idx = rng.randint(0, n_users, batch_size)
+        return user_idx if self.user_pool is None else self.user_pool[user_idx]
+
+    def sample_pos_items(self, user_idx, rng=np.random):
+        offsets = (rng.random_sample(len(user_idx)) * self.degrees[user_idx]).astype(np.int64)
+        return self.items[self.indptr[user_idx] + offsets].astype(np.int64)
+
+    def sample_neg_items(self, user_idx, rng=np.random):
+        neg_items = rng.randint(0, self.n_items, len(user_idx))
+        reject = self.is_positive(user_idx, neg_items)
+        while reject.any():
+            neg_items[reject] = rng.randint(0, self.n_items, int(reject.sum()))
+            reject[reject] = self.is_positive(user_idx[reject], neg_items[reject])
+        return neg_items
+
+    def sample(self, batch_size, rng=np.random):
+        """
+        返回三个 int64 数组：用户 id、正样本项目 id、负样本项目 id
+        """
+        user_idx = self.sample_users(batch_size, rng)
+        pos_items = self.sample_pos_items(user_idx, rng)
+        neg_items = self.sample_neg_items(user_idx, rng)
+        return self.users[user_idx], pos_items, neg_items
+
+
+class KGSampler(object):
+    """
+    向量化的 kg 采样器，一次生成整个 batch 的 (head, relation, pos_tail, neg_tail)
+        - 正样本直接由 KGIndex 的 offsets 定位：offsets[h] + randint(degree[h])
+        - 三元组的查询键为 (h * n_relations + r) * n_tail_keys + t，排序后用 np.searchsorted 批量判断
+        - 负样本（替换尾实体）只对和已有三元组冲突的位置重新采样
+    """
+
+    def __init__(self, kg_index, n_neg_tails, keys=None):
+        """
+        keys 为之前保存的查询键（可以是 mmap 读取的数组），传入时不再在内存中重新计算和排序
+        """
+        self.kg_index = kg_index
+        self.n_neg_tails = int(n_neg_tails)
+
+        self.offsets = kg_index.offsets
+        self.tails = kg_index.tails
+        self.relations = kg_index.relations
+        self.degrees = kg_index.degrees.astype(np.int64)
+        self.heads = kg_index.heads.astype(np.int64)
+
+        n_triples = len(self.tails)
+        self.n_relations = int(self.relations.max()) + 1 if n_triples > 0 else 1
+        self.n_tail_keys = max(self.n_neg_tails, int(self.tails.max()) + 1 if n_triples > 0 else 1)
+
+        if keys is None:
+            all_heads = np.repeat(np.arange(len(self.degrees), dtype=np.int64), self.degrees)
+            keys = np.sort(self.triple_keys(all_heads, self.relations, self.tails))
+        self.keys = keys
+
+    def shard(self, rank, world_size):
+        """
+        数据并行时每个进程只从第 rank, rank + world_size, ... 个头实体中采样
+        """
+        self.heads = self.kg_index.heads[rank::world_size].astype(np.int64)
+
+    def triple_keys(self, heads, relations, tails):
+        return (heads * self.n_relations + relations.astype(np.int64)) * self.n_tail_keys + tails.astype(np.int64)
+
+    def is_positive(self, heads, relations, tails):
+        query = self.triple_keys(heads, relations, tails)
+        pos = np.searchsorted(self.keys, query)
+        pos[pos == len(self.keys)] = 0
+        return self.keys[pos] == query
+
+    def sample_heads(self, batch_size, rng=np.random):
+        n_heads = len(self.heads)
+        if batch_size <= n_heads:
+            return self.heads[rng.choice(n_heads, batch_size, replace=False)]
+        return self.heads[rng.randint(0, n_heads, batch_size)]
+
+    def sample_pos_triples(self, heads, rng=np.random):
+        offsets = (rng.random_sample(len(heads)) * self.degrees[heads]).astype(np.int64)
+        edge_idx = self.offsets[heads] + offsets
+        return self.relations[edge_idx].astype(np.int64), self.tails[edge_idx].astype(np.int64)
+
+    def sample_neg_tails(self, heads, relations, rng=np.random):
+        neg_tails = rng.randint(0, self.n_neg_tails, len(heads))
+        reject = self.is_positive(heads, relations, neg_tails)
+        while reject.any():
+            neg_tails[reject] = rng.randint(0, self.n_neg_tails, int(reject.sum()))
+            reject[reject] = self.is_positive(heads[reject], relations[reject], neg_tails[reject])
+        return neg_tails
+
+    def sample(self, batch_size, rng=np.random):
+        """
+        返回四个 int64 数组：头实体、关系、正样本尾实体、负样本尾实体
+        """
+        heads = self.sample_heads(batch_size, rng)
+        relations, pos_tails = self.sample_pos_triples(heads, rng)
+        neg_tails = self.sample_neg_tails(heads, relations, rng)
+        return heads, relations, pos_tails, neg_tails
@@ -0,0 +1,81 @@
+import torch
+
+
+"""
+    不依赖 DGL 的图（--graph_backend sparse）
+    KGAT 对图只做三件事：按关系计算每条边的注意力、按目标节点做 edge softmax、用注意力加权求和邻居（SpMM），
+    后两者已经由 utility.helper 中基于 torch CSR 张量 / segment_reduce 的实现完成，
+    所以这里只需要保存边和节点、边的特征，实现 KGAT / DataLoaderKGAT 用到的那一部分 DGL 接口：
+        - edges() / num_nodes() / num_edges() / num_src_nodes() / num_dst_nodes()
+        - ndata / edata / srcdata / dstdata / is_block / device
+        - local_var() / to(device) / in_degrees(nodes)
+"""
+
+
+class SparseGraph(object):
+    """
+        - src / dst:    边的源节点和目标节点，int64 张量，边 src -> dst
+        - is_block:     False 时为整个图，源节点和目标节点相同，ndata 就是 srcdata / dstdata；
+                        True 时和 DGL block 相同，目标节点是源节点的前 num_dst_nodes 个
+    """
+
+    def __init__(self, src, dst, num_src_nodes, num_dst_nodes=None, is_block=False):
+        self.src = src
+        self.dst = dst
+        self._num_src_nodes = int(num_src_nodes)
+        self._num_dst_nodes = int(num_src_nodes if num_dst_nodes is None else num_dst_nodes)
+        self.is_block = is_block
+
+        self.srcdata = {}
+        self.dstdata = {} if is_block else self.srcdata
+        self.edata = {}
+
+    @property
+    def ndata(self):
+        if self.is_block:
+            raise AttributeError('ndata is not defined for blocks, use srcdata / dstdata')
+        return self.srcdata
+
+    @property
+    def device(self):
+        return self.src.device
+
+    def edges(self):
+        return self.src, self.dst
+
+    def num_nodes(self):
+        return self._num_src_nodes
+
+    def num_src_nodes(self):
+        return self._num_src_nodes
+
+    def num_dst_nodes(self):
+        return self._num_dst_nodes
+
+    def num_edges(self):
+        return len(self.src)
+
+    def in_degrees(self, nodes=None):
+        degrees = torch.bincount(self.dst, minlength=self._num_dst_nodes)
+        return degrees if nodes is None else degrees[nodes]
+
+    def _copy(self, fn):
+        g = SparseGraph(fn(self.src), fn(self.dst), self._num_src_nodes, self._num_dst_nodes, self.is_block)
+        g.srcdata.update({k: fn(v) for k, v in self.srcdata.items()})
+        if self.is_block:
+            g.dstdata.update({k: fn(v) for k, v in self.dstdata.items()})
+        g.edata.update({k: fn(v) for k, v in self.edata.items()})
+        return g
+
+    def local_var(self):
+        """
+        和 DGL 相同：返回共享结构和特征张量的图，在上面增删特征不影响原图
+        """
+        return self._copy(lambda x: x)
+
+    def to(self, device, **kwargs):
+        return self._copy(lambda x: x.to(device, **kwargs))
+
+    def __repr__(self):
+        return 'SparseGraph(num_src_nodes={}, num_dst_nodes={}, num_edges={}, is_block={})'.format(
+            self._num_src_nodes, self._num_dst_nodes, self.num_edges(), self.is_block)